@@ -0,0 +1,200 @@
+"""
+Throughput and precision/recall of the anonymization backends.
+
+Generates a synthetic labeled corpus of PQRS pages (names in title,
+upper and lower case, ids, phones, emails, accounts and addresses
+mixed with capitalized phrases that are not personal data), runs each
+backend over it and scores the redaction token by token: a token is
+redacted when it is replaced or removed in the output (difflib
+alignment), and it is personal data when it overlaps a labeled span.
+
+    python -m benchmarks.anonymizers
+    python -m benchmarks.anonymizers --pages 500 --backends regex presidio
+"""
+import argparse
+import difflib
+import random
+import re
+import time
+from collections import Counter
+
+from utils.functions import ANONYMIZERS
+
+FIRST_NAMES = ["Juan", "María", "Carlos", "Luisa", "Andrés", "Paola", "Jorge", "Diana", "Santiago", "Valentina"]
+LAST_NAMES = ["Pérez", "Gómez", "Rodríguez", "Martínez", "López", "Ramírez", "Torres", "Castaño", "Ospina", "Restrepo"]
+STREETS = ["Calle", "Carrera", "Cra", "Avenida", "Transversal", "Diagonal"]
+DOMAINS = ["gmail.com", "hotmail.com", "outlook.com", "yahoo.com"]
+# Frases capitalizadas que no son datos personales
+NOT_PERSONAL = [
+    "Derecho De Petición", "Superintendencia Financiera", "Cajero Automático", "Tarjeta De Crédito",
+    "Oficina Centro", "Defensor Del Consumidor", "Servicio Al Cliente", "Banca Móvil", "Ley De Habeas Data",
+    "Código De Comercio", "Banco Bilbao Vizcaya", "Medellín", "Bogotá"
+]
+FILLER = [
+    "solicito la devolución de {amount} que fueron debitados sin autorización",
+    "el día 15 de marzo de 2024 realicé un retiro en el {phrase} y no me entregó el dinero",
+    "presenté un reclamo ante la {phrase} y no he recibido respuesta",
+    "les pido revisar los movimientos de mi {phrase} del último mes",
+    "adjunto el extracto y la copia del {phrase} radicado en la {phrase}",
+]
+TEMPLATES = [
+    "Yo, {name_upper}, identificado con cédula {id}, {filler}.",
+    "Mi nombre es {name_lower} y mi número de celular es {phone}, {filler}.",
+    "Señores {phrase}: {name_title} con cédula de ciudadanía {id_dotted} {filler}.",
+    "Pueden contactarme al correo {email} o al teléfono {phone}. {filler}.",
+    "El dinero debía llegar a la Cuenta de Ahorro {account} a nombre de {name_title}. {filler}.",
+    "Recibo notificaciones en la {address}. {filler}.",
+    "{filler}. Atentamente, {name_upper}",
+    "mi esposa {name_lower} también fue afectada, {filler}.",
+]
+SLOT = re.compile(r"\{(\w+)\}")
+
+
+def fake_name(rng: random.Random) -> str:
+    words = [rng.choice(FIRST_NAMES)] + rng.sample(LAST_NAMES, rng.randint(1, 2))
+    return " ".join(words)
+
+
+def fake_value(slot: str, rng: random.Random) -> tuple[str, str]:
+    """
+    Returns the value of a template slot and its entity, None if the
+    value is not personal data.
+    """
+    if slot == "name_title":
+        return fake_name(rng), "NOMBRE"
+    if slot == "name_upper":
+        return fake_name(rng).upper(), "NOMBRE"
+    if slot == "name_lower":
+        return fake_name(rng).lower(), "NOMBRE_MINUSCULAS"
+    if slot == "id":
+        return str(rng.randint(10_000_000, 1_999_999_999)), "CÉDULA"
+    if slot == "id_dotted":
+        return f"{rng.randint(1, 99)}.{rng.randint(100, 999)}.{rng.randint(100, 999)}", "CÉDULA"
+    if slot == "phone":
+        return f"3{rng.randint(0, 50):02d} {rng.randint(100, 999)} {rng.randint(1000, 9999)}", "TELÉFONO"
+    if slot == "email":
+        user = f"{rng.choice(FIRST_NAMES)}.{rng.choice(LAST_NAMES)}{rng.randint(1, 99)}".lower()
+        return f"{user}@{rng.choice(DOMAINS)}", "CORREO"
+    if slot == "account":
+        return "".join(str(rng.randint(0, 9)) for _ in range(rng.choice([9, 10, 16]))), "CUENTA"
+    if slot == "address":
+        return f"{rng.choice(STREETS)} {rng.randint(1, 120)} # {rng.randint(1, 99)}-{rng.randint(1, 99)}", "DIRECCIÓN"
+    if slot == "phrase":
+        return rng.choice(NOT_PERSONAL), None
+    if slot == "amount":
+        return f"${rng.randint(1, 9)}.{rng.randint(100, 999)}.000", None
+    raise ValueError(slot)
+
+
+def render(template: str, rng: random.Random, spans: list, offset: int) -> str:
+    parts = []
+    last = 0
+    length = offset
+    for match in SLOT.finditer(template):
+        parts.append(template[last:match.start()])
+        length += len(template[last:match.start()])
+        if match.group(1) == "filler":
+            value = render(rng.choice(FILLER), rng, spans, length)
+        else:
+            value, entity = fake_value(match.group(1), rng)
+            if entity:
+                spans.append((length, length + len(value), entity))
+        parts.append(value)
+        length += len(value)
+        last = match.end()
+    parts.append(template[last:])
+    return "".join(parts)
+
+
+def labeled_corpus(n_pages: int, seed: int = 0) -> list[tuple[str, list]]:
+    """
+    Returns n_pages synthetic pages with their personal data spans
+    (start, end, entity).
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(n_pages):
+        text = ""
+        spans = []
+        for _ in range(rng.randint(6, 14)):
+            text += render(rng.choice(TEMPLATES), rng, spans, len(text)) + rng.choice([" ", "\n", "\n\n"])
+        corpus.append((text, spans))
+    return corpus
+
+
+def score(text: str, spans: list, output: str) -> Counter:
+    """
+    Returns the counts of true/false positives and false negatives of
+    the redacted tokens, overall and per entity.
+    """
+    tokens = [(match.start(), match.end(), match.group(0)) for match in re.finditer(r"\S+", text)]
+    redacted = set()
+    matcher = difflib.SequenceMatcher(None, [token[2] for token in tokens], re.findall(r"\S+", output), autojunk=False)
+    for tag, i1, i2, _, _ in matcher.get_opcodes():
+        if tag in ("replace", "delete"):
+            redacted.update(range(i1, i2))
+    counts = Counter()
+    for i, (start, end, _) in enumerate(tokens):
+        entity = next((span[2] for span in spans if span[0] < end and start < span[1]), None)
+        if entity and i in redacted:
+            counts["tp"] += 1
+            counts[f"tp:{entity}"] += 1
+        elif entity:
+            counts["fn"] += 1
+            counts[f"fn:{entity}"] += 1
+        elif i in redacted:
+            counts["fp"] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300, help="Number of synthetic pages")
+    parser.add_argument("--batch", type=int, default=16, help="Pages sent to the backend per call")
+    parser.add_argument("--backends", nargs="+", default=sorted(ANONYMIZERS), help="Backends to compare")
+    args = parser.parse_args()
+
+    corpus = labeled_corpus(args.pages)
+    chars = sum(len(text) for text, _ in corpus)
+    entities = sorted({span[2] for _, spans in corpus for span in spans})
+    print(f"Corpus: {len(corpus)} pages, {chars} characters")
+    print(f"{'backend':<10}{'load (s)':>10}{'pages/s':>10}{'kchars/s':>10}{'precision':>11}{'recall':>8}{'f1':>7}")
+    per_entity = {}
+    for name in args.backends:
+        anonymizer = ANONYMIZERS[name]()
+        # La primera llamada carga los modelos, se mide aparte del rendimiento
+        start = time.perf_counter()
+        try:
+            anonymizer.anonymize_texts([corpus[0][0]])
+        except ImportError as e:
+            print(f"{name:<10}not available: {e}")
+            continue
+        load = time.perf_counter() - start
+        outputs = []
+        start = time.perf_counter()
+        for i in range(0, len(corpus), args.batch):
+            outputs.extend(anonymizer.anonymize_texts([text for text, _ in corpus[i:i + args.batch]]))
+        elapsed = time.perf_counter() - start
+        counts = Counter()
+        for (text, spans), output in zip(corpus, outputs):
+            counts.update(score(text, spans, output))
+        precision = counts["tp"] / ((counts["tp"] + counts["fp"]) or 1)
+        recall = counts["tp"] / ((counts["tp"] + counts["fn"]) or 1)
+        f1 = 2 * precision * recall / ((precision + recall) or 1)
+        print(
+            f"{name:<10}{load:>10.2f}{len(corpus) / elapsed:>10.1f}{chars / elapsed / 1000:>10.1f}"
+            f"{precision:>11.3f}{recall:>8.3f}{f1:>7.3f}"
+        )
+        per_entity[name] = {
+            entity: counts[f"tp:{entity}"] / ((counts[f"tp:{entity}"] + counts[f"fn:{entity}"]) or 1)
+            for entity in entities
+        }
+
+    print("\nRecall per entity")
+    print(f"{'entity':<20}" + "".join(f"{name:>10}" for name in per_entity))
+    for entity in entities:
+        print(f"{entity:<20}" + "".join(f"{per_entity[name][entity]:>10.3f}" for name in per_entity))
+
+
+if __name__ == "__main__":
+    main()
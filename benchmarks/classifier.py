@@ -0,0 +1,101 @@
+"""
+Offline accuracy and latency evaluation of the typology pre-classifier.
+
+With a labeled history it runs a k-fold evaluation over the history
+(the catalog is always part of the training data). Without history it
+trains on the typology descriptions and evaluates on the held-out
+subtypology and third-party concept descriptions.
+
+    python -m benchmarks.classifier
+    python -m benchmarks.classifier --history data/db/historico_pqrs.csv --folds 5
+"""
+import argparse
+import random
+import time
+from pathlib import Path
+
+import numpy as np
+
+from utils.classifier import PRECLASSIFY_THRESHOLD, TypologyClassifier, catalog_examples, history_examples
+
+
+def evaluate(classifier: TypologyClassifier, texts: list[str], labels: list[int], threshold: float) -> dict:
+    hits_1 = hits_3 = 0
+    confidences = []
+    correct = []
+    latencies = []
+    for text, label in zip(texts, labels):
+        start = time.perf_counter()
+        predictions = classifier.predict(text, k=3)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids = [prediction["id"] for prediction in predictions]
+        hits_1 += ids[0] == label
+        hits_3 += label in ids
+        confidences.append(predictions[0]["confidence"])
+        correct.append(ids[0] == label)
+    confidences = np.array(confidences)
+    correct = np.array(correct, dtype=float)
+    # Error de calibración esperado con 10 intervalos de confianza
+    bins = np.minimum((confidences * 10).astype(int), 9)
+    ece = sum(
+        abs(confidences[bins == b].mean() - correct[bins == b].mean()) * (bins == b).mean()
+        for b in range(10) if (bins == b).any()
+    )
+    above = confidences >= threshold
+    return {
+        "n": len(texts),
+        "top1": hits_1 / len(texts),
+        "top3": hits_3 / len(texts),
+        "ece": float(ece),
+        "coverage": float(above.mean()),
+        "precision_above_threshold": float(correct[above].mean()) if above.any() else 0.0,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=Path, help="csv with columns texto and tipologia_id")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=PRECLASSIFY_THRESHOLD)
+    args = parser.parse_args()
+
+    catalog_texts, catalog_labels = catalog_examples()
+    history_texts, history_labels = history_examples(args.history) if args.history else ([], [])
+    results = []
+    if history_texts:
+        order = list(range(len(history_texts)))
+        random.Random(0).shuffle(order)
+        for fold in range(args.folds):
+            test = set(order[fold::args.folds])
+            train_texts = catalog_texts + [history_texts[i] for i in order if i not in test]
+            train_labels = catalog_labels + [history_labels[i] for i in order if i not in test]
+            start = time.perf_counter()
+            classifier = TypologyClassifier().fit(train_texts, train_labels)
+            train_time = time.perf_counter() - start
+            calibration = [i for i in order if i not in test][: max(len(order) // 10, 1)]
+            classifier.calibrate([history_texts[i] for i in calibration], [history_labels[i] for i in calibration])
+            result = evaluate(classifier, [history_texts[i] for i in test], [history_labels[i] for i in test], args.threshold)
+            result["train_s"] = train_time
+            results.append(result)
+    else:
+        base_texts, base_labels = catalog_examples(include_details=False)
+        start = time.perf_counter()
+        classifier = TypologyClassifier().fit(base_texts, base_labels)
+        train_time = time.perf_counter() - start
+        held_texts, held_labels = catalog_texts[len(base_texts):], catalog_labels[len(base_labels):]
+        # La mitad de los ejemplos calibra y la otra mitad evalúa
+        classifier.calibrate(held_texts[::2], held_labels[::2])
+        result = evaluate(classifier, held_texts[1::2], held_labels[1::2], args.threshold)
+        result["train_s"] = train_time
+        results.append(result)
+
+    print(f"{'n':>6}{'top1':>8}{'top3':>8}{'ece':>8}{'cover':>8}{'prec@thr':>10}{'p50 ms':>9}{'p95 ms':>9}{'train s':>9}")
+    for result in results:
+        print(f"{result['n']:>6}{result['top1']:>8.3f}{result['top3']:>8.3f}{result['ece']:>8.3f}{result['coverage']:>8.3f}"
+              f"{result['precision_above_threshold']:>10.3f}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['train_s']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
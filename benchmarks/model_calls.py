@@ -0,0 +1,147 @@
+"""
+Model calls per conversation with the legacy tools (get_subtypologies
+and get_typology_concept, one call per step) and with the typology
+dossier tool and parallel tool calls.
+
+Each conversation is seeded with a proposal of three typologies, as
+left by the first analysis, and then replays the analyst choosing
+one of them and asking for the response template. The model calls
+of a conversation are the AI messages the graph added to the thread.
+It calls the real model: set OPENAI_API_KEY (and OPENAI_BASE_URL if
+needed). With --scripted a stand-in model requests, at each step, the
+next tools the variant needs for the turn (all at once when parallel)
+and answers when they ran: the minimum model calls of each variant,
+through the real graph and tools, without calling a model.
+
+    python -m benchmarks.model_calls
+    python -m benchmarks.model_calls --typologies 64 350 24 --model gpt-5-mini
+    python -m benchmarks.model_calls --scripted
+"""
+import argparse
+import time
+from datetime import date
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_openai import ChatOpenAI
+from langgraph.checkpoint.memory import InMemorySaver
+
+from utils.agent import make_agent_graph
+from utils.dataframes import typo_data, typo_list
+from utils.prompts import agent_prompt
+from utils.tools import get_subtypologies, get_typology_concept, get_typology_dossier, make_response_document
+from utils.workspace import SessionWorkspace, use_workspace
+
+TURNS = ("Me quedo con la número 1", "Sí, genera la plantilla de respuesta")
+
+VARIANTS = {
+    "legacy": ([get_typology_concept, get_subtypologies, make_response_document], False),
+    "dossier": ([get_typology_dossier, make_response_document], True),
+}
+
+
+# Herramientas que pide el modelo guion en cada turno, la primera opción cuyas herramientas estén disponibles
+SCRIPT = {
+    TURNS[0]: (("get_typology_dossier",), ("get_typology_concept", "get_subtypologies")),
+    TURNS[1]: (("make_response_document",),),
+}
+
+
+def tool_args(name: str, typo_code: int) -> dict:
+    row = typo_data.set_index("id").loc[typo_code]
+    if name == "get_typology_concept":
+        return {"typo_code_list": typo_code}
+    if name == "make_response_document":
+        return {
+            "date": str(date.today()), "typo_name": row["typo"], "typo_desc": row["desc"],
+            "pqrs_summary": "El cliente no reconoce una transacción y solicita la devolución.", "file_name": "benchmark"
+        }
+    return {"typo_code": typo_code}
+
+
+class ScriptedModel(BaseChatModel):
+    typo_code: int
+    tools: tuple = ()
+    parallel: bool = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools: list, parallel_tool_calls: bool = True, **kwargs):
+        return self.model_copy(update={"tools": tuple(tool.name for tool in tools), "parallel": parallel_tool_calls})
+
+    def _generate(self, messages: list, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        turn = max(i for i, message in enumerate(messages) if isinstance(message, HumanMessage))
+        called = {call["name"] for message in messages[turn:] if isinstance(message, AIMessage) for call in message.tool_calls}
+        options = SCRIPT.get(messages[turn].content, ())
+        needed = next((names for names in options if all(name in self.tools for name in names)), ())
+        pending = [name for name in needed if name not in called]
+        if not self.parallel:
+            pending = pending[:1]
+        message = AIMessage(content="" if pending else "Listo.", tool_calls=[
+            {"name": name, "args": tool_args(name, self.typo_code), "id": f"call_{len(messages)}_{i}"}
+            for i, name in enumerate(pending)
+        ])
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def proposal(typo_codes: list[int]) -> str:
+    rows = typo_data.set_index("id").loc[typo_codes]
+    lines = [f"{i}. **{row['typo']} ({code})**: {row['desc']}" for i, (code, row) in enumerate(rows.iterrows(), 1)]
+    return "Selección de tipologías propuestas\n" + "\n".join(lines) + \
+        "\n¿Con cuál de las 3 tipologías deseas clasificar el documento?"
+
+
+def run_conversation(agent, thread_id: str, typo_codes: list[int]) -> tuple[int, int, float]:
+    config = {"configurable": {"thread_id": thread_id}}
+    sys_prompt = agent_prompt.format(typo_list=typo_list, file_name="benchmark", today=date.today())
+    agent.update_state(
+        config,
+        {"messages": [
+            SystemMessage(content=sys_prompt),
+            HumanMessage(content="Analiza este documento."),
+            AIMessage(content=proposal(typo_codes))
+        ]},
+        as_node="chatbot"
+    )
+    start = time.perf_counter()
+    # La plantilla queda en un espacio de trabajo en memoria
+    with use_workspace(SessionWorkspace(persist=False)):
+        for turn in TURNS:
+            agent.invoke({"messages": [HumanMessage(content=turn)]}, config)
+    elapsed = time.perf_counter() - start
+    messages = agent.get_state(config).values["messages"][3:]
+    ai_messages = [message for message in messages if isinstance(message, AIMessage)]
+    tool_calls = sum(len(message.tool_calls) for message in ai_messages)
+    return len(ai_messages), tool_calls, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--typologies", type=int, nargs="+", default=[64, 350, 24], help="Proposed typology codes")
+    parser.add_argument("--model", default="gpt-5-mini")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--scripted", action="store_true", help="Minimum model calls with a scripted stand-in model")
+    args = parser.parse_args()
+
+    if args.scripted:
+        llm = ScriptedModel(typo_code=args.typologies[0])
+    else:
+        llm = ChatOpenAI(model=args.model, temperature=0)
+    print(f"{'variant':<12}{'calls/conv':>12}{'tools/conv':>12}{'s/conv':>10}")
+    for name, (tools, parallel) in VARIANTS.items():
+        # El análisis ya viene en la conversación, ningún paso usa el esquema tipado
+        agent = make_agent_graph(
+            llm=llm, tools=tools, memory=InMemorySaver(), parallel_tool_calls=parallel, structured_analysis=False
+        )
+        results = [
+            run_conversation(agent, f"{name}-{repeat}", args.typologies) for repeat in range(args.repeats)
+        ]
+        calls, tool_calls, elapsed = (sum(values) / len(results) for values in zip(*results))
+        print(f"{name:<12}{calls:>12.2f}{tool_calls:>12.2f}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Stress benchmark of the redaction modes.
+
+Checks that the chunked mode gives the same output as the full mode
+on a sample corpus and times both modes on adversarial OCR text.
+The anonymizers apply the mode to one page at a time, so the
+comparison that matters is with the full mode applied page by page.
+On a whole multi-page text the full mode also matches across page
+separators (e.g. the address tail swallows the separator), which
+is reported apart.
+
+    python -m benchmarks.redaction
+    python -m benchmarks.redaction --corpus data/pqrs/textos
+"""
+import argparse
+import random
+import time
+from pathlib import Path
+
+from utils.functions import PAGE_SEPARATOR, encrypt_text, encrypt_text_chunked
+
+# Fragmentos para generar cartas sintéticas parecidas a las PQRS
+SAMPLE_WORDS = [
+    "Señores", "BBVA", "Colombia", "Yo,", "JUAN", "CARLOS", "PEREZ", "Juan", "Carlos", "Pérez", "de", "del",
+    "la", "Rosa", "identificado", "con", "cédula", "1.234.567", "1234567890", "cuenta", "Cuenta de Ahorro",
+    "123456789", "celular", "315 123 4567", "correo", "juan.perez@gmail.com", "jp (a) hotmail.com",
+    "Calle 45 # 12-34 apto 301", "Cra 7 No. 71-52", "$1.000.000", "retiro", "cajero", "no", "me",
+    "entregó", "el", "dinero", "DERECHO", "DE", "PETICIÓN", "Atentamente,", "Superintendencia",
+    "Financiera", "12-34-5678", ",", ".", "\n", "\n\n"
+]
+
+# Textos adversariales: ruido de OCR que dispara el retroceso de las expresiones
+ADVERSARIAL = {
+    "glued_capwords": lambda n: "Aa" * n + "1",
+    "capwords_de": lambda n: "Aa de " * n + "Aa1",
+    "upper_runs": lambda n: "AB " * n + "Ca",
+    "dotted_noise": lambda n: "a." * n,
+    "dashed_digits": lambda n: "12-" * n,
+}
+
+
+def sample_corpus(n_docs: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    docs = []
+    for _ in range(n_docs):
+        pages = [" ".join(rng.choice(SAMPLE_WORDS) for _ in range(rng.randint(100, 600))) for _ in range(rng.randint(1, 4))]
+        docs.append("".join(f"\n\n--- Página {i + 1}---\n\n{page}" for i, page in enumerate(pages)).strip())
+    return docs
+
+
+def encrypt_text_by_page(text: str) -> str:
+    pieces = PAGE_SEPARATOR.split(text)
+    separators = [match.group(0) for match in PAGE_SEPARATOR.finditer(text)] + [""]
+    return "".join(encrypt_text(page) + separator for page, separator in zip(pieces[::2], separators))
+
+
+def timed(function, text: str) -> tuple[str, float]:
+    start = time.perf_counter()
+    result = function(text)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=Path, help="Directory of OCR .txt files to compare both modes")
+    parser.add_argument("--docs", type=int, default=200, help="Number of synthetic documents when no corpus is given")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000, 16000], help="Repetitions of each adversarial pattern")
+    args = parser.parse_args()
+
+    if args.corpus:
+        docs = [path.read_text(encoding="utf-8") for path in sorted(args.corpus.glob("*.txt"))]
+    else:
+        docs = sample_corpus(args.docs)
+    different = different_by_page = 0
+    full_total = chunked_total = 0.0
+    for doc in docs:
+        full, full_time = timed(encrypt_text, doc)
+        chunked, chunked_time = timed(encrypt_text_chunked, doc)
+        different += full != chunked
+        different_by_page += encrypt_text_by_page(doc) != chunked
+        full_total += full_time
+        chunked_total += chunked_time
+    print(f"Corpus: {len(docs)} documents, full {full_total:.3f}s, chunked {chunked_total:.3f}s")
+    print(f"  different from full mode page by page (as the anonymizers apply it): {different_by_page}")
+    print(f"  different from full mode on the whole text: {different} (matches across page separators)")
+
+    print(f"{'case':<16}{'chars':>9}{'full (s)':>11}{'chunked (s)':>13}{'same':>6}")
+    for name, generate in ADVERSARIAL.items():
+        for size in args.sizes:
+            text = generate(size)
+            full, full_time = timed(encrypt_text, text)
+            chunked, chunked_time = timed(encrypt_text_chunked, text)
+            print(f"{name:<16}{len(text):>9}{full_time:>11.3f}{chunked_time:>13.3f}{str(full == chunked):>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Documents rendered per second by create_pdf and the response template.
+
+Renders synthetic anonymized cases of 1 and 100 pages with the
+per-line renderer used before (full font added to every document and
+one multi_cell per line) and with create_pdf (process-wide font
+subset and bulk layout of each page), checking both give the same
+pages, page map and text. The response docx is compared built from
+scratch with python-docx against the prepared template.
+
+    python -m benchmarks.rendering
+    python -m benchmarks.rendering --pages 1 10 100 --repeat 5
+"""
+import argparse
+import os
+import random
+import re
+import time
+from pathlib import Path
+
+import fitz
+from fpdf import FPDF
+
+from utils.functions import PAGE_SEPARATOR, create_pdf, join_pages
+from utils.rendering import render_font
+
+FONT_PATH = Path(os.getcwd()) / "fonts" / "noto-sans-regular.ttf"
+
+SENTENCES = [
+    "Señores BBVA Colombia, yo [NOMBRE] identificado con cédula [CÉDULA] presento derecho de petición.",
+    "El día 3 de marzo realicé un retiro en el cajero automático y no me entregó el dinero.",
+    "Solicito la devolución de $1.250.000 debitados de mi cuenta [CUENTA] sin mi autorización.",
+    "Fecha Descripción Valor Saldo 2024-03-03 COMPRA INTERNACIONAL 1.250.000 3.400.000",
+    "Vigilado Superintendencia Financiera de Colombia.",
+    "Recibo notificaciones en [DIRECCIÓN] o al correo [CORREO].",
+    "REF-0000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000",
+]
+
+
+def synthetic_text(n_pages: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    pages = []
+    for i in range(n_pages):
+        lines = [" ".join(rng.choice(SENTENCES) for _ in range(rng.randint(0, 2))) for _ in range(rng.randint(15, 30))]
+        pages.append({"page": i + 1, "text": "\n".join(lines)})
+    return join_pages(pages)
+
+
+# Renderizador anterior, como referencia
+def per_line_pdf(text: str, font_path: Path) -> tuple[bytes, dict]:
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.add_font("Noto", "", font_path)
+    pdf.set_font("Noto", size=12)
+    pdf.set_auto_page_break(auto=True, margin=15)
+    page_map = {}
+    current = None
+    for linea in text.split("\n"):
+        separator = PAGE_SEPARATOR.fullmatch(linea)
+        if separator:
+            if current is not None:
+                pdf.add_page()
+            current = int(separator.group(1))
+            page_map[current] = [pdf.page_no() - 1]
+        pdf.multi_cell(0, 10, linea, new_x="LMARGIN", new_y="NEXT")
+        if current is not None and pdf.page_no() - 1 not in page_map[current]:
+            page_map[current].append(pdf.page_no() - 1)
+    return bytes(pdf.output()), page_map
+
+
+def pdf_text(data: bytes) -> list[str]:
+    with fitz.open(stream=data, filetype="pdf") as document:
+        return [" ".join(re.findall(r"\S+", page.get_text())) for page in document]
+
+
+def docs_per_second(render, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        render()
+    return repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 100], help="Pages of the synthetic cases")
+    parser.add_argument("--repeat", type=int, default=20, help="Documents rendered per measure (at least 1 for 100 pages)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    subset_path = render_font(FONT_PATH)
+    print(f"Font subset: {time.perf_counter() - start:.2f}s, {FONT_PATH.stat().st_size} -> {subset_path.stat().st_size} bytes")
+    print(f"{'pages':>6}{'per line docs/s':>17}{'bulk docs/s':>13}{'speedup':>9}{'pdf pages':>11}{'same text':>11}{'same map':>10}")
+    for n_pages in args.pages:
+        text = synthetic_text(n_pages)
+        repeat = max(args.repeat * 10 // (n_pages + 9), 1)
+        before, before_map = per_line_pdf(text, FONT_PATH)
+        after, after_map = create_pdf(text, None, FONT_PATH)
+        same_text = pdf_text(before) == pdf_text(after)
+        baseline = docs_per_second(lambda: per_line_pdf(text, FONT_PATH), repeat)
+        bulk = docs_per_second(lambda: create_pdf(text, None, FONT_PATH), repeat)
+        print(
+            f"{n_pages:>6}{baseline:>17.2f}{bulk:>13.2f}{bulk / baseline:>8.1f}x"
+            f"{len(pdf_text(after)):>11}{str(same_text):>11}{str(before_map == after_map):>10}"
+        )
+
+    # La herramienta importa langchain, se mide solo si está instalado
+    try:
+        from utils.tools import build_response_document, render_response_document
+    except ImportError as e:
+        print(f"Response template not measured: {e}")
+        return
+    fields = {
+        "date": "19 de octubre de 2026",
+        "typo_name": "Fraude por transacción no reconocida",
+        "typo_desc": "El cliente no reconoce una compra & solicita <reversión>",
+        "pqrs_summary": "\n".join(random.Random(0).choice(SENTENCES) for _ in range(12))
+    }
+    repeat = args.repeat * 5
+    scratch = docs_per_second(lambda: build_response_document(**fields), repeat)
+    # Se llama sin la memoria de lru_cache para medir el render de la plantilla
+    template = docs_per_second(lambda: render_response_document.__wrapped__(**fields), repeat)
+    print(f"\nResponse docx: from scratch {scratch:.1f} docs/s, template {template:.1f} docs/s ({template / scratch:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Before/after pixel and byte totals of the vision payload.
+
+Every page is treated as a weak page so it is a candidate to be sent
+as an image. Without arguments a synthetic anonymized case is built
+(letter, annexes, blank backs and a legal footer page); with --cases
+each directory with <case>_encrypted.pdf and <case>_encrypted_pages.json
+is measured.
+
+    python -m benchmarks.vision
+    python -m benchmarks.vision --cases data/cases/artifacts --max-images 4
+"""
+import argparse
+import os
+import random
+import time
+from pathlib import Path
+
+from utils.functions import create_pdf, join_pages, load_case_artifacts
+from utils.vision import VISION_MAX_IMAGES, VISION_TOKENS_PER_IMAGE, optimize_vision_payload
+
+FONT_PATH = Path(os.getcwd()) / "fonts" / "noto-sans-regular.ttf"
+
+LETTER = (
+    "Señores BBVA Colombia. Yo, [NOMBRE] identificado con cédula [CÉDULA], presento reclamo por el cobro "
+    "de una transacción que no reconozco en mi cuenta [CUENTA] por $1.250.000 el día 3 de marzo. "
+    "Solicito la devolución del dinero y el extracto de la tarjeta de crédito. "
+)
+ANNEX = "Fecha Descripción Valor Saldo 2024-03-03 COMPRA INTERNACIONAL 1.250.000 3.400.000 "
+FOOTER = (
+    "Vigilado Superintendencia Financiera de Colombia. Este mensaje y sus anexos contienen información "
+    "confidencial. Consulte nuestra política de tratamiento de datos personales en la línea de atención. "
+)
+
+
+def synthetic_case(seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    texts = [LETTER * rng.randint(4, 8), LETTER * 3, "", ANNEX * 25, ANNEX * 20, "", FOOTER * 2, ANNEX * 15, "", LETTER * 2]
+    pages = [{"page": i + 1, "text": text} for i, text in enumerate(texts)]
+    pdf, page_map = create_pdf(join_pages(pages), None, FONT_PATH)
+    for page in pages:
+        page["pdf_pages"] = page_map.get(page["page"], [])
+    return {"pdf": pdf, "pages": pages}
+
+
+def measure(name: str, case: dict, max_images: int, tokens_per_image: int):
+    start = time.perf_counter()
+    _, report = optimize_vision_payload(case["pdf"], case["pages"], max_images, tokens_per_image, report_bytes=True)
+    elapsed = time.perf_counter() - start
+    pixel_ratio = report["pixels_after"] / report["pixels_before"] if report["pixels_before"] else 0.0
+    byte_ratio = report["bytes_after"] / report["bytes_before"] if report["bytes_before"] else 0.0
+    print(
+        f"{name:<24}{report['images_before']:>7}{report['images_after']:>7}"
+        f"{report['pixels_before']:>12}{report['pixels_after']:>12}{pixel_ratio:>8.1%}"
+        f"{report['bytes_before'] or 0:>12}{report['bytes_after']:>12}{byte_ratio:>8.1%}"
+        f"{report['blank']:>7}{report['capped']:>7}{elapsed:>8.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=Path, help="Directory with one sub-directory per persisted case")
+    parser.add_argument("--max-images", type=int, default=VISION_MAX_IMAGES)
+    parser.add_argument("--tokens-per-image", type=int, default=VISION_TOKENS_PER_IMAGE)
+    args = parser.parse_args()
+
+    cases = {}
+    if args.cases:
+        for encrypted_path in sorted(args.cases.glob("*/*_encrypted.pdf")):
+            artifacts = load_case_artifacts(encrypted_path)
+            if artifacts:
+                pages = [page for page in artifacts["pages"] if not page.get("duplicate_of")]
+                cases[encrypted_path.parent.name] = {"pdf": artifacts["pdf"], "pages": pages}
+    else:
+        cases["synthetic"] = synthetic_case()
+
+    print(
+        f"{'case':<24}{'img':>7}{'img':>7}{'px before':>12}{'px after':>12}{'px %':>8}"
+        f"{'B before':>12}{'B after':>12}{'B %':>8}{'blank':>7}{'capped':>7}{'s':>8}"
+    )
+    for name, case in cases.items():
+        measure(name, case, args.max_images, args.tokens_per_image)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
+import hashlib
 import logging
 import os
+import uuid
 from pathlib import Path
 
-import numpy as np
 import httpx
 from dotenv import load_dotenv
 
@@ -10,21 +11,27 @@ from langgraph.checkpoint.memory import InMemorySaver
 
 import streamlit as st
 
-from utils.tools import get_typology_concept, get_subtypologies, make_response_document, typo_data
+from utils.dataframes import typo_list
+from utils.tools import get_typology_dossier, make_response_document
 from utils.prompts import agent_prompt
-from utils.agent import make_agent_graph
+from utils.prompt_assembly import prompt_assembler
+from utils.agent import make_agent_graph, route_metrics
+from utils.cache import AnalysisCache, content_hash
+from utils.cancellation import Cancelled, cancellable, cancellation_metrics
+from utils.case_store import CaseStore
+from utils.classifier import PRECLASSIFY, TypologyClassifier, train_classifier
+from utils.governor import admission, governor
+from utils.ocr_cache import PageOCRCache
+from utils.pipeline import pipeline_metrics
+from utils.prefetch import SpeculativePrefetcher
+from utils.profiling import profile_request, should_profile
+from utils.shared_cache import SharedCache, make_shared_cache
 from utils.response import get_agent_response
+from utils.workspace import SessionWorkspace
+from utils.logs import hot, log_context, setup_logging
 
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # --------------------------------------------------- VARIABLES DE ENTORNO ----------------------------------------------------
@@ -58,31 +65,104 @@ MIME_TYPES = {
 model_supplier = "openai"
 model_id = "gpt-5"
 
-if model_supplier == "openai":
-    from utils.openai import AWSSignedHTTPTransport
-    from langchain_openai import ChatOpenAI
-    llm = ChatOpenAI(
-        model=model_id,
-        base_url=URL_EXP_ENV,
-        api_key=JWT_EXP_ENV,
-        max_tokens=None,
-        http_client=httpx.Client(transport=AWSSignedHTTPTransport()),
-        temperature=0
-    )
-    logger.info(f"Using OPENAI {model_id}")
-elif model_supplier == "vertex":
-    from utils.vertexai import service_account_credentials
-    from langchain_google_vertexai import ChatVertexAI
-    llm = ChatVertexAI(
-        model_name=model_id,
-        base_url=URL_EXP_ENV,
-        credentials=service_account_credentials,
-        max_tokens=None,
-        temperature=0
-    )
-    logger.info(f"Using VERTEX {model_id}")
-else:
-    None
+# Modelo por etapa del grafo
+# El análisis multimodal usa el modelo grande, el despacho de herramientas
+# y el formato de sus resultados usan un modelo rápido
+model_routes = {
+    "analysis": (model_supplier, model_id),
+    "followup": ("openai", "gpt-5-mini"),
+    "tool_result": ("openai", "gpt-5-mini"),
+}
+
+
+# Función para crear el cliente de un proveedor y modelo
+def make_llm(model_supplier: str, model_id: str):
+    if model_supplier == "openai":
+        from utils.openai import AWSSignedHTTPTransport
+        from langchain_openai import ChatOpenAI
+        llm = ChatOpenAI(
+            model=model_id,
+            base_url=URL_EXP_ENV,
+            api_key=JWT_EXP_ENV,
+            max_tokens=None,
+            http_client=httpx.Client(transport=AWSSignedHTTPTransport()),
+            # Los reintentos los maneja el transporte respetando el deadline del turno
+            max_retries=0,
+            temperature=0
+        )
+        logger.info(f"Using OPENAI {model_id}")
+    elif model_supplier == "vertex":
+        from utils.vertexai import service_account_credentials, mount_signed_transport
+        from langchain_google_vertexai import ChatVertexAI
+        llm = ChatVertexAI(
+            model_name=model_id,
+            base_url=URL_EXP_ENV,
+            credentials=service_account_credentials,
+            max_tokens=None,
+            temperature=0,
+            api_transport="rest"
+        )
+        mount_signed_transport(llm.prediction_client)
+        logger.info(f"Using VERTEX {model_id}")
+    else:
+        llm = None
+    return llm
+
+
+llm = make_llm(model_supplier, model_id)
+route_llms = {
+    stage: llm if route == (model_supplier, model_id) else make_llm(*route)
+    for stage, route in model_routes.items()
+}
+
+
+# Cache del primer análisis compartida por todas las sesiones del proceso
+@st.cache_resource
+def get_analysis_cache() -> AnalysisCache:
+    return AnalysisCache()
+
+analysis_cache = get_analysis_cache()
+
+
+# Índice de los casos guardados en disco, compartido por todas las sesiones
+@st.cache_resource
+def get_case_store() -> CaseStore:
+    return CaseStore(root=CASES_PATH)
+
+case_store = get_case_store()
+
+
+# Clasificador local de tipologías, se entrena una vez por proceso si está activado
+@st.cache_resource
+def get_classifier() -> TypologyClassifier:
+    return train_classifier() if PRECLASSIFY else None
+
+classifier = get_classifier()
+
+
+# Precálculo de las tipologías propuestas mientras el analista elige una
+@st.cache_resource
+def get_prefetcher() -> SpeculativePrefetcher:
+    return SpeculativePrefetcher()
+
+prefetcher = get_prefetcher()
+
+
+# Cache de artefactos compartido entre los procesos del servidor (SHARED_CACHE_URL)
+# Un documento cargado en varios procesos a la vez se procesa una sola vez
+@st.cache_resource
+def get_shared_cache() -> SharedCache:
+    return make_shared_cache()
+
+shared_cache = get_shared_cache()
+
+
+# OCR de las páginas que se repiten entre casos (formatos, cartas remisorias)
+@st.cache_resource
+def get_ocr_cache() -> PageOCRCache:
+    return PageOCRCache()
+
+ocr_cache = get_ocr_cache()
 
 # --------------------------------------------------- STREAMLIT ---------------------------------------------------------------
 st.markdown(
@@ -94,6 +174,7 @@ with st.expander("**¿Cómo usar a Faro?**"):
 """
 FARO es el asistente inteligente diseñado especificamente para ayudarte a gestionar las PQRS de los clientes.
 Lo único que debes hacer es cargar el documento **.pdf** que deseas que analicemos juntos.
+Si el caso tiene anexos puedes cargarlos todos juntos, las páginas repetidas solo se analizan una vez.
 En este momento tengo la capacidad de:
 * Identificar la o las tipologías más adecuadas para el contexto del caso del cliente.
 * Darte un resumen detallado de que necesita el usuario.
@@ -110,16 +191,16 @@ st.markdown(
     "<h4 style='text-align: center;'>Aquí puedes cargar el documento que quieres que analicemos📑</h4>",
     unsafe_allow_html=True
 )
-uploaded_file = st.file_uploader(
+uploaded_files = st.file_uploader(
     label="Cargar documento",
     label_visibility="collapsed",
     type="pdf",
-    accept_multiple_files=False,
+    accept_multiple_files=True,
 )
 
 # Variables de sesión de Streamlit
 if "thread_id" not in st.session_state:
-    st.session_state["thread_id"] = str(np.random.randint(1, 500)).zfill(5)
+    st.session_state["thread_id"] = uuid.uuid4().hex
 
 if "memory" not in st.session_state:
     st.session_state["memory"] = InMemorySaver()
@@ -133,71 +214,136 @@ for msg in st.session_state.messages:
 if "document_analyzed" not in st.session_state:
     st.session_state["document_analyzed"] = False
 
-if "uploaded_filename" not in st.session_state:
-    st.session_state["uploaded_filename"] = ""
+if "uploaded_key" not in st.session_state:
+    st.session_state["uploaded_key"] = ""
+
+if "case_hash" not in st.session_state:
+    st.session_state["case_hash"] = ""
+
+# Espacio de trabajo aislado de la sesión para los artefactos de sus casos
+if "workspace" not in st.session_state:
+    st.session_state["workspace"] = SessionWorkspace(root=CASES_PATH, store=case_store)
+
+# Perfilado del turno: con ?profile=1 en la url o por muestreo (PROFILE_SAMPLE_RATE)
+profile_requested = st.query_params.get("profile", "").lower() in ("1", "true")
+
+
+# Función para ubicar los perfiles junto a los artefactos del caso
+def profile_dir(documents: list[tuple[str, bytes]]) -> Path:
+    case_name = Path(documents[0][0]).stem if documents else "sin_documento"
+    return st.session_state["workspace"].case_path(case_name) / "profiles"
 
 
 # Agente
 agent = make_agent_graph(
     llm=llm,
-    tools=[get_typology_concept, get_subtypologies, make_response_document],
-    memory=st.session_state["memory"]
+    tools=[get_typology_dossier, make_response_document],
+    memory=st.session_state["memory"],
+    routes=route_llms
 )
 
 # Una vez cargado crea un mensaje para disparar el agente automaticamente
-if uploaded_file:
-    if uploaded_file.name != st.session_state["uploaded_filename"]:
+if uploaded_files:
+    # El primer archivo es la carta y los demás sus anexos
+    # La llave cambia si se cargan otros archivos o los mismos con cambios
+    # Los documentos se procesan en memoria, sin escribirlos en el directorio de trabajo
+    documents = [(f.name, f.getvalue()) for f in uploaded_files]
+    uploaded_key = "|".join(f"{name}:{hashlib.sha256(data).hexdigest()}" for name, data in documents)
+    if uploaded_key != st.session_state["uploaded_key"]:
         logger.info("New document")
         st.toast("**¡Documento cargado!** ✅", duration="long")
-        doc_path = MAIN_PATH / uploaded_file.name
-        with open(doc_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        logger.info("Document obtained")
+        logger.info(f"Document obtained with {len(documents) - 1} attachments")
 
         # Reiniciar conversación y memoria
-        st.session_state["thread_id"] = str(np.random.randint(1, 500)).zfill(5)
+        st.session_state["thread_id"] = uuid.uuid4().hex
+        st.session_state["case_hash"] = content_hash(uploaded_key)[:12]
         st.session_state["messages"] = []
         st.session_state["document_analyzed"] = False
 
         # Ya tenemos el documento podemos ejecutar la logica
         # siempre y cuando no lo hayamos hecho antes
-        with st.spinner("¡Analizando documento! 🧐"):
-            auto_response = get_agent_response(
-                cases_path=CASES_PATH,
-                agent=agent,
-                thread_id=st.session_state["thread_id"],
-                typo_list="\n".join(typo_data["data"].tolist()),
-                sys_prompt=agent_prompt,
-                user_input=None,
-                doc_path=doc_path,
-                memory=st.session_state["memory"]
-            )
+        profiling = should_profile(profile_requested)
+        # La propuesta del clasificador local se muestra aquí antes de la respuesta del LLM
+        proposal_placeholder = st.empty()
+        try:
+            with st.spinner("¡Analizando documento! 🧐"), log_context(
+                    case=st.session_state["case_hash"], thread_id=st.session_state["thread_id"]), profile_request(
+                    profile_dir(documents) if profiling else None, profiling, name="analysis"), cancellable(
+                    st.session_state["workspace"].session_id, job=f"analysis:{st.session_state['case_hash']}"), admission(
+                    "analysis", st.session_state["workspace"].session_id):
+                auto_response = get_agent_response(
+                    agent=agent,
+                    thread_id=st.session_state["thread_id"],
+                    typo_list=typo_list,
+                    sys_prompt=agent_prompt,
+                    user_input=None,
+                    documents=documents,
+                    workspace=st.session_state["workspace"],
+                    memory=st.session_state["memory"],
+                    model_id=model_id,
+                    analysis_cache=analysis_cache,
+                    classifier=classifier,
+                    prefetcher=prefetcher,
+                    shared_cache=shared_cache,
+                    ocr_cache=ocr_cache,
+                    on_proposal=lambda proposal: proposal_placeholder.chat_message("assistant").markdown(proposal)
+                )
+        except Cancelled:
+            # El analista cargó otro documento, este análisis ya no se mostraría
+            logger.info("Turn superseded by a newer one of the session")
+            st.stop()
+        logger.info(f"Analysis cache stats: {analysis_cache.stats()}")
+        logger.info(f"Case store stats: {case_store.stats()}")
+        logger.info(f"Shared cache stats: {shared_cache.stats()}")
+        logger.info(f"Route metrics: {route_metrics.summary()}")
+        logger.info(f"Conversation metrics: {route_metrics.conversation_summary()}")
+        logger.info(f"Static prompt memo: {prompt_assembler.stats()}")
+        logger.info(f"Cancellation metrics: {cancellation_metrics.summary()}")
+        logger.info(f"Gateway governor: {governor.stats()}")
+        logger.info(f"Page pipeline metrics: {pipeline_metrics.summary()}")
         st.session_state.messages.append({"role": "assistant", "content": auto_response[0]})
+        # La respuesta ya incluye la propuesta
+        proposal_placeholder.empty()
         st.chat_message("assistant").markdown(auto_response[0])
         # Marcamos el documento como ya analizado
-        st.session_state["uploaded_filename"] = uploaded_file.name
+        st.session_state["uploaded_key"] = uploaded_key
         st.session_state["document_analyzed"] = True
-    else:
-        doc_path = MAIN_PATH / uploaded_file.name
 else:
-    logger.info("Document already analized")
-    doc_path = None
+    logger.info("Document already analized", extra=hot())
+    documents = None
 
 # -------------------------------------------------------------- CHATBOT -------------------------------------------------------
 if prompt := st.chat_input():
     st.session_state.messages.append({"role": "user", "content": prompt})
     st.chat_message("user").write(prompt)
-    with st.spinner("¡Pensando! 🧐", show_time=False):
-        response = get_agent_response(
-            cases_path=CASES_PATH,
-            agent=agent,
-            thread_id=st.session_state["thread_id"],
-            typo_list="\n".join(typo_data["data"].tolist()),
-            sys_prompt=agent_prompt,
-            user_input=prompt,
-            doc_path=doc_path,
-            memory=st.session_state["memory"]
-        )
+    profiling = should_profile(profile_requested)
+    try:
+        with st.spinner("¡Pensando! 🧐", show_time=False), log_context(
+                case=st.session_state["case_hash"], thread_id=st.session_state["thread_id"]), profile_request(
+                profile_dir(documents) if profiling else None, profiling, name="chat"), cancellable(
+                st.session_state["workspace"].session_id, job=f"chat:{st.session_state['case_hash']}"), admission(
+                "interactive", st.session_state["workspace"].session_id):
+            response = get_agent_response(
+                agent=agent,
+                thread_id=st.session_state["thread_id"],
+                typo_list=typo_list,
+                sys_prompt=agent_prompt,
+                user_input=prompt,
+                documents=documents,
+                workspace=st.session_state["workspace"],
+                memory=st.session_state["memory"],
+                prefetcher=prefetcher,
+                shared_cache=shared_cache,
+                ocr_cache=ocr_cache
+            )
+    except Cancelled:
+        # La sesión empezó un turno más nuevo, este resultado ya no se mostraría
+        logger.info("Turn superseded by a newer one of the session")
+        st.stop()
+    logger.info(f"Route metrics: {route_metrics.summary()}")
+    logger.info(f"Conversation metrics: {route_metrics.conversation_summary()}")
+    logger.info(f"Prefetch stats: {prefetcher.stats()}")
+    logger.info(f"Gateway governor: {governor.stats()}")
     st.session_state.messages.append({"role": "assistant", "content": response[0]})
     st.chat_message("assistant").markdown(response[0])
     # Boton de descarga de las imagenes
@@ -0,0 +1,19 @@
+"""
+PageOCRCache counts distinct cases per page and stores only what it is given.
+
+    python -m pytest -q tests
+"""
+from utils.ocr_cache import PageOCRCache
+
+
+def test_page_is_stored_after_min_distinct_cases(tmp_path):
+    cache = PageOCRCache(tmp_path / "page_ocr.sqlite", min_cases=3)
+    result = {"text": "[NOMBRE] radicó el formato", "weak": False, "mask": None}
+    # Volver a ver la página en un caso ya contado no suma
+    assert not cache.record("policy/digest", "A", result)
+    assert not cache.record("policy/digest", "B", result)
+    assert not cache.record("policy/digest", "A", result)
+    assert cache.get("policy/digest") is None
+    assert cache.record("policy/digest", "C", result)
+    assert cache.get("policy/digest") == result
+    assert cache.stats()["hits"] == 1
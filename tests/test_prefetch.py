@@ -0,0 +1,37 @@
+"""
+Only a short, explicit choice of a proposed typology injects its prefetched dossier.
+
+    python -m pytest -q tests
+"""
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from utils.prefetch import chosen_typology  # noqa: E402
+
+CODES = [64, 12, 30]
+
+
+@pytest.mark.parametrize("message, code", [
+    ("2", 12),
+    ("La 2", 12),
+    ("la tercera opción, por favor", 30),
+    ("Me quedo con la número 1", 64),
+    ("tipología 30", 30),
+    ("64", 64),
+])
+def test_explicit_choices(message, code):
+    assert chosen_typology(message, CODES) == code
+
+
+@pytest.mark.parametrize("message", [
+    "el 1 de marzo hice el retiro",
+    "el primer pago no lo reconozco",
+    "y 3 cuotas más",
+    "la 2 y la 3",
+    "el cliente reclama 64 mil pesos",
+    "¿qué pasa con la 2?",
+    "4",
+])
+def test_follow_up_text_is_not_a_choice(message):
+    assert chosen_typology(message, CODES) is None
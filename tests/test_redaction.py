@@ -0,0 +1,33 @@
+"""
+Chunked redaction against the full mode and its time guard.
+
+    python -m pytest -q tests
+"""
+import re
+import time
+
+import pytest
+
+from utils.functions import RedactionTimeout, encrypt_text, encrypt_text_chunked, windowed_sub
+
+PAGE = (
+    "Señores BBVA Colombia. Yo, JUAN CARLOS PEREZ identificado con cédula 1.234.567 presento derecho de petición. "
+    "Mi celular es 315 123 4567 y mi correo juan.perez@gmail.com, vivo en la Calle 45 # 12-34 apto 301. "
+    "Atentamente, Juan Carlos Pérez de la Rosa\n"
+)
+# Expresión con retroceso exponencial sobre una racha de x sin y
+PATHOLOGICAL = re.compile(r"(x+x+)+y")
+
+
+@pytest.mark.parametrize("repeat", [1, 40])
+def test_chunked_page_matches_full_mode(repeat):
+    page = PAGE * repeat
+    assert encrypt_text_chunked(page) == encrypt_text(page)
+
+
+@pytest.mark.parametrize("length", [1000, 10000])
+def test_pathological_window_stops_at_its_budget(length):
+    start = time.monotonic()
+    with pytest.raises(RedactionTimeout):
+        windowed_sub(PATHOLOGICAL, "[X]", "x" * length, chunk_size=2000, overlap=300, budget=0.05)
+    assert time.monotonic() - start < 1
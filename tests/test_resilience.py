@@ -0,0 +1,121 @@
+"""
+resilient_call against a local fake gateway that injects delays and 429s.
+
+    python -m pytest -q tests
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from utils import resilience
+from utils.resilience import DeadlineExceeded, deadline, resilient_call
+
+
+class FakeGateway:
+    """
+    HTTP server on a thread that answers each request with the next
+    planned step: (status, delay in seconds, headers). Once the plan
+    runs out it answers 200 at once.
+    """
+
+    def __init__(self, plan: list[tuple[int, float, dict]]):
+        self.plan = list(plan)
+        self.requests = 0
+        self.lock = threading.Lock()
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with gateway.lock:
+                    gateway.requests += 1
+                    status, delay, headers = gateway.plan.pop(0) if gateway.plan else (200, 0, {})
+                time.sleep(delay)
+                body = str(status).encode()
+                try:
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    # El cliente ya se fue por su timeout
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/invoke"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self, timeout: float) -> requests.Response:
+        return requests.post(self.url, data=b"{}", timeout=timeout)
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, "GATEWAY_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(resilience, "GATEWAY_BACKOFF_MAX", 0.05)
+
+
+def test_retries_throttling_until_success():
+    with FakeGateway([(429, 0, {}), (503, 0, {}), (429, 0, {"Retry-After": "0.05"})]) as gateway:
+        response = resilient_call(gateway.send, hedge_after=0, model="test-retry")
+    assert response.status_code == 200
+    assert gateway.requests == 4
+
+
+def test_returns_last_response_when_retries_run_out():
+    with FakeGateway([(429, 0, {})] * 5) as gateway:
+        response = resilient_call(gateway.send, max_retries=2, hedge_after=0, model="test-exhausted")
+    assert response.status_code == 429
+    assert gateway.requests == 3
+
+
+def test_backoff_longer_than_deadline_returns_without_retrying(monkeypatch):
+    monkeypatch.setattr(resilience, "GATEWAY_BACKOFF_MAX", 20)
+    with FakeGateway([(429, 0, {"Retry-After": "5"})]) as gateway:
+        with deadline(0.5):
+            response = resilient_call(gateway.send, hedge_after=0, model="test-retry-after")
+    assert response.status_code == 429
+    assert gateway.requests == 1
+
+
+def test_deadline_expires_on_slow_gateway():
+    with FakeGateway([(200, 2, {})] * 3) as gateway:
+        start = time.monotonic()
+        with pytest.raises(DeadlineExceeded), deadline(0.3):
+            resilient_call(gateway.send, hedge_after=0, model="test-deadline")
+        elapsed = time.monotonic() - start
+    assert elapsed < 1.5
+
+
+def test_hedged_request_wins_over_slow_one():
+    with FakeGateway([(200, 2, {}), (200, 0, {})]) as gateway:
+        start = time.monotonic()
+        response = resilient_call(gateway.send, hedge_after=0.1, model="test-hedge")
+        elapsed = time.monotonic() - start
+    assert response.status_code == 200
+    assert gateway.requests == 2
+    assert elapsed < 1.5
+
+
+def test_no_hedging_for_non_idempotent_calls():
+    with FakeGateway([(200, 0.3, {})]) as gateway:
+        response = resilient_call(gateway.send, idempotent=False, hedge_after=0.05, model="test-no-hedge")
+    assert response.status_code == 200
+    assert gateway.requests == 1
@@ -0,0 +1,71 @@
+"""
+Single flight of get_or_compute on the memory stand-in and the local directory backend.
+
+    python -m pytest -q tests
+"""
+import threading
+import time
+
+import pytest
+
+from utils.shared_cache import LocalSharedCache, MemorySharedCache
+
+
+@pytest.fixture(params=["memory", "local"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        return MemorySharedCache(lock_timeout=10)
+    return LocalSharedCache(root=tmp_path, lock_timeout=10)
+
+
+def run_threads(targets: list) -> list:
+    results = [None] * len(targets)
+
+    def run(i):
+        results[i] = targets[i]()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(targets))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=20)
+    return results
+
+
+def test_concurrent_callers_compute_once(cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.3)
+        return b"artifacts"
+
+    key = "ab" * 32
+    results = run_threads([lambda: cache.get_or_compute(key, compute)] * 8)
+    assert results == [b"artifacts"] * 8
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] + stats["waits"] == 7
+
+
+def test_other_keys_do_not_wait_for_a_computation(cache):
+    started = threading.Event()
+    finish = threading.Event()
+
+    def slow():
+        started.set()
+        finish.wait(10)
+        return b"slow"
+
+    # Llaves con el mismo prefijo, antes compartían el lock del proceso
+    slow_thread = threading.Thread(target=cache.get_or_compute, args=("00000000" + "a" * 56, slow))
+    slow_thread.start()
+    assert started.wait(5)
+    start = time.monotonic()
+    value = cache.get_or_compute("00000000" + "b" * 56, lambda: b"fast")
+    elapsed = time.monotonic() - start
+    finish.set()
+    slow_thread.join(10)
+    assert value == b"fast"
+    assert elapsed < 1
@@ -1,7 +1,14 @@
+import inspect
 import logging
+import os
+import threading
+import time
 from typing import Annotated
 from typing_extensions import TypedDict
 
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_openai import ChatOpenAI
 
 from langgraph.checkpoint.memory import InMemorySaver
@@ -9,31 +16,226 @@ from langgraph.graph import StateGraph, START
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
 
+from utils.analysis import STRUCTURED_ANALYSIS, TypologyAnalysis, structured_analysis_message
+from utils.cancellation import check_cancelled
+from utils.logs import setup_logging
+from utils.profiling import profile_stage
+
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Etapas del grafo que se pueden enrutar a un modelo distinto
+STAGES = ("analysis", "followup", "tool_result")
+
+# Permite al modelo pedir varias herramientas en un mismo paso, si el proveedor lo soporta
+PARALLEL_TOOL_CALLS = os.getenv("PARALLEL_TOOL_CALLS", "true").lower() == "true"
+
+# Precio en USD por millón de tokens (entrada, salida) para estimar el costo por ruta
+MODEL_PRICES = {
+    "gpt-5": (1.25, 10.0),
+    "gpt-5-mini": (0.25, 2.0),
+    "gpt-5-nano": (0.05, 0.4),
+    "gemini-2.5-pro": (1.25, 10.0),
+    "gemini-2.5-flash": (0.3, 2.5),
+}
+
+
+class RouteMetrics:
+    """
+    Process-wide latency, token and cost counters per graph stage and
+    model, and model/tool call counters per conversation (thread).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._conversations = {}
+
+    def record(
+            self,
+            stage: str,
+            model: str,
+            latency: float,
+            usage: dict = None,
+            thread_id: str = None,
+            tool_calls: int = 0
+    ) -> None:
+        """
+        Add one model call to the counters of its route.
+
+        Args:
+            stage: graph stage that made the call
+            model: id of the model used
+            latency: seconds spent in the call
+            usage: usage_metadata of the AI message
+            thread_id: id of the conversation
+            tool_calls: number of tool calls requested in the message
+        """
+        usage = usage or {}
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        # Tokens de entrada servidos desde la cache de prompts del proveedor
+        cached_tokens = (usage.get("input_token_details") or {}).get("cache_read", 0)
+        input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+        with self._lock:
+            route = self._routes.setdefault((stage, model), {
+                "calls": 0, "latency": 0.0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost": 0.0
+            })
+            route["calls"] += 1
+            route["latency"] += latency
+            route["input_tokens"] += input_tokens
+            route["cached_tokens"] += cached_tokens
+            route["output_tokens"] += output_tokens
+            route["cost"] += cost
+            if thread_id is not None:
+                conversation = self._conversations.setdefault(thread_id, {"model_calls": 0, "tool_calls": 0})
+                conversation["model_calls"] += 1
+                conversation["tool_calls"] += tool_calls
+        logger.info(
+            f"Route {stage} -> {model}: {latency:.2f}s, {input_tokens} in ({cached_tokens} cached) / "
+            f"{output_tokens} out tokens, ${cost:.4f}",
+            extra={"stage": stage, "model": model, "duration_ms": round(latency * 1000, 1)}
+        )
+
+    def summary(self) -> dict:
+        """
+        Returns the counters per route with the average latency
+        and the prompt-cache hit ratio (cached / input tokens).
+        """
+        with self._lock:
+            return {
+                f"{stage}:{model}": {
+                    **route,
+                    "avg_latency": route["latency"] / route["calls"],
+                    "prompt_cache_hit_ratio": route["cached_tokens"] / route["input_tokens"] if route["input_tokens"] else 0.0
+                }
+                for (stage, model), route in self._routes.items()
+            }
+
+    def conversation_summary(self) -> dict:
+        """
+        Returns the number of conversations, the average model calls
+        and tool calls per conversation and the tool calls requested
+        per model step that used tools (above 1 means parallel calls).
+        """
+        with self._lock:
+            conversations = list(self._conversations.values())
+        n_conversations = len(conversations)
+        model_calls = sum(conversation["model_calls"] for conversation in conversations)
+        tool_calls = sum(conversation["tool_calls"] for conversation in conversations)
+        return {
+            "conversations": n_conversations,
+            "model_calls": model_calls,
+            "model_calls_per_conversation": model_calls / n_conversations if n_conversations else 0.0,
+            "tool_calls_per_conversation": tool_calls / n_conversations if n_conversations else 0.0
+        }
+
+
+route_metrics = RouteMetrics()
+
+
 class State(TypedDict):
     messages: Annotated[list, add_messages]
 
+
+# Función para identificar la etapa de la conversación
+def classify_stage(messages: list) -> str:
+    """
+    Classify the step the graph is about to run.
+    Returns "tool_result" when formatting a tool output, "analysis"
+    for the first turn of the thread or when the last human message
+    carries page images and "followup" otherwise.
+
+    Args:
+        messages: messages of the graph state
+    """
+    last = messages[-1]
+    if isinstance(last, ToolMessage):
+        return "tool_result"
+    if not any(isinstance(message, AIMessage) for message in messages):
+        return "analysis"
+    if isinstance(last, HumanMessage) and isinstance(last.content, list):
+        for block in last.content:
+            if isinstance(block, dict) and block.get("type") in ("image", "image_url"):
+                return "analysis"
+    return "followup"
+
+
+def model_name(llm: BaseChatModel) -> str:
+    return getattr(llm, "model_name", None) or getattr(llm, "model", "") or ""
+
+
+# Función para asociar las herramientas al modelo
+def bind_agent_tools(llm: BaseChatModel, tools: list, parallel_tool_calls: bool = PARALLEL_TOOL_CALLS):
+    """
+    Returns the model bound to the tools, with parallel tool calls
+    enabled when the provider exposes the option (OpenAI). Gemini
+    already returns parallel function calls without it.
+
+    Args:
+        llm: chat model
+        tools: tools available to the agent
+        parallel_tool_calls: allow several tool calls in one step
+    """
+    if "parallel_tool_calls" in inspect.signature(llm.bind_tools).parameters:
+        return llm.bind_tools(tools, parallel_tool_calls=parallel_tool_calls)
+    return llm.bind_tools(tools)
+
+
 def make_agent_graph(
         llm: ChatOpenAI,
         tools: list,
-        memory: InMemorySaver
+        memory: InMemorySaver,
+        routes: dict = None,
+        parallel_tool_calls: bool = PARALLEL_TOOL_CALLS,
+        structured_analysis: bool = STRUCTURED_ANALYSIS
 ) -> StateGraph: 
+    """
+    Build the agent graph. Each chatbot step is routed to the model
+    configured for its stage, falling back to llm.
 
+    Args:
+        llm: default model
+        tools: tools available to the agent
+        memory: checkpointer of the conversation
+        routes: optional dict of stage -> model (see STAGES)
+        parallel_tool_calls: allow several tool calls in one model step
+        structured_analysis: ask the analysis stage for a TypologyAnalysis
+            and render its markdown locally instead of generating it
+    """
+    routes = routes or {}
     builder = StateGraph(State)
-    llm_with_tools = llm.bind_tools(tools)
-    def chatbot(state: State):
-        return {"messages": [llm_with_tools.invoke(state["messages"])]}
+    llm_with_tools = bind_agent_tools(llm, tools, parallel_tool_calls)
+    routed_llms = {stage: bind_agent_tools(route_llm, tools, parallel_tool_calls) for stage, route_llm in routes.items()}
+    # El primer análisis no usa herramientas, el modelo solo llena el esquema
+    structured_llm = None
+    if structured_analysis:
+        structured_llm = routes.get("analysis", llm).with_structured_output(TypologyAnalysis, include_raw=True)
+    def chatbot(state: State, config: RunnableConfig):
+        stage = classify_stage(state["messages"])
+        check_cancelled("agent", skipped=1)
+        start = time.perf_counter()
+        with profile_stage(f"chatbot:{stage}"):
+            message = None
+            if structured_llm is not None and stage == "analysis":
+                try:
+                    message = structured_analysis_message(structured_llm, state["messages"])
+                except Exception as e:
+                    logger.error(f"Error in structured analysis: {e}")
+            # Sin análisis tipado válido el modelo escribe la respuesta completa
+            if message is None:
+                message = routed_llms.get(stage, llm_with_tools).invoke(state["messages"])
+        route_metrics.record(
+            stage=stage,
+            model=model_name(routes.get(stage, llm)),
+            latency=time.perf_counter() - start,
+            usage=getattr(message, "usage_metadata", None),
+            thread_id=config.get("configurable", {}).get("thread_id"),
+            tool_calls=len(getattr(message, "tool_calls", None) or [])
+        )
+        return {"messages": [message]}
     builder.add_node("chatbot", chatbot)
     tool_node = ToolNode(tools=tools)
     builder.add_node("tools", tool_node)
@@ -0,0 +1,136 @@
+import logging
+import os
+
+from langchain_core.messages import AIMessage
+from pydantic import BaseModel, Field
+
+from utils.dataframes import typo_data
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# El primer análisis se pide como datos tipados y el markdown se arma localmente
+STRUCTURED_ANALYSIS = os.getenv("STRUCTURED_ANALYSIS", "false").lower() == "true"
+# Llave del análisis tipado en el mensaje del agente
+ANALYSIS_KEY = "structured_analysis"
+
+
+class TypologyChoice(BaseModel):
+    """
+    Typology proposed for the case.
+    """
+    id: int = Field(description="Código de la tipología, tomado SOLO de la lista de tipologías")
+    justification: str = Field(
+        description="Justificación breve (una o dos frases) de por qué la tipología se ajusta a qué le pasó al cliente"
+    )
+
+
+class TypologyAnalysis(BaseModel):
+    """
+    First analysis of a PQRS document.
+    """
+    what_happened: str = Field(description="¿Qué le pasó al cliente?: problema, motivo o causa raíz, en pocas frases")
+    client_request: str = Field(description="¿Qué solicita el cliente?: lo que pide para resolver su caso, en pocas frases")
+    typologies: list[TypologyChoice] = Field(
+        description="Las 3 tipologías que mejor se ajustan a qué le pasó al cliente, de la más a la menos adecuada",
+        min_length=1,
+        max_length=3
+    )
+
+
+# Función para validar el análisis contra el catálogo
+def validate_analysis(analysis: TypologyAnalysis) -> dict:
+    """
+    Returns the analysis as a dict keeping only the typologies of the
+    catalog (without repetitions), None if none of them is valid.
+
+    Args:
+        analysis: analysis returned by the model
+    """
+    known = set(typo_data["id"].tolist())
+    typologies = []
+    for choice in analysis.typologies:
+        if choice.id in known and choice.id not in [typology["id"] for typology in typologies]:
+            typologies.append({"id": choice.id, "justification": choice.justification.strip()})
+        else:
+            logger.info(f"Typology {choice.id} dropped from the structured analysis")
+    if not typologies:
+        return None
+    return {
+        "what_happened": analysis.what_happened.strip(),
+        "client_request": analysis.client_request.strip(),
+        "typologies": typologies
+    }
+
+
+# Función para armar el markdown del análisis con el catálogo
+def render_analysis(analysis: dict, proposal: list[dict] = None) -> str:
+    """
+    Returns the markdown of the first analysis, as described in the
+    response guide of the prompt, with the names and descriptions
+    of the typologies taken from the catalog.
+
+    Args:
+        analysis: output of validate_analysis
+        proposal: predictions of the pre-classifier, to show their confidence
+    """
+    catalog = typo_data.set_index("id")
+    confidences = {prediction["id"]: prediction["confidence"] for prediction in proposal or []}
+    lines = [
+        f"* **¿Qué le pasó al cliente?**: {analysis['what_happened']}",
+        f"* **¿Qué solicita el cliente?**: {analysis['client_request']}",
+        "",
+        "##### Selección de tipologías propuestas"
+    ]
+    for i, typology in enumerate(analysis["typologies"], start=1):
+        code = typology["id"]
+        confidence = f" _(confianza {confidences[code]:.0%})_" if code in confidences else ""
+        lines.append(f"{i}. **{catalog.loc[code, 'typo']} ({code})**: {catalog.loc[code, 'desc']}{confidence}")
+        lines.append(f"    * **Justificación**: {typology['justification']}")
+    lines.append("")
+    lines.append(f"¿Con cuál de las {len(analysis['typologies'])} tipologías deseas clasificar el documento?")
+    return "\n".join(lines)
+
+
+# Función para pedir el primer análisis como datos tipados
+def structured_analysis_message(structured_llm, messages: list) -> AIMessage:
+    """
+    Call the model bound to the TypologyAnalysis schema and render the
+    answer locally.
+    Returns the AI message with the markdown as content and the typed
+    analysis in additional_kwargs, None if the answer is not valid
+    (the caller falls back to the free-form answer).
+
+    Args:
+        structured_llm: model.with_structured_output(TypologyAnalysis, include_raw=True)
+        messages: messages of the graph state
+    """
+    output = structured_llm.invoke(messages)
+    raw = output.get("raw")
+    if output.get("parsed") is None:
+        logger.error(f"Structured analysis not parsed: {output.get('parsing_error')}")
+        return None
+    analysis = validate_analysis(output["parsed"])
+    if analysis is None:
+        logger.error("Structured analysis without typologies of the catalog")
+        return None
+    return AIMessage(
+        content=render_analysis(analysis),
+        additional_kwargs={ANALYSIS_KEY: analysis},
+        usage_metadata=getattr(raw, "usage_metadata", None),
+        response_metadata=getattr(raw, "response_metadata", {}) or {}
+    )
+
+
+# Función para obtener el análisis tipado de un mensaje del agente
+def message_analysis(message) -> dict:
+    """
+    Returns the typed analysis carried by the message, None if it was
+    a free-form answer.
+
+    Args:
+        message: AI message of the agent
+    """
+    return (getattr(message, "additional_kwargs", None) or {}).get(ANALYSIS_KEY)
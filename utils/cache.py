@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+MAIN_PATH = Path(os.getcwd())
+DATA_PATH = MAIN_PATH / "data"
+CACHE_PATH = DATA_PATH / "cache"
+
+# Vigencia y tamaño máximo de la cache de análisis
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", 7 * 24 * 3600))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 500))
+
+
+# Función para obtener el hash de un texto o de una lista de textos
+def content_hash(*parts: str) -> str:
+    """
+    Hash several strings into a single sha256 digest.
+    Returns the hex digest.
+
+    Args:
+        parts: strings to hash in order
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Exact-match cache for the first analysis of a document.
+    Entries are keyed by the anonymized content hash, the prompt
+    version, the catalog version and the model id, and live in a
+    local SQLite store with TTL and LRU eviction by entry count.
+    """
+
+    def __init__(
+            self,
+            db_path: Path = CACHE_PATH / "analysis.sqlite",
+            ttl: int = ANALYSIS_CACHE_TTL,
+            max_entries: int = ANALYSIS_CACHE_MAX_ENTRIES
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analysis (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(content: str, prompt_version: str, catalog_version: str, model_id: str) -> str:
+        """
+        Build the cache key of an analysis.
+        Returns a sha256 hex digest.
+
+        Args:
+            content: hash of the anonymized pages
+            prompt_version: hash or version of the system prompt
+            catalog_version: hash or version of the typology catalog
+            model_id: id of the model used
+        """
+        return content_hash(content, prompt_version, catalog_version, model_id)
+
+    def get(self, key: str) -> dict:
+        """
+        Returns the cached payload or None if missing or expired.
+
+        Args:
+            key: cache key built with make_key
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, created_at FROM analysis WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM analysis WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                logger.info(f"Analysis cache miss ({self.hits} hits / {self.misses} misses)")
+                return None
+            self._conn.execute("UPDATE analysis SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        logger.info(f"Analysis cache hit ({self.hits} hits / {self.misses} misses)")
+        return json.loads(row[0])
+
+    def set(self, key: str, payload: dict) -> None:
+        """
+        Store a payload and evict expired and least recently used entries.
+
+        Args:
+            key: cache key built with make_key
+            payload: json serializable dict
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis (key, payload, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            self._conn.execute("DELETE FROM analysis WHERE created_at < ?", (now - self.ttl,))
+            self._conn.execute(
+                """
+                DELETE FROM analysis WHERE key IN (
+                    SELECT key FROM analysis ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,)
+            )
+            self._conn.commit()
+        logger.info("Analysis stored in cache")
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters, hit ratio and number of entries.
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "entries": entries
+        }
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+class Cancelled(BaseException):
+    """
+    Raised inside a job whose token was cancelled. It derives from
+    BaseException, like asyncio.CancelledError, so the generic
+    "except Exception" handlers of the pipeline do not swallow it.
+    """
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag of one job. The job checks it at
+    its cancellation points (each OCR page, each encoded page, each
+    gateway attempt and backoff) and stops with Cancelled.
+    """
+
+    def __init__(self, job: str = ""):
+        self.job = job
+        self.reason = ""
+        self.cancelled_at = None
+        self.recorded = False
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "superseded"):
+        if not self._event.is_set():
+            self.reason = reason
+            self.cancelled_at = time.monotonic()
+            self._event.set()
+
+    def wait(self, seconds: float) -> bool:
+        """
+        Sleep up to seconds, waking up as soon as the token is cancelled.
+        Returns True if it was cancelled.
+        """
+        return self._event.wait(seconds)
+
+
+class CancellationMetrics:
+    """
+    Process-wide counters of the cancelled jobs and of the work they
+    did not do (OCR pages, encoded pages and gateway calls), with the
+    time each job took to stop after being cancelled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.saved = {}
+        self.stop_latency = 0.0
+        self.max_stop_latency = 0.0
+
+    def record(self, stage: str, skipped: int, latency: float):
+        with self._lock:
+            self.jobs += 1
+            self.saved[stage] = self.saved.get(stage, 0) + skipped
+            self.stop_latency += latency
+            self.max_stop_latency = max(self.max_stop_latency, latency)
+        logger.info(
+            f"Job cancelled at {stage} after {latency:.2f}s, {skipped} units of work skipped",
+            extra={"stage": stage, "duration_ms": round(latency * 1000, 1)}
+        )
+
+    def summary(self) -> dict:
+        """
+        Returns the cancelled jobs, the work skipped per stage and the
+        average and maximum seconds from cancel to stop.
+        """
+        with self._lock:
+            return {
+                "jobs_cancelled": self.jobs,
+                "work_skipped": dict(self.saved),
+                "avg_stop_latency": self.stop_latency / self.jobs if self.jobs else 0.0,
+                "max_stop_latency": self.max_stop_latency
+            }
+
+
+cancellation_metrics = CancellationMetrics()
+
+# Token del trabajo en curso, se propaga a los hilos que copian el contexto
+current_token = ContextVar("current_token", default=None)
+
+_jobs_lock = threading.Lock()
+_jobs = {}
+
+
+# Función para detener el trabajo en curso si fue cancelado
+def check_cancelled(stage: str = "", skipped: int = 0):
+    """
+    Raise Cancelled if the token of the current job was cancelled.
+
+    Args:
+        stage: cancellation point, for the metrics
+        skipped: units of work left undone at this point (pages, calls...)
+    """
+    token = current_token.get()
+    if token is None or not token.cancelled:
+        return
+    # Solo el primer punto que lo detecta cuenta el trabajo ahorrado
+    if not token.recorded:
+        token.recorded = True
+        cancellation_metrics.record(stage, skipped, time.monotonic() - token.cancelled_at)
+    raise Cancelled(token.reason)
+
+
+# Contexto para un trabajo que reemplaza al anterior de la misma llave
+@contextmanager
+def cancellable(key: str, job: str = ""):
+    """
+    Run the block as the current job of key (e.g. the analyst
+    session). Starting it cancels the previous job of the same key,
+    which stops at its next cancellation point.
+
+    Args:
+        key: owner of the job
+        job: name of the job, for the logs
+    """
+    token = CancellationToken(job)
+    with _jobs_lock:
+        previous = _jobs.get(key)
+        _jobs[key] = token
+    if previous is not None and not previous.cancelled:
+        logger.info(f"Cancelling superseded job {previous.job or '-'}")
+        previous.cancel("superseded")
+    context_token = current_token.set(token)
+    try:
+        yield token
+    finally:
+        current_token.reset(context_token)
+        with _jobs_lock:
+            if _jobs.get(key) is token:
+                del _jobs[key]
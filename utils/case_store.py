@@ -0,0 +1,254 @@
+"""
+Index of the case artifacts persisted on disk.
+
+    python -m utils.case_store --compact
+    python -m utils.case_store --stats
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from utils.cache import CACHE_PATH, content_hash
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+MAIN_PATH = Path(os.getcwd())
+DATA_PATH = MAIN_PATH / "data"
+CASES_PATH = DATA_PATH / "cases"
+
+# Vigencia de un caso sin accesos y cuota de disco de todos los casos
+CASE_STORE_TTL = int(os.getenv("CASE_STORE_TTL", 7 * 24 * 3600))
+CASE_STORE_QUOTA_MB = float(os.getenv("CASE_STORE_QUOTA_MB", 2048))
+# Los directorios sin indexar más nuevos que este margen pueden ser de un caso que se está escribiendo
+CASE_STORE_ORPHAN_GRACE = int(os.getenv("CASE_STORE_ORPHAN_GRACE", 3600))
+
+
+class CaseStore:
+    """
+    SQLite index of the cases persisted under root: one row per
+    case (hash, directory, last access) and one per artifact (name,
+    path, size). Artifact lookups are primary key queries instead
+    of filesystem checks. Cases idle for longer than ttl are removed
+    and the least recently used are evicted while the total size
+    is above the quota.
+    """
+
+    def __init__(
+            self,
+            root: Path = CASES_PATH,
+            db_path: Path = CACHE_PATH / "cases.sqlite",
+            ttl: int = CASE_STORE_TTL,
+            quota_bytes: int = int(CASE_STORE_QUOTA_MB * 1024 * 1024),
+            orphan_grace: int = CASE_STORE_ORPHAN_GRACE
+    ):
+        self.root = Path(root)
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.quota_bytes = quota_bytes
+        self.orphan_grace = orphan_grace
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS cases (
+                case_hash TEXT PRIMARY KEY,
+                case_dir TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS artifacts (
+                case_hash TEXT NOT NULL,
+                name TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (case_hash, name)
+            );
+            CREATE INDEX IF NOT EXISTS cases_last_access ON cases (last_access);
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(session_id: str, case_name: str) -> str:
+        """
+        Returns the hash of a case of a session.
+
+        Args:
+            session_id: id of the analyst session
+            case_name: name of the case
+        """
+        return content_hash(session_id, case_name)
+
+    def put(self, case_hash: str, case_dir: Path, name: str, path: Path) -> None:
+        """
+        Index an artifact already written to disk and enforce the
+        TTL and quota.
+
+        Args:
+            case_hash: hash of the case
+            case_dir: directory of the case
+            name: name of the artifact
+            path: local path of the artifact
+        """
+        now = time.time()
+        size = os.path.getsize(path)
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO cases (case_hash, case_dir, created_at, last_access) VALUES (?, ?, ?, ?)
+                ON CONFLICT (case_hash) DO UPDATE SET last_access = excluded.last_access
+                """,
+                (case_hash, str(case_dir), now, now)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO artifacts (case_hash, name, path, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                (case_hash, name, str(path), size, now)
+            )
+            self._conn.commit()
+        self.evict()
+
+    def get(self, case_hash: str, name: str) -> Path:
+        """
+        Returns the path of an artifact and refreshes the last access
+        of its case, None if it is not indexed.
+
+        Args:
+            case_hash: hash of the case
+            name: name of the artifact
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path FROM artifacts WHERE case_hash = ? AND name = ?", (case_hash, name)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE cases SET last_access = ? WHERE case_hash = ?", (time.time(), case_hash))
+            self._conn.commit()
+        return Path(row[0])
+
+    def _remove(self, case_hash: str, case_dir: str) -> None:
+        shutil.rmtree(case_dir, ignore_errors=True)
+        self._conn.execute("DELETE FROM artifacts WHERE case_hash = ?", (case_hash,))
+        self._conn.execute("DELETE FROM cases WHERE case_hash = ?", (case_hash,))
+
+    def evict(self) -> dict:
+        """
+        Remove the cases idle for longer than the TTL and then the
+        least recently used ones until the total size fits the quota.
+        Returns the number of removed cases and freed bytes.
+        """
+        removed = freed = 0
+        with self._lock:
+            expired = self._conn.execute(
+                """
+                SELECT c.case_hash, c.case_dir, COALESCE(SUM(a.size), 0) FROM cases c
+                LEFT JOIN artifacts a ON a.case_hash = c.case_hash
+                WHERE c.last_access < ? GROUP BY c.case_hash
+                """,
+                (time.time() - self.ttl,)
+            ).fetchall()
+            for case_hash, case_dir, size in expired:
+                self._remove(case_hash, case_dir)
+                removed += 1
+                freed += size
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+            if total > self.quota_bytes:
+                cases = self._conn.execute(
+                    """
+                    SELECT c.case_hash, c.case_dir, COALESCE(SUM(a.size), 0) FROM cases c
+                    LEFT JOIN artifacts a ON a.case_hash = c.case_hash
+                    GROUP BY c.case_hash ORDER BY c.last_access ASC
+                    """
+                ).fetchall()
+                for case_hash, case_dir, size in cases:
+                    if total <= self.quota_bytes:
+                        break
+                    self._remove(case_hash, case_dir)
+                    removed += 1
+                    freed += size
+                    total -= size
+            self._conn.commit()
+        if removed:
+            logger.info(f"Case store evicted {removed} cases, {freed} bytes freed")
+        return {"removed": removed, "freed_bytes": freed}
+
+    def compact(self) -> dict:
+        """
+        Evict expired and over-quota cases, drop index rows whose
+        files no longer exist, delete case directories that are not
+        indexed and vacuum the database. Directories modified within
+        orphan_grace are kept: a session may have just created them
+        and not indexed its files yet.
+        Returns a report of the compaction.
+        """
+        report = self.evict()
+        missing = orphans = 0
+        with self._lock:
+            for case_hash, name, path in self._conn.execute("SELECT case_hash, name, path FROM artifacts").fetchall():
+                if not os.path.exists(path):
+                    self._conn.execute("DELETE FROM artifacts WHERE case_hash = ? AND name = ?", (case_hash, name))
+                    missing += 1
+            self._conn.execute("DELETE FROM cases WHERE case_hash NOT IN (SELECT case_hash FROM artifacts)")
+            indexed = {Path(row[0]).resolve() for row in self._conn.execute("SELECT case_dir FROM cases")}
+            # Directorios de casos (raíz/sesión/caso) que nadie indexó
+            cutoff = time.time() - self.orphan_grace
+            if self.root.exists():
+                for session_dir in [path for path in self.root.iterdir() if path.is_dir()]:
+                    for case_dir in [path for path in session_dir.iterdir() if path.is_dir()]:
+                        if case_dir.resolve() not in indexed and case_dir.stat().st_mtime < cutoff:
+                            shutil.rmtree(case_dir, ignore_errors=True)
+                            orphans += 1
+                    try:
+                        if session_dir.stat().st_mtime < cutoff and not any(session_dir.iterdir()):
+                            session_dir.rmdir()
+                    except OSError:
+                        # Otra sesión acaba de crear un caso en el directorio
+                        pass
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+        report.update({"missing_rows": missing, "orphan_dirs": orphans})
+        logger.info(f"Case store compacted: {report}")
+        return report
+
+    def stats(self) -> dict:
+        """
+        Returns the number of cases and artifacts, the disk usage and the quota.
+        """
+        with self._lock:
+            cases = self._conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+            artifacts, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts").fetchone()
+        return {
+            "cases": cases,
+            "artifacts": artifacts,
+            "bytes": size,
+            "quota_bytes": self.quota_bytes,
+            "usage": size / self.quota_bytes if self.quota_bytes else 0.0
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--compact", action="store_true", help="Evict, remove orphans and vacuum the index")
+    parser.add_argument("--stats", action="store_true", help="Print the usage of the store")
+    args = parser.parse_args()
+
+    store = CaseStore()
+    if args.compact:
+        print(json.dumps(store.compact(), indent=2))
+    if args.stats or not args.compact:
+        print(json.dumps(store.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
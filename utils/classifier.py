@@ -0,0 +1,251 @@
+import logging
+import math
+import os
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.dataframes import typo_data, subtypo_data, concept_data
+from utils.functions import remove_accents
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+MAIN_PATH = Path(os.getcwd())
+DB_PATH = MAIN_PATH / "data" / "db"
+# Histórico etiquetado opcional con columnas texto y tipologia_id
+HISTORY_PATH = DB_PATH / "historico_pqrs.csv"
+# El clasificador local viene desactivado: en benchmarks/classifier.py (n=31) el top 1 acierta 22.6%
+# y la precisión sobre el umbral no pasa de 29% con ningún umbral, se activa con un histórico etiquetado
+PRECLASSIFY = os.getenv("PRECLASSIFY", "false").lower() == "true"
+# Confianza mínima del top 1 para mostrar la propuesta sin pedirle al LLM que elija
+PRECLASSIFY_THRESHOLD = float(os.getenv("PRECLASSIFY_THRESHOLD", 0.6))
+
+STOPWORDS = set("""
+a al algo ante con contra cual cuando de del desde donde durante e el ella ellas ellos en entre era es esa ese eso esta
+este esto fue ha hay la las le les lo los mas me mi muy no nos o para pero por que se sea segun ser si sin sobre su sus
+tambien te tiene todo tu un una uno unos y ya yo cliente clientes banco bbva solicitud caso
+""".split())
+
+
+# Función para obtener los términos de un texto
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercase, remove accents and stopwords.
+    Returns the words and bigrams of the text.
+
+    Args:
+        text: text to tokenize
+    """
+    words = [w for w in re.findall(r"[a-zñ]{3,}", remove_accents(str(text).lower())) if w not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class TypologyClassifier:
+    """
+    TF-IDF nearest-centroid classifier over the typology catalog.
+    Confidences are a softmax of the cosine similarities with a
+    temperature calibrated on labeled examples.
+    """
+
+    def __init__(self, temperature: float = 0.05):
+        self.temperature = temperature
+        self.vocabulary = {}
+        self.idf = None
+        self.centroids = None
+        self.labels = []
+
+    def _vectorize(self, texts: list[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term, count in Counter(tokenize(text)).items():
+                column = self.vocabulary.get(term)
+                if column is not None:
+                    matrix[row, column] = 1 + math.log(count)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def fit(self, texts: list[str], labels: list[int]) -> "TypologyClassifier":
+        """
+        Fit the vocabulary, idf weights and one centroid per typology.
+        Returns the fitted classifier.
+
+        Args:
+            texts: training texts
+            labels: typology id of each text
+        """
+        documents = [set(tokenize(text)) for text in texts]
+        frequency = Counter(term for document in documents for term in document)
+        self.vocabulary = {term: i for i, term in enumerate(sorted(frequency))}
+        n_docs = len(documents)
+        self.idf = np.array(
+            [math.log((1 + n_docs) / (1 + frequency[term])) + 1 for term in sorted(frequency)], dtype=np.float32
+        )
+        vectors = self._vectorize(texts)
+        self.labels = sorted(set(labels))
+        index = {label: i for i, label in enumerate(self.labels)}
+        centroids = np.zeros((len(self.labels), vectors.shape[1]), dtype=np.float32)
+        for vector, label in zip(vectors, labels):
+            centroids[index[label]] += vector
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        self.centroids = centroids / np.where(norms == 0, 1, norms)
+        logger.info(f"Classifier fitted with {n_docs} texts, {len(self.labels)} typologies and {len(self.vocabulary)} terms")
+        return self
+
+    def similarities(self, texts: list[str]) -> np.ndarray:
+        """
+        Returns the cosine similarity of each text with each typology.
+
+        Args:
+            texts: texts to classify
+        """
+        return self._vectorize(texts) @ self.centroids.T
+
+    def _softmax(self, similarities: np.ndarray, temperature: float) -> np.ndarray:
+        scores = similarities / temperature
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def calibrate(self, texts: list[str], labels: list[int]) -> float:
+        """
+        Pick the softmax temperature that minimizes the negative
+        log-likelihood of the labeled examples.
+        Returns the chosen temperature.
+
+        Args:
+            texts: labeled texts not used to fit the centroids
+            labels: typology id of each text
+        """
+        index = {label: i for i, label in enumerate(self.labels)}
+        pairs = [(text, index[label]) for text, label in zip(texts, labels) if label in index]
+        if not pairs:
+            return self.temperature
+        similarities = self.similarities([text for text, _ in pairs])
+        targets = np.array([target for _, target in pairs])
+        best = None
+        for temperature in np.geomspace(0.005, 1.0, 40):
+            probabilities = self._softmax(similarities, temperature)
+            nll = -np.mean(np.log(probabilities[np.arange(len(targets)), targets] + 1e-12))
+            if best is None or nll < best[0]:
+                best = (nll, float(temperature))
+        self.temperature = best[1]
+        logger.info(f"Classifier calibrated on {len(pairs)} examples, temperature {self.temperature:.4f}")
+        return self.temperature
+
+    def predict(self, text: str, k: int = 3) -> list[dict]:
+        """
+        Returns the top k typologies with their calibrated confidence.
+
+        Args:
+            text: anonymized text of the document
+            k: number of typologies to return
+        """
+        probabilities = self._softmax(self.similarities([text]), self.temperature)[0]
+        top = np.argsort(probabilities)[::-1][:k]
+        return [{"id": self.labels[i], "confidence": float(probabilities[i])} for i in top]
+
+
+# Función para armar los textos de entrenamiento desde el catálogo
+def catalog_examples(include_details: bool = True) -> tuple[list[str], list[int]]:
+    """
+    Returns texts and typology ids from the catalog: name and
+    description of each typology and, optionally, its subtypology
+    and third-party concept descriptions.
+
+    Args:
+        include_details: add subtypology and concept descriptions
+    """
+    texts = (typo_data["typo"] + ". " + typo_data["desc"]).tolist()
+    labels = typo_data["id"].tolist()
+    if include_details:
+        texts += (subtypo_data["subtypo"] + ". " + subtypo_data["desc"]).tolist()
+        labels += subtypo_data["id"].tolist()
+        concepts = concept_data[(concept_data["id"] > 0) & (concept_data["casu"] != "No disponible")]
+        texts += concepts["casu"].tolist()
+        labels += concepts["id"].tolist()
+    return texts, labels
+
+
+# Función para leer el histórico etiquetado
+def history_examples(path: Path = HISTORY_PATH) -> tuple[list[str], list[int]]:
+    """
+    Returns texts and typology ids from the labeled history,
+    empty lists if the file does not exist.
+
+    Args:
+        path: csv with columns texto and tipologia_id
+    """
+    if not os.path.exists(path):
+        return [], []
+    history = pd.read_csv(path, dtype={"texto": str}).dropna(subset=["texto", "tipologia_id"])
+    return history["texto"].tolist(), history["tipologia_id"].astype(int).tolist()
+
+
+# Función para entrenar el clasificador con el catálogo y el histórico
+def train_classifier(history_path: Path = HISTORY_PATH) -> TypologyClassifier:
+    """
+    Fit the classifier with the catalog and the labeled history and
+    calibrate it. Without history, it is calibrated on the subtypology
+    and concept descriptions held out from the catalog.
+    Returns the fitted classifier.
+
+    Args:
+        history_path: csv with columns texto and tipologia_id
+    """
+    history_texts, history_labels = history_examples(history_path)
+    if history_texts:
+        texts, labels = catalog_examples()
+        classifier = TypologyClassifier().fit(texts, labels)
+        classifier.calibrate(history_texts, history_labels)
+        return classifier.fit(texts + history_texts, labels + history_labels)
+    base_texts, base_labels = catalog_examples(include_details=False)
+    all_texts, all_labels = catalog_examples()
+    classifier = TypologyClassifier().fit(base_texts, base_labels)
+    classifier.calibrate(all_texts[len(base_texts):], all_labels[len(base_labels):])
+    return classifier.fit(all_texts, all_labels)
+
+
+# Función para mostrar la propuesta sin esperar al LLM
+def render_proposal(predictions: list[dict]) -> str:
+    """
+    Returns the markdown list of the proposed typologies.
+
+    Args:
+        predictions: output of TypologyClassifier.predict
+    """
+    catalog = typo_data.set_index("id")
+    lines = ["##### Selección de tipologías propuestas"]
+    for i, prediction in enumerate(predictions, start=1):
+        typology = catalog.loc[prediction["id"]]
+        lines.append(f"{i}. **{typology['typo']} ({prediction['id']})**: {typology['desc']} _(confianza {prediction['confidence']:.0%})_")
+    return "\n".join(lines)
+
+
+# Función para pedirle al LLM solo la justificación
+def justification_prompt(predictions: list[dict]) -> str:
+    """
+    Returns the first-turn instruction when the typologies are
+    already proposed by the classifier.
+
+    Args:
+        predictions: output of TypologyClassifier.predict
+    """
+    catalog = typo_data.set_index("id")
+    proposed = "\n".join(
+        f"{i}. {catalog.loc[prediction['id'], 'typo']} ({prediction['id']})"
+        for i, prediction in enumerate(predictions, start=1)
+    )
+    return (
+        "Analiza este documento. Las tipologías propuestas ya fueron seleccionadas y se le muestran al analista:\n"
+        f"{proposed}\n"
+        "No repitas la lista ni las descripciones. Entrega únicamente ¿Qué le pasó al cliente?, "
+        "¿Qué solicita el cliente? y una justificación breve de cada tipología en el mismo orden. "
+        "Termina preguntando con cuál de las 3 tipologías desea clasificar el documento."
+    )
@@ -5,16 +5,10 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
+from utils.logs import setup_logging
+
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -40,6 +34,8 @@ typo_data["id"] = typo_data["id"].astype(int)
 typo_data = typo_data.dropna(subset=["typo", "desc"], how="any")
 typo_data["typo"] = typo_data["typo"].str.upper().str.strip()
 typo_data["data"] = typo_data["id"].astype(str) + ". **" + typo_data["typo"] + "**: " + typo_data["desc"]
+# Lista de tipologías para el prompt, se construye una sola vez por proceso
+typo_list = "\n".join(typo_data["data"].tolist())
 
 
 # Tabla de subtipologias --------------------------------------------------------------------------------
@@ -1,32 +1,82 @@
+import hashlib
 import io
+import json
+import os
 import re
+import threading
+import time
 import unicodedata
-from functools import partial
+from abc import ABC, abstractmethod
+from difflib import SequenceMatcher
+from functools import lru_cache, partial
 import logging
 from pathlib import Path
+from typing import Iterator
 
 import base64
 import cv2
 import numpy as np
 import pytesseract
-from fpdf import FPDF
-from pdf2image import convert_from_path
-from PIL import Image
+# Motor de expresiones compatible con re que acepta un límite de tiempo por llamada
+import regex as bounded_re
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+from PIL import Image, ImageDraw
 import fitz
 
+from utils.cancellation import check_cancelled
+from utils.logs import setup_logging, timed_stage
+from utils.ocr_cache import PageOCRCache
+from utils.pipeline import PagePipeline, Stage
+from utils.profiling import profile_stage
+from utils.rendering import new_pdf, write_image, write_text
+from utils.vision import (
+    VISION_RENDER_DPI, VISION_REPORT_BYTES, assemble_vision_payload, new_report, optimize_vision_payload,
+    render_vision_page
+)
 
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Umbrales para decidir si una página se envía como texto o como imagen
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", 75))
+OCR_LOW_CONF_WORD = float(os.getenv("OCR_LOW_CONF_WORD", 50))
+OCR_MAX_LOW_CONF_RATIO = float(os.getenv("OCR_MAX_LOW_CONF_RATIO", 0.35))
+TABLE_LINE_RATIO = float(os.getenv("TABLE_LINE_RATIO", 0.015))
+# Las páginas débiles se envían como la imagen de su página en el pdf anonimizado
+# Si es verdadero esa página es la imagen de origen con las palabras anonimizadas tapadas; solo se tapa
+# lo que leyó el OCR (manuscritos, firmas y sellos quedan visibles), así que debe activarse explícitamente
+WEAK_PAGE_RASTER = os.getenv("WEAK_PAGE_RASTER", "false").lower() == "true"
+REDACTION_MASK_PADDING = int(os.getenv("REDACTION_MASK_PADDING", 4))
+PAGE_RASTER_DPI = 200
+# Modo de anonimización: "full" (las expresiones de encrypt_text) o "chunked" (por ventanas, cada llamada
+# con el tiempo que queda de REDACTION_CHUNK_BUDGET). Los anonimizadores aplican el modo página por página
+# y ahí los dos dan el mismo texto; sobre un texto de varias páginas "full" además une datos a través
+# de los separadores de página, ver benchmarks/redaction.py
+REDACTION_MODE = os.getenv("REDACTION_MODE", "full")
+REDACTION_CHUNK_SIZE = int(os.getenv("REDACTION_CHUNK_SIZE", 2000))
+REDACTION_CHUNK_OVERLAP = int(os.getenv("REDACTION_CHUNK_OVERLAP", 300))
+REDACTION_CHUNK_BUDGET = float(os.getenv("REDACTION_CHUNK_BUDGET", 0.5))
+# Motor de anonimización: "regex" (expresiones de encrypt_text) o "presidio" (NER de spaCy + las mismas expresiones)
+ANONYMIZER = os.getenv("ANONYMIZER", "regex")
+PRESIDIO_SPACY_MODEL = os.getenv("PRESIDIO_SPACY_MODEL", "es_core_news_md")
+PRESIDIO_BATCH_SIZE = int(os.getenv("PRESIDIO_BATCH_SIZE", 16))
+PRESIDIO_MIN_SCORE = float(os.getenv("PRESIDIO_MIN_SCORE", 0.4))
+PAGE_SEPARATOR = re.compile(r"\n*--- Página (\d+)---\n*")
+# Huella perceptual de las páginas: dHash de PAGE_HASH_SIZE x PAGE_HASH_SIZE bits
+# Las páginas con distancia de Hamming menor o igual a PAGE_DUPLICATE_DISTANCE son candidatas
+# y se confirman con la correlación de sus miniaturas para no unir páginas de texto distintas
+PAGE_HASH_SIZE = int(os.getenv("PAGE_HASH_SIZE", 16))
+PAGE_DUPLICATE_DISTANCE = int(os.getenv("PAGE_DUPLICATE_DISTANCE", 10))
+PAGE_DUPLICATE_MIN_CORRELATION = float(os.getenv("PAGE_DUPLICATE_MIN_CORRELATION", 0.985))
+PAGE_THUMBNAIL_WIDTH = 128
+# Procesamiento por páginas en etapas solapadas: rasterizar -> OCR -> anonimizar -> codificar
+PAGE_PIPELINE = os.getenv("PAGE_PIPELINE", "true").lower() == "true"
+PIPELINE_RASTER_CHUNK = int(os.getenv("PIPELINE_RASTER_CHUNK", 2))
+PIPELINE_OCR_WORKERS = int(os.getenv("PIPELINE_OCR_WORKERS", min(4, os.cpu_count() or 1)))
+PIPELINE_REDACT_BATCH = int(os.getenv("PIPELINE_REDACT_BATCH", 8))
+PIPELINE_ENCODE_WORKERS = int(os.getenv("PIPELINE_ENCODE_WORKERS", 2))
+
 
 # Función para remover acentos
 def remove_accents(text: str) -> str:
@@ -56,6 +106,453 @@ def process_image(image: Image) -> Image:
     return Image.fromarray(binary)
 
 
+# Función para medir qué tanto de la página son líneas de tabla
+def table_score(binary: Image) -> float:
+    """
+    Detect long horizontal and vertical ruling lines.
+    Returns the fraction of the page covered by table lines.
+
+    Args:
+        binary: Binarized page image
+    """
+    inverted = 255 - np.array(binary)
+    height, width = inverted.shape
+    horizontal = cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 30, 1), 1))
+    vertical = cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(height // 30, 1)))
+    lines = cv2.bitwise_or(
+        cv2.morphologyEx(inverted, cv2.MORPH_OPEN, horizontal),
+        cv2.morphologyEx(inverted, cv2.MORPH_OPEN, vertical)
+    )
+    return float(np.count_nonzero(lines) / lines.size)
+
+
+# Función que extrae el texto y la confianza del OCR de una página
+def ocr_page(processed: Image) -> dict:
+    """
+    Run word-level OCR on a processed page.
+    Returns a dict with the page text, the word boxes
+    ([word, left, top, width, height, confidence]), the mean word
+    confidence and the ratio of low-confidence words.
+
+    Args:
+        processed: Binarized page image
+    """
+    data = pytesseract.image_to_data(
+        processed, lang="spa", config="--psm 6", output_type=pytesseract.Output.DICT
+    )
+    lines = {}
+    confidences = []
+    words = []
+    for i, word in enumerate(data["text"]):
+        conf = float(data["conf"][i])
+        if conf < 0 or not word.strip():
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+        confidences.append(conf)
+        words.append([word, int(data["left"][i]), int(data["top"][i]), int(data["width"][i]), int(data["height"][i]), conf])
+    text = ""
+    previous = None
+    for key, line_words in lines.items():
+        if previous is not None:
+            # Salto de párrafo cuando cambia el bloque o el párrafo
+            text += "\n\n" if key[:2] != previous[:2] else "\n"
+        text += " ".join(line_words)
+        previous = key
+    return {
+        "text": text,
+        "words": words,
+        "confidence": float(np.mean(confidences)) if confidences else 0.0,
+        "low_conf_ratio": float(np.mean([c < OCR_LOW_CONF_WORD for c in confidences])) if confidences else 1.0
+    }
+
+
+# Función para obtener la huella de una página renderizada
+def page_fingerprint(image: Image) -> dict:
+    """
+    Compute a perceptual difference hash (dHash) and a normalized
+    thumbnail of the page to find repeated pages across attachments,
+    and an exact digest of the raster to find unchanged pages
+    across uploads.
+    Returns a dict with the hex phash, the thumbnail and the sha256 digest.
+
+    Args:
+        image: Rendered page image
+    """
+    gray = np.array(image.convert("L"))
+    small = cv2.resize(gray, (PAGE_HASH_SIZE + 1, PAGE_HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    phash = int("".join("1" if bit else "0" for bit in bits), 2)
+    height = max(round(gray.shape[0] * PAGE_THUMBNAIL_WIDTH / gray.shape[1]), 1)
+    thumbnail = cv2.resize(gray, (PAGE_THUMBNAIL_WIDTH, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+    thumbnail -= thumbnail.mean()
+    thumbnail /= np.linalg.norm(thumbnail) or 1.0
+    return {
+        "phash": f"{phash:0{PAGE_HASH_SIZE * PAGE_HASH_SIZE // 4}x}",
+        "thumbnail": thumbnail,
+        "digest": hashlib.sha256(gray.tobytes()).hexdigest()
+    }
+
+
+# Función para medir la distancia entre dos huellas perceptuales
+def hash_distance(phash_a: str, phash_b: str) -> int:
+    return bin(int(phash_a, 16) ^ int(phash_b, 16)).count("1")
+
+
+# Función para buscar si una página ya apareció en el caso
+def find_duplicate(
+        fingerprint: dict,
+        pages: list[dict],
+        max_distance: int = PAGE_DUPLICATE_DISTANCE,
+        min_correlation: float = PAGE_DUPLICATE_MIN_CORRELATION
+) -> dict:
+    """
+    Returns the first non-duplicate page with the same raster, or
+    whose phash is within max_distance and whose thumbnail
+    correlation is at least min_correlation. None if the page is new.
+
+    Args:
+        fingerprint: output of page_fingerprint
+        pages: pages already processed in the case
+        max_distance: maximum Hamming distance between phashes
+        min_correlation: minimum correlation between thumbnails
+    """
+    for page in pages:
+        if page.get("duplicate_of"):
+            continue
+        if page["digest"] == fingerprint["digest"]:
+            return page
+        if (
+            hash_distance(page["phash"], fingerprint["phash"]) <= max_distance
+            and page["thumbnail"].shape == fingerprint["thumbnail"].shape
+            and float((page["thumbnail"] * fingerprint["thumbnail"]).sum()) >= min_correlation
+        ):
+            return page
+    return None
+
+
+# Función para hacer el OCR de una página rasterizada
+def read_page(page: Image) -> dict:
+    """
+    Returns the OCR result of the page: text without accents, word
+    boxes, confidence, low confidence ratio and table score.
+
+    Args:
+        page: rasterized page
+    """
+    processed = process_image(page)
+    result = ocr_page(processed)
+    result["text"] = remove_accents(result["text"].strip())
+    result["table_score"] = table_score(processed)
+    return result
+
+
+# Función para decidir si una página se envía como imagen
+def is_weak(result: dict) -> bool:
+    # Páginas con OCR débil, manuscritas o con tablas se envían como imagen
+    return bool(
+        result["confidence"] < OCR_MIN_CONFIDENCE
+        or result["low_conf_ratio"] > OCR_MAX_LOW_CONF_RATIO
+        or result["table_score"] > TABLE_LINE_RATIO
+    )
+
+
+# Función para leer documentos desde disco en el formato del pipeline en memoria
+def read_documents(doc_paths: list[Path]) -> list[tuple[str, bytes]]:
+    """
+    Returns a list of (file name, file bytes) for each document.
+
+    Args:
+        doc_paths: Local paths of the documents
+    """
+    documents = []
+    for doc_path in doc_paths:
+        with open(doc_path, "rb") as f:
+            documents.append((Path(doc_path).name, f.read()))
+    return documents
+
+
+# Función para rasterizar las páginas de un caso y reconocer las repetidas o ya procesadas
+def rasterize_pages(
+        documents: list[tuple[str, bytes]],
+        poppler_path: Path,
+        page_index: dict = None,
+        chunk: int = PIPELINE_RASTER_CHUNK
+) -> Iterator[dict]:
+    """
+    Rasterize the documents of a case a few pages at a time and
+    fingerprint each page. Pages repeated in the case get
+    duplicate_of and no text, pages found in page_index (from a
+    previous upload) get their anonymized text with redacted set;
+    only the new pages keep their image for the OCR. Reused weak pages
+    keep a copy of their raster to be masked again.
+    Yields a dict with the page and its image (None if it is not OCR'd)
+    for each page, in the order of the case.
+
+    Args:
+        documents: (file name, file bytes) of each document of the case
+        poppler_path: Local path of Poppler
+        page_index: Optional dict of page digest -> processed page
+        chunk: Pages rasterized per call to Poppler
+    """
+    page_index = page_index or {}
+    seen = []
+    for file_name, data in documents:
+        logger.info(f"Document: {file_name}")
+        # Se rasteriza desde memoria sin escribir el documento en disco
+        n_pages = pdfinfo_from_bytes(data, poppler_path=poppler_path)["Pages"]
+        for first in range(1, n_pages + 1, chunk):
+            check_cancelled("rasterize", skipped=n_pages - first + 1)
+            last = min(first + chunk - 1, n_pages)
+            images = convert_from_bytes(
+                data, dpi=PAGE_RASTER_DPI, poppler_path=poppler_path, first_page=first, last_page=last
+            )
+            for offset, image in enumerate(images):
+                result = page_fingerprint(image)
+                result.update({"page": len(seen) + 1, "file": file_name, "file_page": first + offset})
+                duplicate = find_duplicate(result, seen)
+                seen.append(result)
+                if duplicate:
+                    # La página ya está en el caso, no se procesa ni se envía de nuevo
+                    result.update({"duplicate_of": duplicate["page"], "text": "", "weak": False})
+                elif result["digest"] in page_index:
+                    # La página no cambió desde la carga anterior
+                    cached = page_index[result["digest"]]
+                    result.update({key: cached[key] for key in ("text", "confidence", "low_conf_ratio", "table_score", "weak")})
+                    result["redacted"] = True
+                    # Las páginas débiles se tapan de nuevo con la máscara de la carga anterior
+                    if WEAK_PAGE_RASTER and result["weak"] and cached.get("mask") is not None:
+                        result["mask"] = cached["mask"]
+                        result["image"] = raster_copy(image)
+                else:
+                    yield {"page": result, "image": image}
+                    continue
+                yield {"page": result, "image": None}
+
+
+# Función para leer una página nueva del caso
+def read_new_page(result: dict, image: Image, ocr_cache: PageOCRCache = None, policy: str = "") -> dict:
+    """
+    Fill the page with its OCR and its weak flag. When the very same
+    page was anonymized under the same policy in other cases it is
+    read from ocr_cache already anonymized, with redacted set like
+    the pages of page_index.
+    Returns the page.
+
+    Args:
+        result: page from rasterize_pages
+        image: rasterized page
+        ocr_cache: Optional cache of the anonymized pages shared by all the cases
+        policy: anonymization policy of the case (see redaction_policy)
+    """
+    # Formatos que se repiten entre casos se leen ya anonimizados del cache de OCR por página
+    cached = ocr_cache.get(ocr_cache_key(result, policy)) if ocr_cache is not None else None
+    if cached is not None:
+        result.update(cached)
+        result["redacted"] = True
+        result["from_ocr_cache"] = True
+        if WEAK_PAGE_RASTER and result["weak"] and result.get("mask") is not None:
+            result["image"] = raster_copy(image)
+        return result
+    result.update(read_page(image))
+    result["weak"] = is_weak(result)
+    if WEAK_PAGE_RASTER and result["weak"]:
+        # Se guarda una copia reducida para taparla después de anonimizar
+        result["image"] = raster_copy(image)
+    return result
+
+
+# Función para obtener la llave de una página en el cache de OCR
+def ocr_cache_key(page: dict, policy: str) -> str:
+    return f"{policy}/{page['digest']}"
+
+
+# Función para obtener lo que se guarda de una página anonimizada, nunca el texto original del OCR
+def index_entry(page: dict) -> dict:
+    return {
+        **{key: page[key] for key in ("text", "confidence", "low_conf_ratio", "table_score", "weak")},
+        "mask": page.get("mask")
+    }
+
+
+# Función para contar en el cache de OCR las páginas anonimizadas en el caso
+def record_pages(pages: list[dict], ocr_cache: PageOCRCache, case_id: str, policy: str):
+    """
+    Record the anonymized result of the pages processed in the case,
+    stored once the page recurs in enough cases (see PageOCRCache).
+
+    Args:
+        pages: anonymized pages of the case
+        ocr_cache: cache of the anonymized pages shared by all the cases, None to skip
+        case_id: sources digest of the case
+        policy: anonymization policy of the case (see redaction_policy)
+    """
+    if ocr_cache is None:
+        return
+    for page in pages:
+        if not page.get("duplicate_of") and not page.get("redacted"):
+            ocr_cache.record(ocr_cache_key(page, policy), case_id, index_entry(page))
+
+
+# Función para guardar la imagen de una página débil con la resolución de las imágenes del modelo
+def raster_copy(image: Image) -> Image:
+    scale = VISION_RENDER_DPI / PAGE_RASTER_DPI
+    return image.convert("L").resize(
+        (max(round(image.width * scale), 1), max(round(image.height * scale), 1)), Image.LANCZOS
+    )
+
+
+# Función para ubicar en la página las palabras que cambió la anonimización
+def redaction_mask(words: list[list], text: str) -> list[list[int]]:
+    """
+    Align the OCR words of a page with its anonymized text.
+    Returns the [left, top, width, height] boxes of the words that
+    the anonymization replaced or removed.
+
+    Args:
+        words: word boxes of ocr_page ([word, left, top, width, height, confidence])
+        text: anonymized text of the page
+    """
+    matcher = SequenceMatcher(None, [remove_accents(word[0]) for word in words], text.split(), autojunk=False)
+    return [
+        [int(value) for value in words[i][1:5]]
+        for tag, i1, i2, _, _ in matcher.get_opcodes() if tag != "equal"
+        for i in range(i1, i2)
+    ]
+
+
+# Función para tapar en la imagen de una página débil las palabras anonimizadas
+def mask_weak_page(page: dict) -> dict:
+    """
+    Turn the raster kept for a weak page into its anonymized image:
+    the boxes of the words changed by the anonymization are painted
+    black. The mask is kept with the page so an unchanged page can
+    be masked again on the next upload.
+    Returns the page, with raster set when it has an image.
+
+    Args:
+        page: anonymized page, with image set by read_new_page or rasterize_pages
+    """
+    image = page.pop("image", None)
+    if image is None:
+        return page
+    if page.get("mask") is None:
+        page["mask"] = redaction_mask(page.get("words") or [], page["text"])
+    scale = VISION_RENDER_DPI / PAGE_RASTER_DPI
+    draw = ImageDraw.Draw(image)
+    for left, top, width, height in page["mask"]:
+        draw.rectangle(
+            [
+                left * scale - REDACTION_MASK_PADDING, top * scale - REDACTION_MASK_PADDING,
+                (left + width) * scale + REDACTION_MASK_PADDING, (top + height) * scale + REDACTION_MASK_PADDING
+            ],
+            fill=0
+        )
+    page["raster"] = image
+    return page
+
+
+# Función para obtener las imágenes anonimizadas de las páginas débiles
+def page_rasters(pages: list[dict]) -> dict:
+    return {page["page"]: page["raster"] for page in pages if page.get("raster") is not None}
+
+
+# Función para reportar cómo se obtuvo cada página del caso
+def log_pages(pages: list[dict], n_documents: int, ocr_cache: PageOCRCache = None):
+    n_duplicates = sum(bool(page.get("duplicate_of")) for page in pages)
+    n_reused = sum(bool(page.get("redacted")) and not page.get("from_ocr_cache") for page in pages)
+    n_cached = sum(bool(page.get("from_ocr_cache")) for page in pages)
+    logger.info(
+        f"Extracted {len(pages)} pages from {n_documents} documents: "
+        f"{n_duplicates} duplicated, {n_reused} reused, {n_cached} from the OCR cache, "
+        f"{len(pages) - n_duplicates - n_reused - n_cached} processed"
+    )
+    if ocr_cache is not None:
+        logger.info(f"Page OCR cache stats: {ocr_cache.stats()}")
+
+
+# Función que extrae el texto de cada página de varios documentos
+def extract_pages_from_documents(
+        documents: list[tuple[str, bytes]],
+        poppler_path: Path,
+        tesseract_path: Path,
+        page_index: dict = None,
+        ocr_cache: PageOCRCache = None,
+        policy: str = ""
+) -> list[dict]:
+    """
+    Extract text from the pages of all the documents of a case.
+    Pages repeated across the documents are OCR'd only once, pages
+    found in page_index (from a previous upload) are reused with
+    their already anonymized text and pages recurring across cases
+    (standard forms) are read anonymized from ocr_cache.
+    Returns a list with the text, OCR confidence, table score,
+    weak flag and fingerprint of each page. Duplicated pages
+    have duplicate_of set and no text; reused pages have
+    redacted set.
+
+    Args:
+        documents: (file name, file bytes) of each document of the case
+        poppler_path: Local path of Poppler
+        tesseract_path: Local path of tesseract
+        page_index: Optional dict of page digest -> processed page
+        ocr_cache: Optional cache of the anonymized pages shared by all the cases
+        policy: anonymization policy of the case, part of the ocr_cache keys
+    """
+    pytesseract.pytesseract.tesseract_cmd = tesseract_path
+    # os.environ['TESSDATA_PREFIX'] = r"C:\Users\O014796\AppData\Local\Programs\Tesseract-OCR\tessdata"
+    results = []
+    for item in rasterize_pages(documents, poppler_path, page_index):
+        if item["image"] is not None:
+            # Si el analista cargó otro documento se detiene antes de la siguiente página
+            check_cancelled("ocr", skipped=1)
+            read_new_page(item["page"], item["image"], ocr_cache, policy)
+        results.append(item["page"])
+    log_pages(results, len(documents), ocr_cache)
+    return results
+
+
+# Función que extrae el texto de cada página con sus métricas de calidad
+def extract_pages_from_document(doc_path: Path, poppler_path: Path, tesseract_path: Path) -> list[dict]:
+    """
+    Extract text from pages inlucind images.
+    Returns a list with the text, OCR confidence, table score
+    and a weak flag for each page.
+
+    Args:
+        doc_path: Local path of the document
+        poppler_path: Local path of Poppler
+        tesseract_path: Local path of tesseract
+    """
+    return extract_pages_from_documents(read_documents([doc_path]), poppler_path, tesseract_path)
+
+
+# Función para unir el texto de las páginas
+def join_pages(pages: list[dict]) -> str:
+    """
+    Returns a text string of all pages with page separators.
+    Duplicated pages are left out.
+
+    Args:
+        pages: list of page dicts with page number and text
+    """
+    return "".join(
+        f"\n\n--- Página {page['page']}---\n\n{page['text']}" for page in pages if not page.get("duplicate_of")
+    ).strip()
+
+
+# Función para separar el texto por páginas
+def split_pages(text: str) -> dict:
+    """
+    Returns a dict of page number -> page text.
+
+    Args:
+        text: text string of all pages with page separators
+    """
+    parts = PAGE_SEPARATOR.split(text)
+    return {int(parts[i]): parts[i + 1].strip() for i in range(1, len(parts) - 1, 2)}
+
+
 # Función que extrae el texto de cada página del documento
 def extract_text_from_document(doc_path: Path, poppler_path: Path, tesseract_path: Path) -> str:
     """
@@ -67,17 +564,51 @@ def extract_text_from_document(doc_path: Path, poppler_path: Path, tesseract_pat
         poppler_path: Local path of Poppler
         tesseract_path: Local path of tesseract
     """
-    logger.info(f"Document: {doc_path.name}")
-    pytesseract.pytesseract.tesseract_cmd = tesseract_path
-    # os.environ['TESSDATA_PREFIX'] = r"C:\Users\O014796\AppData\Local\Programs\Tesseract-OCR\tessdata"
-    full_text = ""
-    pages = convert_from_path(doc_path, dpi=200, poppler_path=poppler_path)
-    for i, page in enumerate(pages):
-        processed = process_image(page)
-        ocr_text = pytesseract.image_to_string(processed, lang="spa", config="--psm 6")
-        ocr_text = remove_accents(ocr_text.strip())
-        full_text += f"\n\n--- Página {i + 1}---\n\n{ocr_text}"
-    return full_text.strip()
+    return join_pages(extract_pages_from_document(doc_path, poppler_path, tesseract_path))
+
+
+# Expresiones para anonimizar el texto en el orden en que se aplican,
+# antes y después de la detección de nombres
+PRE_NAME_STEPS = [
+    (re.compile(r'''\b [\w\.-]+ \s* [\(\[\{<]? @|arroba|\(a\)|\[a\] [\)\]\}>]? \s* [\w\.-]+ \.[a-z]{2,} \b''',
+        re.IGNORECASE | re.VERBOSE), '[CORREO]'),
+    (re.compile(r'\b\S{1,50}(gmail\.com|hotmail\.com|outlook\.com|yahoo\.com|live\.com|une\.net\.co|icloud\.com)\b',
+        re.IGNORECASE), '[CORREO]'),
+    (re.compile(r'\b3\d{2}[\s\-.]?\d{3}[\s\-.]?\d{4}\b'), '[TELÉFONO]'),
+    (re.compile(r'(?<!\$)\b\d{8,10}\b'), '[CÉDULA]'),
+    (re.compile(r'(?<!\$)\b\d{1,3}(?:\.\d{3}){2,3}\b'), '[CÉDULA]'),
+    # Enmascarar cuentas específicas: 9, 10, 16 o 20 dígitos exactos
+    (re.compile(r'\b(?:\d{9}|\d{10}|\d{16}|\d{20})\b'), '[CUENTA]'),
+    (re.compile(r'\b(?:\d{2,6}[-]){2,4}\d{2,6}\b'), '[CUENTA]'),
+    (re.compile(r'(Cuenta\s+de\s+(?:Ahorro|Corriente)[\sN°\.]*)(\d{9}|\d{10}|\d{16}|\d{20})', flags=re.IGNORECASE),
+        r'\1[CUENTA]'),
+    (re.compile(r'\b(Calle|Carrera|Cra|Cr|Kra|Transversal|Diagonal|Av\.?|Avenida|Mz|Manzana|Anillo|Autopista|Circular)\s*\d+[A-Za-z]?\s*(Bis)?\s*(#|No\.?)\s*\d+[A-Za-z]?\s*[-–]?\s*\d+\b(?:[\w\s,°\.#-]{0,40})?',
+        flags=re.IGNORECASE), '[DIRECCIÓN]'),
+]
+POST_NAME_STEPS = [
+    (re.compile(r'Atentamente[,:]?\s+[A-ZÁÉÍÓÚÑ ]{3,}'), 'Atentamente, [NOMBRE]'),
+    (re.compile(r'\b[Yy]o,\s*((?:[A-ZÁÉÍÓÚÑ]{2,}(?:\s+|,\s*)){1,6})'), 'Yo, [NOMBRE]'),
+]
+NAME_EXCEPTIONS = {'BBVA','NET','CC','SUPERINTENDENCIA','BANCO','COLOMBIA','SURA','DIAN','ICBF','EPS','ADRES',
+                   'Av','Cédula','DERECHO DE PETICIÓN','DERECHOS','NO','NI','PSE','Banco Bilbao Vizcaya','FUNDAMENTOS'}
+NAMES_REGEX = re.compile(r'\b((?:[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+(?:[\s\u00A0\r\n]+(?:de|del))?[\s\u00A0\r\n]*)+[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+|(?:[A-ZÁÉÍÓÚÑ]{2,}(?:[\s\u00A0\r\n]+[A-ZÁÉÍÓÚÑ]{2,}){1,}))\b')
+NAME_UPPER = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZÁÉÍÓÚÑ")
+NAME_LOWER = frozenset("abcdefghijklmnopqrstuvwxyzáéíóúñ")
+
+
+# Función para decidir si un nombre se reemplaza
+def replace_name(name: str, exceptions: set) -> str:
+    """
+    Returns the name if any of its words is an exception,
+    [NOMBRE] otherwise.
+
+    Args:
+        name: detected name
+        exceptions: set of exceptions
+    """
+    if any(p.upper() in exceptions for p in name.split()):
+        return name
+    return '[NOMBRE]'
 
 
 # Función para reemplazar texto
@@ -90,10 +621,7 @@ def replacement(match: str, exceptions: str) -> str:
         match: str match
         exceptions: regex list of exceptions
     """
-    name = match.group(0)
-    if any(p.upper() in exceptions for p in name.split()):
-        return name
-    return '[NOMBRE]'
+    return replace_name(match.group(0), exceptions)
 
 
 # Función para anonimizar el texto quitando valores sensibles
@@ -106,103 +634,926 @@ def encrypt_text(text: str) -> str:
         doc_path: Local path of the document
     """
     text = text.replace('\xa0', ' ').replace('\u200b', ' ')
-    email_regex = re.compile(r'''\b [\w\.-]+ \s* [\(\[\{<]? @|arroba|\(a\)|\[a\] [\)\]\}>]? \s* [\w\.-]+ \.[a-z]{2,} \b''',
-        re.IGNORECASE | re.VERBOSE)
-    text = re.sub(email_regex, '[CORREO]', text)
-    frag_email_regex = re.compile(r'\b\S{1,50}(gmail\.com|hotmail\.com|outlook\.com|yahoo\.com|live\.com|une\.net\.co|icloud\.com)\b',
-        re.IGNORECASE)
-    text = re.sub(frag_email_regex, '[CORREO]', text)
-    text = re.sub(r'\b3\d{2}[\s\-.]?\d{3}[\s\-.]?\d{4}\b','[TELÉFONO]', text)
-    text = re.sub(r'(?<!\$)\b\d{8,10}\b', '[CÉDULA]', text)
-    text = re.sub(r'(?<!\$)\b\d{1,3}(?:\.\d{3}){2,3}\b', '[CÉDULA]', text)
-    # Enmascarar cuentas específicas: 9, 10, 16 o 20 dígitos exactos
-    direct_account_regex = re.compile(r'\b(?:\d{9}|\d{10}|\d{16}|\d{20})\b')
-    text = re.sub(direct_account_regex, '[CUENTA]', text)
-    prompt_account_regex = re.compile(r'\b(?:\d{2,6}[-]){2,4}\d{2,6}\b')
-    text = re.sub(prompt_account_regex, '[CUENTA]', text)
-    sentence_account_regex = re.compile(r'(Cuenta\s+de\s+(?:Ahorro|Corriente)[\sN°\.]*)(\d{9}|\d{10}|\d{16}|\d{20})',flags=re.IGNORECASE)
-    text = re.sub(sentence_account_regex, r'\1[CUENTA]', text)
-    text = re.sub(r'\b(Calle|Carrera|Cra|Cr|Kra|Transversal|Diagonal|Av\.?|Avenida|Mz|Manzana|Anillo|Autopista|Circular)\s*\d+[A-Za-z]?\s*(Bis)?\s*(#|No\.?)\s*\d+[A-Za-z]?\s*[-–]?\s*\d+\b(?:[\w\s,°\.#-]{0,40})?', '[DIRECCIÓN]', text, flags=re.IGNORECASE)
-    exceptions = {'BBVA','NET','CC','SUPERINTENDENCIA','BANCO','COLOMBIA','SURA','DIAN','ICBF','EPS','ADRES',
-                   'Av','Cédula','DERECHO DE PETICIÓN','DERECHOS','NO','NI','PSE','Banco Bilbao Vizcaya','FUNDAMENTOS'}
-    names_regex = re.compile(r'\b((?:[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+(?:[\s\u00A0\r\n]+(?:de|del))?[\s\u00A0\r\n]*)+[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+|(?:[A-ZÁÉÍÓÚÑ]{2,}(?:[\s\u00A0\r\n]+[A-ZÁÉÍÓÚÑ]{2,}){1,}))\b')
-    replacement_exceptions = partial(replacement, exceptions=exceptions)
-    text = names_regex.sub(replacement_exceptions, text)
-    text = re.sub(r'Atentamente[,:]?\s+[A-ZÁÉÍÓÚÑ ]{3,}', 'Atentamente, [NOMBRE]', text)
-    text = re.sub(r'\b[Yy]o,\s*((?:[A-ZÁÉÍÓÚÑ]{2,}(?:\s+|,\s*)){1,6})', 'Yo, [NOMBRE]', text)
+    for regex, repl in PRE_NAME_STEPS:
+        text = regex.sub(repl, text)
+    replacement_exceptions = partial(replacement, exceptions=NAME_EXCEPTIONS)
+    text = NAMES_REGEX.sub(replacement_exceptions, text)
+    for regex, repl in POST_NAME_STEPS:
+        text = regex.sub(repl, text)
     return text
 
 
+class RedactionTimeout(Exception):
+    """
+    Raised when a chunk exceeds its redaction time budget.
+    """
+
+
+# Función para detectar nombres en tiempo lineal
+def find_name_spans(text: str) -> list[tuple[int, int]]:
+    """
+    Linear-time equivalent of NAMES_REGEX. Capitalized words and
+    uppercase runs are linked into chains once, and each chain keeps
+    the furthest word followed by a word boundary, which is the match
+    the backtracking regex would return.
+    Returns the list of (start, end) spans in order.
+
+    Args:
+        text: text to scan
+    """
+    n = len(text)
+    is_word = [c.isalnum() or c == "_" for c in text]
+    # Fin de la racha de minúsculas, mayúsculas y espacios que empieza en cada posición
+    lower_end = [0] * (n + 1)
+    upper_end = [0] * (n + 1)
+    space_end = [0] * (n + 1)
+    lower_end[n] = upper_end[n] = space_end[n] = n
+    for i in range(n - 1, -1, -1):
+        c = text[i]
+        lower_end[i] = lower_end[i + 1] if c in NAME_LOWER else i
+        upper_end[i] = upper_end[i + 1] if c in NAME_UPPER else i
+        space_end[i] = space_end[i + 1] if c.isspace() else i
+
+    def boundary_after(end: int) -> bool:
+        return end == n or not is_word[end]
+
+    def capword_end(q: int) -> int:
+        if q + 1 < n and text[q] in NAME_UPPER and text[q + 1] in NAME_LOWER:
+            return lower_end[q + 1]
+        return -1
+
+    def next_capword(end: int) -> int:
+        s = space_end[end]
+        if s > end and text.startswith("de", s):
+            t = space_end[s + 2]
+            if capword_end(t) >= 0:
+                return t
+            if text.startswith("del", s):
+                t = space_end[s + 3]
+                if capword_end(t) >= 0:
+                    return t
+            return -1
+        return s if capword_end(s) >= 0 else -1
+
+    # Cadenas de palabras capitalizadas (primera alternativa)
+    word_last = {}
+    word_next = {}
+    starts = [q for q in range(n - 1) if capword_end(q) >= 0]
+    for q in reversed(starts):
+        end = capword_end(q)
+        nxt = next_capword(end)
+        word_next[q] = nxt
+        last = word_last.get(nxt) if nxt >= 0 else None
+        word_last[q] = last if last is not None else (end if boundary_after(end) else None)
+
+    # Cadenas de palabras en mayúsculas (segunda alternativa)
+    run_last = {}
+    run_next = {}
+    runs = [q for q in range(n) if text[q] in NAME_UPPER and (q == 0 or text[q - 1] not in NAME_UPPER)]
+    for q in reversed(runs):
+        end = upper_end[q]
+        if end - q < 2:
+            continue
+        s = space_end[end]
+        nxt = s if s > end and upper_end[s] - s >= 2 else -1
+        run_next[q] = nxt
+        last = run_last.get(nxt) if nxt >= 0 else None
+        run_last[q] = last if last is not None else (end if boundary_after(end) else None)
+
+    spans = []
+    pos = 0
+    for q in sorted(set(starts) | set(run_last)):
+        if q < pos or (q > 0 and is_word[q - 1]):
+            continue
+        end = None
+        if q in word_next and word_next[q] >= 0:
+            end = word_last.get(word_next[q])
+        if end is None and q in run_next and run_next[q] >= 0:
+            end = run_last.get(run_next[q])
+        if end is not None:
+            spans.append((q, end))
+            pos = end
+    return spans
+
+
+# Función para reemplazar nombres sin expresiones con retroceso
+def replace_names(text: str, exceptions: set = NAME_EXCEPTIONS) -> str:
+    """
+    Returns the text with the names replaced by [NOMBRE].
+
+    Args:
+        text: text to anonymize
+        exceptions: set of exceptions
+    """
+    parts = []
+    last = 0
+    for start, end in find_name_spans(text):
+        parts.append(text[last:start])
+        parts.append(replace_name(text[start:end], exceptions))
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+# Función para obtener una expresión de re con el motor que acepta límite de tiempo
+@lru_cache(maxsize=None)
+def bounded_pattern(pattern: re.Pattern):
+    return bounded_re.compile(pattern.pattern, pattern.flags)
+
+
+# Función para aplicar una expresión por ventanas solapadas
+def windowed_sub(
+        regex: re.Pattern,
+        repl,
+        text: str,
+        chunk_size: int = REDACTION_CHUNK_SIZE,
+        overlap: int = REDACTION_CHUNK_OVERLAP,
+        budget: float = REDACTION_CHUNK_BUDGET
+) -> str:
+    """
+    Same result as regex.sub on realistic text, but each search is
+    bounded to a window of chunk_size + overlap characters, so the
+    backtracking cost stays proportional to the text length, and
+    every call runs with the time left of the window budget, so a
+    pathological window stops instead of running without limit.
+    Returns the substituted text.
+
+    Args:
+        regex: compiled expression
+        repl: replacement string or function
+        text: text to substitute
+        chunk_size: size of the window where matches may start
+        overlap: extra characters a match may span past the window
+        budget: maximum seconds per window before RedactionTimeout
+    """
+    pattern = bounded_pattern(regex)
+    n = len(text)
+    if n <= chunk_size + overlap:
+        try:
+            return pattern.sub(repl, text, timeout=budget)
+        except TimeoutError as e:
+            raise RedactionTimeout(f"Text of {n} characters exceeded {budget}s") from e
+    parts = []
+    last = 0
+    pos = 0
+    window_start = time.perf_counter()
+    while pos < n:
+        core_end = min(pos + chunk_size, n)
+        window_end = min(core_end + overlap, n)
+        remaining = budget - (time.perf_counter() - window_start)
+        try:
+            if remaining <= 0:
+                raise TimeoutError
+            match = pattern.search(text, pos, window_end, timeout=remaining)
+            if match is None or match.start() >= core_end:
+                pos = core_end
+                window_start = time.perf_counter()
+                continue
+            # La ventana pudo cortar la coincidencia, se repite hasta el final del texto con el tiempo que queda
+            if match.end() == window_end and window_end < n:
+                remaining = max(budget - (time.perf_counter() - window_start), 0.0)
+                full_match = pattern.match(text, match.start(), timeout=remaining)
+                if full_match is None:
+                    pos = match.start() + 1
+                    continue
+                match = full_match
+        except TimeoutError as e:
+            raise RedactionTimeout(f"Window at {pos} exceeded {budget}s") from e
+        parts.append(text[last:match.start()])
+        parts.append(repl(match) if callable(repl) else match.expand(repl))
+        last = match.end()
+        pos = max(match.end(), match.start() + 1)
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+# Función de anonimización conservadora en tiempo lineal
+def conservative_redaction(text: str) -> str:
+    """
+    Fallback used when a chunk exceeds its time budget. Masks every
+    token with an at sign, four or more digits or a capital letter.
+    Returns the anonymized text.
+
+    Args:
+        text: text to anonymize
+    """
+    def mask(match):
+        token = match.group(0)
+        if "@" in token or sum(c.isdigit() for c in token) >= 4:
+            return "[DATO]"
+        if token[0].isupper() and token.upper().strip(".,;:") not in NAME_EXCEPTIONS:
+            return "[NOMBRE]"
+        return token
+    return re.sub(r"\S+", mask, text)
+
+
+# Función para anonimizar el texto por páginas y ventanas
+def encrypt_text_chunked(
+        text: str,
+        chunk_size: int = REDACTION_CHUNK_SIZE,
+        overlap: int = REDACTION_CHUNK_OVERLAP,
+        budget: float = REDACTION_CHUNK_BUDGET
+) -> str:
+    """
+    Same steps as encrypt_text applied page by page, with windowed
+    expressions and linear-time name detection. Pages over the time
+    budget fall back to conservative_redaction.
+    Returns the anonymized text.
+
+    Args:
+        text: text string of all pages with page separators
+        chunk_size: size of the redaction windows
+        overlap: overlap between redaction windows
+        budget: maximum seconds per window
+    """
+    text = text.replace('\xa0', ' ').replace('\u200b', ' ')
+    # El separador de páginas queda en las posiciones impares
+    pieces = PAGE_SEPARATOR.split(text)
+    separators = [match.group(0) for match in PAGE_SEPARATOR.finditer(text)]
+    output = []
+    for i, page in enumerate(pieces[::2]):
+        start = time.perf_counter()
+        try:
+            for regex, repl in PRE_NAME_STEPS:
+                page = windowed_sub(regex, repl, page, chunk_size, overlap, budget)
+            page = replace_names(page)
+            for regex, repl in POST_NAME_STEPS:
+                page = windowed_sub(regex, repl, page, chunk_size, overlap, budget)
+        except RedactionTimeout as e:
+            logger.error(f"Redaction time guard on page chunk {i}: {e}")
+            page = conservative_redaction(pieces[2 * i])
+        logger.debug(f"Page chunk {i} redacted in {time.perf_counter() - start:.3f}s")
+        output.append(page)
+        if i < len(separators):
+            output.append(separators[i])
+    return "".join(output)
+
+
+# Función para anonimizar según el modo configurado
+def redact_text(text: str, mode: str = REDACTION_MODE) -> str:
+    """
+    Returns the anonymized text using the chunked or full mode.
+
+    Args:
+        text: text string of all pages
+        mode: "chunked" or "full"
+    """
+    if mode == "full":
+        return encrypt_text(text)
+    return encrypt_text_chunked(text)
+
+
+class Anonymizer(ABC):
+    """
+    Interface of the anonymization backends. A backend receives the
+    OCR text of several pages at once, so it can batch them, and
+    returns each page with its sensitive data replaced by the labels
+    of encrypt_text ([NOMBRE], [CÉDULA], [CORREO]...).
+    """
+
+    name = "base"
+
+    @property
+    def policy(self) -> str:
+        """
+        Returns an id of the settings that shape the anonymized text.
+        """
+        return self.name
+
+    @abstractmethod
+    def anonymize_texts(self, texts: list[str]) -> list[str]:
+        """
+        Returns the anonymized texts, in the same order.
+
+        Args:
+            texts: OCR text of each page
+        """
+
+    def anonymize_pages(self, pages: list[dict]) -> dict:
+        """
+        Returns a dict of page number -> anonymized page text.
+
+        Args:
+            pages: list of page dicts with page number and text
+        """
+        pages = [page for page in pages if not page.get("duplicate_of")]
+        texts = self.anonymize_texts([page["text"] for page in pages])
+        return {page["page"]: text.strip() for page, text in zip(pages, texts)}
+
+
+class RegexAnonymizer(Anonymizer):
+    """
+    The regular expressions of encrypt_text, page by page.
+    """
+
+    name = "regex"
+
+    def __init__(self, mode: str = REDACTION_MODE):
+        self.mode = mode
+
+    @property
+    def policy(self) -> str:
+        return f"{self.name}/{self.mode}"
+
+    def anonymize_texts(self, texts: list[str]) -> list[str]:
+        return [redact_text(text, self.mode) for text in texts]
+
+
+class PresidioAnonymizer(Anonymizer):
+    """
+    Presidio analyzer with the spaCy NER model for the names (also
+    lowercase ones, which the regular expressions miss) and the
+    expressions of PRE_NAME_STEPS as custom pattern recognizers.
+    The NLP engine is loaded once per process, on first use, and
+    the pages are analyzed in batches with nlp.pipe.
+    """
+
+    name = "presidio"
+
+    def __init__(
+            self,
+            spacy_model: str = PRESIDIO_SPACY_MODEL,
+            batch_size: int = PRESIDIO_BATCH_SIZE,
+            min_score: float = PRESIDIO_MIN_SCORE
+    ):
+        self.spacy_model = spacy_model
+        self.batch_size = batch_size
+        self.min_score = min_score
+        self._lock = threading.Lock()
+        self._engines = None
+
+    @property
+    def policy(self) -> str:
+        return f"{self.name}/{self.spacy_model}/{self.min_score}"
+
+    @staticmethod
+    def recognizers() -> list:
+        """
+        Returns the pattern recognizers built from PRE_NAME_STEPS, one
+        per expression to keep its flags, plus the signature names of
+        POST_NAME_STEPS.
+        """
+        from presidio_analyzer import Pattern, PatternRecognizer
+
+        recognizers = []
+        for i, (regex, repl) in enumerate(PRE_NAME_STEPS):
+            # Las que reemplazan solo un grupo (\1[CUENTA]) ya las cubre la expresión del número
+            if "\\" in repl:
+                continue
+            entity = repl.strip("[]")
+            recognizers.append(PatternRecognizer(
+                supported_entity=entity,
+                name=f"{entity.lower()}_{i}",
+                patterns=[Pattern(name=f"{entity.lower()}_{i}", regex=regex.pattern, score=0.9)],
+                supported_language="es",
+                global_regex_flags=regex.flags
+            ))
+        # Firmas y "Yo, NOMBRE" en mayúsculas, el nombre sin el texto que lo precede
+        recognizers.append(PatternRecognizer(
+            supported_entity="NOMBRE",
+            name="nombre_firma",
+            patterns=[
+                Pattern(name="atentamente", regex=r"(?<=Atentamente,\s)[A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑ ]{2,}", score=0.8),
+                Pattern(name="yo", regex=r"(?<=[Yy]o,\s)(?:[A-ZÁÉÍÓÚÑ]{2,}(?:\s+|,\s*)){1,6}", score=0.8),
+            ],
+            supported_language="es",
+            global_regex_flags=re.UNICODE
+        ))
+        return recognizers
+
+    def engines(self) -> tuple:
+        """
+        Returns the batch analyzer and the anonymizer engines, loading
+        the spaCy model the first time.
+        """
+        if self._engines is None:
+            with self._lock:
+                if self._engines is None:
+                    from presidio_analyzer import AnalyzerEngine, BatchAnalyzerEngine, RecognizerRegistry
+                    from presidio_analyzer.nlp_engine import NlpEngineProvider
+                    from presidio_anonymizer import AnonymizerEngine
+
+                    start = time.perf_counter()
+                    nlp_engine = NlpEngineProvider(nlp_configuration={
+                        "nlp_engine_name": "spacy",
+                        "models": [{"lang_code": "es", "model_name": self.spacy_model}]
+                    }).create_engine()
+                    registry = RecognizerRegistry(supported_languages=["es"])
+                    registry.load_predefined_recognizers(languages=["es"], nlp_engine=nlp_engine)
+                    for recognizer in self.recognizers():
+                        registry.add_recognizer(recognizer)
+                    analyzer = AnalyzerEngine(registry=registry, nlp_engine=nlp_engine, supported_languages=["es"])
+                    self._engines = (BatchAnalyzerEngine(analyzer_engine=analyzer), AnonymizerEngine())
+                    logger.info(f"Presidio engines loaded with {self.spacy_model} in {time.perf_counter() - start:.2f}s")
+        return self._engines
+
+    def anonymize_texts(self, texts: list[str]) -> list[str]:
+        from presidio_anonymizer.entities import OperatorConfig
+
+        batch_analyzer, anonymizer = self.engines()
+        texts = [text.replace('\xa0', ' ').replace('\u200b', ' ') for text in texts]
+        entities = ["PERSON", "NOMBRE"] + sorted({
+            repl.strip("[]") for _, repl in PRE_NAME_STEPS if "\\" not in repl
+        })
+        analyses = batch_analyzer.analyze_iterator(
+            texts, language="es", batch_size=self.batch_size, entities=entities, score_threshold=self.min_score
+        )
+        output = []
+        for text, results in zip(texts, analyses):
+            # Las excepciones (BBVA, Superintendencia...) no son nombres, igual que en replace_name
+            results = [
+                result for result in results
+                if result.entity_type not in ("PERSON", "NOMBRE")
+                or replace_name(text[result.start:result.end], NAME_EXCEPTIONS) != text[result.start:result.end]
+            ]
+            operators = {
+                entity: OperatorConfig("replace", {"new_value": f"[{'NOMBRE' if entity == 'PERSON' else entity}]"})
+                for entity in {result.entity_type for result in results}
+            }
+            output.append(anonymizer.anonymize(text=text, analyzer_results=results, operators=operators).text)
+        return output
+
+
+ANONYMIZERS = {"regex": RegexAnonymizer, "presidio": PresidioAnonymizer}
+
+
+# Función para obtener el anonimizador del proceso
+@lru_cache(maxsize=None)
+def get_anonymizer(name: str = ANONYMIZER) -> Anonymizer:
+    """
+    Returns the anonymizer backend, one instance per process so the
+    models stay loaded between cases.
+
+    Args:
+        name: "regex" or "presidio"
+    """
+    if name not in ANONYMIZERS:
+        raise ValueError(f"Unknown anonymizer {name}, expected one of {sorted(ANONYMIZERS)}")
+    return ANONYMIZERS[name]()
+
+
+# Función para identificar la configuración con la que se anonimiza un caso
+def redaction_policy(anonymizer: Anonymizer = None) -> str:
+    """
+    Returns an id of everything that shapes the anonymized output of
+    a page: the backend and its settings and WEAK_PAGE_RASTER.
+
+    Args:
+        anonymizer: anonymization backend, by default the one of ANONYMIZER
+    """
+    anonymizer = anonymizer or get_anonymizer()
+    return f"{anonymizer.policy}/raster={WEAK_PAGE_RASTER}"
+
+
 # Función para crear PDF a partir del texto
-def create_pdf(text: str, output_path: Path, font_path: Path) -> Path:
+def create_pdf(text: str, output_path: Path, font_path: Path, images: dict = None) -> tuple[bytes, dict]:
     """
-    Create a new pdf from all pages text.
-    Returns the new document local path.
+    Create a new pdf from all pages text. Each source page
+    starts on a new pdf page, source pages in images are drawn as
+    their image instead of their text.
+    Returns the pdf bytes and a dict of source page number ->
+    list of pdf page indexes.
 
     Args:
         text: Pages string
-        output_path: Local path of the new document
+        output_path: Optional local path of the new document, None to keep it in memory
         font_path: Local path of the font
+        images: Optional dict of source page number -> anonymized image of the page
     """
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.add_font("Noto", "", font_path, uni=True)
-    pdf.set_font("Noto", size=12)
-    pdf.set_auto_page_break(auto=True, margin=15)
+    images = images or {}
+    pdf = new_pdf(font_path)
+    # Bloques de texto: el anterior al primer separador y el de cada página de origen
+    blocks = [(None, [])]
     for linea in text.split("\n"):
-        pdf.multi_cell(0, 10, linea)
-    pdf.output(output_path)
-    logger.info(f"Generated document: {output_path.name}")
-    return None
+        separator = PAGE_SEPARATOR.fullmatch(linea)
+        if separator:
+            blocks.append((int(separator.group(1)), []))
+        blocks[-1][1].append(linea)
+    page_map = {}
+    for i, (current, lines) in enumerate(blocks):
+        if current is None:
+            if lines:
+                write_text(pdf, "\n".join(lines))
+            continue
+        if i > 1:
+            pdf.add_page()
+        first = pdf.page_no() - 1
+        if current in images:
+            write_image(pdf, images[current])
+        else:
+            write_text(pdf, "\n".join(lines))
+        page_map[current] = list(range(first, pdf.page_no()))
+    data = bytes(pdf.output())
+    if output_path:
+        with open(output_path, "wb") as f:
+            f.write(data)
+        logger.info(f"Generated document: {output_path.name}")
+    return data, page_map
 
 
-# Función para generar documento encriptado
-def encrypt_document(doc_path: Path, output_path: Path, poppler_path: Path, tesseract_path: Path, font_path: Path) -> str:
+# Función para obtener la ruta de los metadatos de páginas de un documento encriptado
+def pages_metadata_path(encrypted_path: Path) -> Path:
+    return encrypted_path.with_name(f"{encrypted_path.stem}_pages.json")
+
+
+# Función para leer los metadatos de páginas de un documento encriptado
+def read_pages_metadata(encrypted_path: Path) -> list[dict]:
     """
-    Extract all info from document including text and image
-    using pytesseract. After that cleanses the text from
-    sensitive data and returns a new .pdf file.
+    Returns the anonymized text and OCR quality of each page,
+    or None if the metadata was not generated.
+
+    Args:
+        encrypted_path: Local path of the encrypted document
+    """
+    metadata_path = pages_metadata_path(encrypted_path)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Función para obtener la ruta del índice de páginas ya procesadas de un caso
+def pages_index_path(encrypted_path: Path) -> Path:
+    return encrypted_path.with_name(f"{encrypted_path.stem}_index.json")
+
+
+# Función para obtener la huella de los archivos cargados en un caso
+def sources_digest(documents: list[tuple[str, bytes]]) -> str:
+    """
+    Returns a sha256 digest of the names and bytes of the documents.
+
+    Args:
+        documents: (file name, file bytes) of each document of the case
+    """
+    digest = hashlib.sha256()
+    for file_name, data in documents:
+        digest.update(file_name.encode("utf-8"))
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+# Función para leer el índice de páginas ya procesadas de un caso
+def read_pages_index(encrypted_path: Path) -> dict:
+    """
+    Returns the index of the case with the sources digest and the
+    anonymized pages keyed by raster digest, empty if it does not exist.
+
+    Args:
+        encrypted_path: Local path of the encrypted document
+    """
+    index_path = pages_index_path(encrypted_path)
+    if not os.path.exists(index_path):
+        return {"sources": None, "pages": {}}
+    with open(index_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Función para validar si el documento encriptado corresponde a los archivos cargados
+def encryption_is_current(doc_paths: list[Path], encrypted_path: Path) -> bool:
+    """
+    Returns True if the encrypted document exists and was generated
+    from exactly these documents.
 
     Args:
-        doc_path: Local path of the pqrs file
+        doc_paths: Local paths of the documents of the case
+        encrypted_path: Local path of the encrypted document
     """
+    if not os.path.exists(encrypted_path):
+        return False
+    return read_pages_index(encrypted_path)["sources"] == sources_digest(read_documents(doc_paths))
+
+
+# Función para anonimizar los documentos de un caso en memoria
+def anonymize_documents(
+        documents: list[tuple[str, bytes]],
+        poppler_path: Path,
+        tesseract_path: Path,
+        font_path: Path,
+        page_index: dict = None,
+        ocr_cache: PageOCRCache = None,
+        anonymizer: Anonymizer = None,
+        pipelined: bool = PAGE_PIPELINE
+) -> dict:
+    """
+    Extract all info from the documents including text and image
+    using pytesseract, cleanse the text from sensitive data and
+    build the anonymized pdf, without touching the disk.
+    Repeated pages are processed once, pages found in page_index
+    (from a previous upload of the case) are not processed again
+    and standard forms seen in other cases are read from ocr_cache.
+    Returns a dict with the sources digest, the pdf bytes, the
+    pages metadata and the page index, or None on error.
+
+    Args:
+        documents: (file name, file bytes) of each document of the case
+        poppler_path: Local path of Poppler
+        tesseract_path: Local path of tesseract
+        font_path: Local path of the font
+        page_index: Optional dict of page digest -> processed page
+        ocr_cache: Optional cache of the anonymized pages shared by all the cases
+        anonymizer: Optional anonymization backend, by default the one of ANONYMIZER
+        pipelined: process the pages in overlapping stages (see anonymize_documents_pipelined)
+    """
+    if pipelined:
+        return anonymize_documents_pipelined(
+            documents, poppler_path, tesseract_path, font_path, page_index, ocr_cache, anonymizer
+        )
+    anonymizer = anonymizer or get_anonymizer()
     try:
-        ocr_text = extract_text_from_document(doc_path, poppler_path, tesseract_path)
+        with timed_stage(logger, "ocr", pages_cached=len(page_index or {})), profile_stage("ocr"):
+            pages = extract_pages_from_documents(
+                documents, poppler_path, tesseract_path, page_index, ocr_cache, redaction_policy(anonymizer)
+            )
         logger.info("Extracted text from document")
     except Exception as e:
         logger.error(f"Error extracting text: {e}")
         return None
+    # Solo se anonimizan las páginas nuevas, las reutilizadas ya están anonimizadas
     try:
-        encrypted_text = encrypt_text(ocr_text)
+        new_pages = [page for page in pages if not page.get("duplicate_of") and not page.get("redacted")]
+        check_cancelled("redact", skipped=len(new_pages))
+        with timed_stage(logger, "redact", pages=len(new_pages), anonymizer=anonymizer.name), profile_stage("redact"):
+            encrypted_pages = anonymizer.anonymize_pages(new_pages) if new_pages else {}
+        for page in new_pages:
+            page["text"] = encrypted_pages.get(page["page"], "")
+        for page in pages:
+            mask_weak_page(page)
+        record_pages(pages, ocr_cache, sources_digest(documents), redaction_policy(anonymizer))
+        encrypted_text = join_pages(pages)
         logger.info("Encrypted text")
     except Exception as e:
         logger.error(f"Error encrypting text: {e}")
         return None
     try:
-        create_pdf(encrypted_text, output_path, font_path)
+        check_cancelled("pdf", skipped=1)
+        with timed_stage(logger, "pdf"), profile_stage("pdf"):
+            pdf, page_map = create_pdf(encrypted_text, None, font_path, page_rasters(pages))
+    except Exception as e:
+        logger.error(f"Error creating pdf: {e}")
+        return None
+    return build_case_artifacts(documents, pages, pdf, page_map)
+
+
+# Función para armar los artefactos de un caso
+def build_case_artifacts(documents: list[tuple[str, bytes]], pages: list[dict], pdf: bytes, page_map: dict) -> dict:
+    """
+    Returns a dict with the sources digest, the pdf bytes, the
+    pages metadata and the page index.
+
+    Args:
+        documents: (file name, file bytes) of each document of the case
+        pages: processed pages with their anonymized text
+        pdf: bytes of the anonymized pdf
+        page_map: dict of source page number -> list of pdf page indexes
+    """
+    # Texto anonimizado y calidad del OCR de cada página
+    # para construir el payload híbrido sin repetir el OCR
+    metadata = [
+        {
+            "page": page["page"],
+            "file": page["file"],
+            "file_page": page["file_page"],
+            "text": page["text"],
+            "confidence": page.get("confidence"),
+            "low_conf_ratio": page.get("low_conf_ratio"),
+            "table_score": page.get("table_score"),
+            "weak": page["weak"],
+            "raster": page.get("raster") is not None,
+            "duplicate_of": page.get("duplicate_of"),
+            "pdf_pages": page_map.get(page["page"], [])
+        }
+        for page in pages
+    ]
+    # El índice guarda solo texto anonimizado, nunca el texto original del OCR,
+    # y de las páginas débiles las cajas de las palabras tapadas
+    index = {page["digest"]: index_entry(page) for page in pages if not page.get("duplicate_of")}
+    return {"sources": sources_digest(documents), "pdf": pdf, "pages": metadata, "index": index}
+
+
+# Función para anonimizar los documentos de un caso por páginas en etapas solapadas
+def anonymize_documents_pipelined(
+        documents: list[tuple[str, bytes]],
+        poppler_path: Path,
+        tesseract_path: Path,
+        font_path: Path,
+        page_index: dict = None,
+        ocr_cache: PageOCRCache = None,
+        anonymizer: Anonymizer = None
+) -> dict:
+    """
+    Same output as anonymize_documents, with each page flowing on its
+    own through rasterize -> OCR -> redact -> encode. The stages are
+    connected by bounded queues and overlap across pages: OCR runs in
+    PIPELINE_OCR_WORKERS threads, redaction batches the pages already
+    waiting and encode renders the vision images of each weak page as
+    soon as it is redacted. After the last page only the image cap and
+    the pdf of the case (rendered once, so the font is embedded once)
+    are left.
+    Returns the artifacts dict, with the message blocks of the case in
+    payload (as build_hybrid_payload), or None on error.
+
+    Args:
+        documents: (file name, file bytes) of each document of the case
+        poppler_path: Local path of Poppler
+        tesseract_path: Local path of tesseract
+        font_path: Local path of the font
+        page_index: Optional dict of page digest -> processed page
+        ocr_cache: Optional cache of the anonymized pages shared by all the cases
+        anonymizer: Optional anonymization backend, by default the one of ANONYMIZER
+    """
+    pytesseract.pytesseract.tesseract_cmd = tesseract_path
+    anonymizer = anonymizer or get_anonymizer()
+    policy = redaction_policy(anonymizer)
+
+    def ocr(items: list[dict]) -> list[dict]:
+        for item in items:
+            if item["image"] is None:
+                continue
+            check_cancelled("ocr", skipped=1)
+            read_new_page(item["page"], item["image"], ocr_cache, policy)
+            # La imagen original no sigue a las etapas siguientes, las páginas débiles llevan su copia reducida
+            item["image"] = None
+        return items
+
+    def redact(items: list[dict]) -> list[dict]:
+        new_pages = [item["page"] for item in items if not item["page"].get("duplicate_of") and not item["page"].get("redacted")]
+        if new_pages:
+            check_cancelled("redact", skipped=len(new_pages))
+            encrypted_pages = anonymizer.anonymize_pages(new_pages)
+            for page in new_pages:
+                page["text"] = encrypted_pages.get(page["page"], "")
+        for item in items:
+            mask_weak_page(item["page"])
+        return items
+
+    def encode(items: list[dict]) -> list[dict]:
+        for item in items:
+            page = item["page"]
+            if page["weak"] and not page.get("duplicate_of"):
+                check_cancelled("encode", skipped=1)
+                item["vision"] = render_weak_page(page, font_path)
+        return items
+
+    try:
+        pipeline = PagePipeline(
+            [
+                Stage("ocr", ocr, workers=PIPELINE_OCR_WORKERS),
+                Stage("redact", redact, batch=PIPELINE_REDACT_BATCH),
+                Stage("encode", encode, workers=PIPELINE_ENCODE_WORKERS)
+            ],
+            name="pages"
+        )
+        with timed_stage(logger, "pages_pipeline", pages_cached=len(page_index or {})):
+            items, _ = pipeline.run(rasterize_pages(documents, poppler_path, page_index), source_name="rasterize")
+        items.sort(key=lambda item: item["page"]["page"])
+        pages = [item["page"] for item in items]
+        record_pages(pages, ocr_cache, sources_digest(documents), policy)
+    except Exception as e:
+        logger.error(f"Error processing pages: {e}")
+        return None
+    log_pages(pages, len(documents), ocr_cache)
+    try:
+        check_cancelled("pdf", skipped=1)
+        with timed_stage(logger, "pdf"), profile_stage("pdf"):
+            pdf, page_map = create_pdf(join_pages(pages), None, font_path, page_rasters(pages))
     except Exception as e:
         logger.error(f"Error creating pdf: {e}")
         return None
+    artifacts = build_case_artifacts(documents, pages, pdf, page_map)
+    try:
+        # Las imágenes ya están codificadas, falta solo el límite de imágenes
+        with timed_stage(logger, "payload"), profile_stage("payload"):
+            rendered = [item["vision"] for item in items if "vision" in item]
+            images = assemble_vision_payload(rendered, new_report(len(rendered), False))
+            artifacts["payload"] = build_hybrid_payload(pdf, artifacts["pages"], images=images)
+    except Exception as e:
+        # El payload se construye de nuevo desde los artefactos
+        logger.error(f"Error building payload in pipeline: {e}")
+    return artifacts
+
+
+# Función para renderizar las imágenes de una página débil apenas se anonimiza
+def render_weak_page(page: dict, font_path: Path) -> dict:
+    """
+    Render the anonymized page alone, as create_pdf lays it out in
+    the pdf of the case, and encode its vision images.
+    Returns the output of render_vision_page.
+
+    Args:
+        page: anonymized weak page
+        font_path: Local path of the font
+    """
+    pdf, page_map = create_pdf(join_pages([page]), None, font_path, page_rasters([page]))
+    with fitz.open(stream=pdf, filetype="pdf") as pdf_document:
+        vision_page = {"page": page["page"], "text": page["text"], "pdf_pages": page_map.get(page["page"], [])}
+        return render_vision_page(pdf_document, vision_page, encode=True)
+
+
+# Función para guardar en disco los artefactos de un caso
+def save_case_artifacts(artifacts: dict, encrypted_path: Path) -> list[Path]:
+    """
+    Write the anonymized pdf, its pages metadata and the page
+    index next to each other.
+    Returns the paths written.
+
+    Args:
+        artifacts: output of anonymize_documents
+        encrypted_path: Local path of the encrypted document
+    """
+    # Escrituras atómicas para que otro proceso nunca lea un archivo a medias
+    write_atomic(encrypted_path, artifacts["pdf"])
+    write_atomic(pages_metadata_path(encrypted_path), json.dumps(artifacts["pages"], ensure_ascii=False).encode("utf-8"))
+    write_atomic(
+        pages_index_path(encrypted_path),
+        json.dumps({"sources": artifacts["sources"], "pages": artifacts["index"]}, ensure_ascii=False).encode("utf-8")
+    )
+    logger.info(f"Generated document: {encrypted_path.name}")
+    return [encrypted_path, pages_metadata_path(encrypted_path), pages_index_path(encrypted_path)]
+
+
+# Función para escribir un archivo de forma atómica
+def write_atomic(path: Path, data: bytes) -> None:
+    """
+    Write to a temporary file next to path and rename it over path.
+
+    Args:
+        path: Local path of the file
+        data: content of the file
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# Función para leer de disco los artefactos de un caso
+def load_case_artifacts(encrypted_path: Path) -> dict:
+    """
+    Returns the artifacts saved by save_case_artifacts,
+    None if the case was not saved.
+
+    Args:
+        encrypted_path: Local path of the encrypted document
+    """
+    pages = read_pages_metadata(encrypted_path)
+    if pages is None or not os.path.exists(encrypted_path):
+        return None
+    index = read_pages_index(encrypted_path)
+    with open(encrypted_path, "rb") as f:
+        pdf = f.read()
+    return {"sources": index["sources"], "pdf": pdf, "pages": pages, "index": index["pages"]}
+
+
+# Función para generar documento encriptado
+def encrypt_document(doc_path: Path | list[Path], output_path: Path, poppler_path: Path, tesseract_path: Path, font_path: Path) -> str:
+    """
+    Extract all info from document including text and image
+    using pytesseract. After that cleanses the text from
+    sensitive data and returns a new .pdf file.
+    Several documents can be given for a case with attachments,
+    repeated pages are processed once and pages unchanged since a
+    previous upload of the case are not processed again.
+
+    Args:
+        doc_path: Local path of the pqrs file or list of paths of the case
+    """
+    doc_paths = doc_path if isinstance(doc_path, list) else [doc_path]
+    artifacts = anonymize_documents(
+        read_documents(doc_paths), poppler_path, tesseract_path, font_path, read_pages_index(output_path)["pages"]
+    )
+    if artifacts is None:
+        return None
+    try:
+        save_case_artifacts(artifacts, output_path)
+    except Exception as e:
+        logger.error(f"Error saving encrypted document: {e}")
     return None
 
 
 # Función para leer las paginas del pdf y convertirlas en base64
-def doc_to_base64(doc_path: Path) -> list[dict]:
+def doc_to_base64(doc_path: Path | bytes, page_indexes: list[int] = None) -> list[dict]:
     """
     Returns a list of dict with base64 images for
     each page of a given document.
 
     Args:
-        doc_path: Local Path of the document
+        doc_path: Local Path of the document or its bytes
+        page_indexes: Optional list of page indexes to convert, all by default
     """
 
-    pdf_document = fitz.open(doc_path)
+    if isinstance(doc_path, (bytes, bytearray)):
+        pdf_document = fitz.open(stream=doc_path, filetype="pdf")
+    else:
+        pdf_document = fitz.open(doc_path)
     n_pages = len(pdf_document)
+    if page_indexes is None:
+        page_indexes = range(0, n_pages)
     # Para cada una de las paginas del pdf
     # Le pedimos que la convierta en un mapa de pixeles y
     # eso es lo que convertimos en base64 para que lo lea el llm
     base64_data = []
-    for page_index in range(0, n_pages):
+    for page_index in page_indexes:
         page = pdf_document.load_page(page_index)
         pix = page.get_pixmap()
         img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
@@ -222,4 +1573,79 @@ def doc_to_base64(doc_path: Path) -> list[dict]:
         base64_data.append(msg_dict)
     logger.info("Document pages converted")
 
-    return base64_data
\ No newline at end of file
+    return base64_data
+
+
+# Función para construir el payload con texto para las páginas limpias
+# e imágenes solo para las páginas con OCR débil
+def build_hybrid_payload(
+        doc_path: Path | bytes,
+        pages: list[dict] = None,
+        name: str = "",
+        images: dict = None
+) -> list[dict]:
+    """
+    Returns a list of message content blocks: anonymized text for
+    well recognized pages and images of the anonymized pdf only for
+    weak pages (their text render, or the masked source raster when
+    WEAK_PAGE_RASTER is set, see mask_weak_page). Images are cropped
+    and downscaled to the vision budget; blank pages and pages over
+    the image cap go as their text. Falls back to images of every
+    page when there is no pages metadata.
+
+    Args:
+        doc_path: Local Path of the encrypted document or its bytes
+        pages: Pages metadata, read next to doc_path when not given
+        name: Name of the document for the logs
+        images: Optional blocks of the weak pages already built (see anonymize_documents_pipelined)
+    """
+    if pages is None and not isinstance(doc_path, (bytes, bytearray)):
+        pages = read_pages_metadata(doc_path)
+    name = name or getattr(doc_path, "name", "document")
+    if isinstance(doc_path, (bytes, bytearray)):
+        doc = bytes(doc_path)
+    else:
+        with open(doc_path, "rb") as f:
+            doc = f.read()
+    if pages is None:
+        logger.info("Pages metadata not found, sending all pages as images")
+        n_pages = len(fitz.open(stream=doc, filetype="pdf"))
+        images, _ = optimize_vision_payload(doc, [{"page": i + 1, "text": None, "pdf_pages": [i]} for i in range(n_pages)])
+        return [block for i in range(n_pages) for block in images.get(i + 1, [])]
+
+    weak_pages = [page for page in pages if page["weak"] and not page.get("duplicate_of")]
+    if images is None:
+        images, _ = optimize_vision_payload(doc, weak_pages) if weak_pages else ({}, None)
+    payload = []
+    for page in pages:
+        if page.get("duplicate_of"):
+            # Las páginas repetidas se envían una sola vez
+            payload.append({
+                "type": "text",
+                "text": f"--- Página {page['page']} ---\n(Igual a la página {page['duplicate_of']})"
+            })
+        elif page["weak"]:
+            # Las páginas en blanco o fuera del límite de imágenes llegan como bloque de texto
+            payload += images[page["page"]]
+        else:
+            payload.append({
+                "type": "text",
+                "text": f"--- Página {page['page']} ---\n{page['text']}"
+            })
+
+    # Reporte del tamaño del payload frente a enviar todas las páginas como imagen
+    hybrid_bytes = sum(len(block.get("data") or block.get("text", "")) for block in payload)
+    n_duplicates = sum(bool(page.get("duplicate_of")) for page in pages)
+    n_images = sum(block["type"] == "image" for block in payload)
+    n_text = sum(not page["weak"] and not page.get("duplicate_of") for page in pages)
+    if VISION_REPORT_BYTES:
+        image_bytes = sum(len(block["data"]) for block in doc_to_base64(doc))
+        reduction = 1 - hybrid_bytes / image_bytes if image_bytes else 0.0
+        baseline = f" vs {image_bytes} bytes all-images ({reduction:.1%} reduction)"
+    else:
+        baseline = ""
+    logger.info(
+        f"Hybrid payload for {name}: {n_text} text pages, {n_images} images for {len(weak_pages)} weak pages, "
+        f"{n_duplicates} duplicated pages, {hybrid_bytes} bytes{baseline}"
+    )
+    return payload
@@ -0,0 +1,291 @@
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from utils.cancellation import check_cancelled
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Límites por modelo del API Gateway: peticiones por segundo, ráfaga y peticiones en curso
+GOVERNOR_RATE = float(os.getenv("GOVERNOR_RATE", 4))
+GOVERNOR_BURST = float(os.getenv("GOVERNOR_BURST", 8))
+GOVERNOR_CONCURRENCY = int(os.getenv("GOVERNOR_CONCURRENCY", 8))
+# Límites propios de algunos modelos, p. ej. '{"gemini-2.0-flash": {"rate": 2, "burst": 4, "concurrency": 4}}'
+GOVERNOR_LIMITS = json.loads(os.getenv("GOVERNOR_LIMITS", "{}"))
+# Segundos máximos en cola antes de rendirse
+GOVERNOR_MAX_WAIT = float(os.getenv("GOVERNOR_MAX_WAIT", 120))
+# Clases de prioridad, las de menor número pasan primero
+PRIORITIES = {"interactive": 0, "analysis": 1, "batch": 2}
+# Número de esperas recientes que se guardan para los percentiles
+WAIT_WINDOW = 512
+# Cada cuánto revisa un turno en cola si fue cancelado o se le acabó el tiempo
+POLL_INTERVAL = 0.1
+# Modelo en la ruta de Vertex: .../publishers/google/models/<modelo>:generateContent
+VERTEX_MODEL = re.compile(r"/models/([^/:?]+)")
+
+# Clase de prioridad y sesión del turno en curso, se propagan a los hilos que copian el contexto
+current_priority = ContextVar("current_priority", default="batch")
+current_session = ContextVar("current_session", default="")
+
+
+class AdmissionTimeout(TimeoutError):
+    """
+    Raised when a call waits in the queue longer than max_wait.
+    """
+
+
+class TokenBucket:
+    """
+    Requests per second allowed for one model, with bursts of up to
+    burst requests. Not thread safe, the governor holds its lock.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        Returns the seconds until a token is available, 0 if there is one.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self.refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class ModelQueue:
+    """
+    Waiting calls of one model. Each priority class keeps a FIFO per
+    session and the sessions take turns (round robin), so a session
+    uploading many documents does not delay the others of its class.
+    """
+
+    def __init__(self, model: str, rate: float, burst: float, concurrency: int):
+        self.model = model
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.classes = {priority: OrderedDict() for priority in PRIORITIES.values()}
+        self.depth = 0
+        self.max_depth = 0
+
+    def push(self, ticket: dict):
+        sessions = self.classes[ticket["priority"]]
+        sessions.setdefault(ticket["session"], deque()).append(ticket)
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def head(self) -> dict:
+        """
+        Returns the next ticket to admit: the first of the session
+        whose turn it is in the highest priority class with waiters.
+        """
+        for priority in sorted(self.classes):
+            sessions = self.classes[priority]
+            if sessions:
+                return next(iter(sessions.values()))[0]
+        return None
+
+    def pop(self, ticket: dict):
+        sessions = self.classes[ticket["priority"]]
+        waiting = sessions[ticket["session"]]
+        waiting.remove(ticket)
+        if waiting:
+            # La sesión vuelve al final de la ronda de su clase
+            sessions.move_to_end(ticket["session"])
+        else:
+            del sessions[ticket["session"]]
+        self.depth -= 1
+
+
+class ConcurrencyGovernor:
+    """
+    Process-wide admission controller in front of the LLM transports.
+    Every gateway request takes a slot of its model: it waits until it
+    is the next in the queue of the model (by priority class, then
+    round robin across sessions), the model has a free slot
+    (concurrency limit) and its token bucket has a token (rate limit).
+    """
+
+    def __init__(
+            self,
+            rate: float = GOVERNOR_RATE,
+            burst: float = GOVERNOR_BURST,
+            concurrency: int = GOVERNOR_CONCURRENCY,
+            limits: dict = None,
+            max_wait: float = GOVERNOR_MAX_WAIT
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.limits = GOVERNOR_LIMITS if limits is None else limits
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._models = {}
+        self._waits = {priority: deque(maxlen=WAIT_WINDOW) for priority in PRIORITIES}
+        self._admitted = {priority: 0 for priority in PRIORITIES}
+        self._timeouts = 0
+        self._tickets = itertools.count()
+
+    def _queue(self, model: str) -> ModelQueue:
+        if model not in self._models:
+            limits = self.limits.get(model, {})
+            self._models[model] = ModelQueue(
+                model,
+                rate=float(limits.get("rate", self.rate)),
+                burst=float(limits.get("burst", self.burst)),
+                concurrency=int(limits.get("concurrency", self.concurrency))
+            )
+        return self._models[model]
+
+    def acquire(self, model: str, priority: str = None, session: str = None, max_wait: float = None) -> float:
+        """
+        Wait for a slot of the model.
+        Returns the seconds waited in the queue.
+
+        Args:
+            model: model called
+            priority: priority class, by default the one of the current turn
+            session: session of the call, by default the one of the current turn
+            max_wait: seconds to wait at most, by default the governor's
+        """
+        max_wait = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        priority = priority or current_priority.get()
+        if priority not in PRIORITIES:
+            priority = "batch"
+        session = session if session is not None else current_session.get()
+        # El número distingue dos llamadas de la misma sesión en la cola
+        ticket = {"priority": PRIORITIES[priority], "session": session, "number": next(self._tickets)}
+        start = time.monotonic()
+        with self._cond:
+            queue = self._queue(model)
+            queue.push(ticket)
+            try:
+                while True:
+                    delay = POLL_INTERVAL
+                    if queue.head() is ticket and queue.in_flight < queue.concurrency:
+                        delay = queue.bucket.delay()
+                        if delay == 0:
+                            queue.pop(ticket)
+                            queue.bucket.take()
+                            queue.in_flight += 1
+                            break
+                    waited = time.monotonic() - start
+                    if waited >= max_wait:
+                        self._timeouts += 1
+                        raise AdmissionTimeout(f"Waited {waited:.1f}s for a slot of {model}")
+                    self._cond.wait(min(delay, POLL_INTERVAL))
+                    # El turno puede ser reemplazado mientras espera
+                    check_cancelled("queue", skipped=1)
+            except BaseException:
+                if ticket in queue.classes[ticket["priority"]].get(session, ()):
+                    queue.pop(ticket)
+                self._cond.notify_all()
+                raise
+            waited = time.monotonic() - start
+            self._waits[priority].append(waited)
+            self._admitted[priority] += 1
+            # El siguiente de la cola puede pasar si queda cupo
+            self._cond.notify_all()
+        if waited >= 1:
+            logger.info(f"Gateway call to {model} admitted after {waited:.2f}s in queue ({priority})")
+        return waited
+
+    def release(self, model: str):
+        with self._cond:
+            self._models[model].in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, model: str, max_wait: float = None):
+        """
+        Hold a slot of the model while inside the block.
+
+        Args:
+            model: model called
+            max_wait: seconds to wait at most for the slot
+        """
+        self.acquire(model, max_wait=max_wait)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    def stats(self) -> dict:
+        """
+        Returns per model the calls in flight and the current and
+        maximum queue depth, and per priority class the admitted calls
+        and the average, p95 and maximum seconds waited in the queue.
+        """
+        with self._cond:
+            models = {
+                model: {"in_flight": queue.in_flight, "queue_depth": queue.depth, "max_queue_depth": queue.max_depth}
+                for model, queue in self._models.items()
+            }
+            waits = {priority: sorted(values) for priority, values in self._waits.items()}
+            admitted = dict(self._admitted)
+            timeouts = self._timeouts
+        return {
+            "models": models,
+            "wait": {
+                priority: {
+                    "admitted": admitted[priority],
+                    "avg_s": round(sum(values) / len(values), 3) if values else 0.0,
+                    "p95_s": round(values[int(0.95 * (len(values) - 1))], 3) if values else 0.0,
+                    "max_s": round(values[-1], 3) if values else 0.0
+                }
+                for priority, values in waits.items()
+            },
+            "timeouts": timeouts
+        }
+
+
+governor = ConcurrencyGovernor()
+
+
+# Contexto para marcar la prioridad y la sesión de las llamadas del bloque
+@contextmanager
+def admission(priority: str, session: str = ""):
+    """
+    Queue the gateway calls made inside the block with the priority
+    class and the session given.
+
+    Args:
+        priority: "interactive", "analysis" or "batch"
+        session: session of the analyst
+    """
+    priority_token = current_priority.set(priority)
+    session_token = current_session.set(session)
+    try:
+        yield
+    finally:
+        current_session.reset(session_token)
+        current_priority.reset(priority_token)
+
+
+# Función para obtener el modelo de una URL de Vertex
+def vertex_model(url: str) -> str:
+    match = VERTEX_MODEL.search(url)
+    return match.group(1) if match else "vertex"
@@ -0,0 +1,177 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+MAIN_PATH = Path(os.getcwd())
+
+# Configuración de los logs
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = Path(os.getenv("LOG_FILE", MAIN_PATH / "app.log"))
+# "json" para registros estructurados o "text" para el formato de consola de siempre
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Rotación por tamaño o, si se define LOG_ROTATE_WHEN (p. ej. "midnight"), por tiempo
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+# Fracción de los registros de rutas calientes que se conserva
+LOG_HOT_SAMPLE_RATE = float(os.getenv("LOG_HOT_SAMPLE_RATE", 0.1))
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(filename)s - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Atributos estándar de un LogRecord que no se copian como campos extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+# Campos del caso y la conversación que acompañan cada registro del turno
+log_fields = ContextVar("log_fields", default={})
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the fields bound with log_context (case hash, thread id...)
+    to every record.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in log_fields.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records marked with a sample_rate
+    (see hot()). Warnings and errors are never dropped.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample_rate", None)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with the time, level, module, message,
+    the context fields and any extra field of the record.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "module": record.filename,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key != "sample_rate":
+                payload[key] = value
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+# Función para crear el manejador del archivo con rotación
+def file_handler(path: Path = LOG_FILE) -> logging.Handler:
+    if LOG_ROTATE_WHEN:
+        return logging.handlers.TimedRotatingFileHandler(
+            path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    return logging.handlers.RotatingFileHandler(
+        path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+
+
+# Función para configurar los logs de toda la aplicación una sola vez
+def setup_logging():
+    """
+    Configure the root logger with a QueueHandler so the request
+    threads only enqueue records. A QueueListener thread formats
+    them and writes to the console and to a rotating log file.
+    Safe to call from every module, only the first call configures.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+        handlers = [logging.StreamHandler(), file_handler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        # Los filtros corren en el hilo que registra, para leer su contexto
+        queue_handler.addFilter(SamplingFilter())
+        queue_handler.addFilter(ContextFilter())
+        root = logging.getLogger()
+        root.handlers = [queue_handler]
+        root.setLevel(LOG_LEVEL)
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+# Contexto para agregar campos a los registros del turno
+@contextmanager
+def log_context(**fields):
+    """
+    Bind fields (e.g. case hash and thread id) to every record
+    logged inside the block, in this thread or context.
+
+    Args:
+        fields: fields to add to the records
+    """
+    token = log_fields.set({**log_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        log_fields.reset(token)
+
+
+# Función para marcar un registro de una ruta caliente
+def hot(rate: float = None, **fields) -> dict:
+    """
+    Returns the extra dict of a sampled record.
+
+    Args:
+        rate: fraction of the records to keep, LOG_HOT_SAMPLE_RATE by default
+        fields: extra fields of the record
+    """
+    return {"sample_rate": LOG_HOT_SAMPLE_RATE if rate is None else rate, **fields}
+
+
+# Contexto para medir la duración de una etapa
+@contextmanager
+def timed_stage(logger: logging.Logger, stage: str, **fields):
+    """
+    Log the duration of the block with the stage name.
+
+    Args:
+        logger: logger of the module
+        stage: name of the stage
+        fields: extra fields of the record
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        # stacklevel apunta al bloque que usa el contexto y no a este módulo
+        logger.info(
+            f"Stage {stage} took {duration_ms:.0f} ms",
+            extra={"stage": stage, "duration_ms": round(duration_ms, 1), **fields},
+            stacklevel=3
+        )
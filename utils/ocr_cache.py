@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from utils.cache import CACHE_PATH
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo del cache de OCR por página y número de apariciones (página, caso) que se recuerdan
+OCR_CACHE_MAX_MB = float(os.getenv("OCR_CACHE_MAX_MB", 256))
+OCR_CACHE_MAX_FINGERPRINTS = int(os.getenv("OCR_CACHE_MAX_FINGERPRINTS", 200_000))
+# Una página se guarda solo cuando aparece en este número de casos distintos (formatos, cartas
+# remisorias, páginas notariales), así no se guarda el texto de páginas propias de un cliente
+OCR_CACHE_MIN_CASES = int(os.getenv("OCR_CACHE_MIN_CASES", 3))
+# Versión del esquema: la 1 usaba una huella aproximada que confundía formularios llenados por clientes distintos,
+# la 2 guardaba el texto original del OCR y contaba los casos comparando solo con el último
+OCR_CACHE_SCHEMA = 3
+
+
+class PageOCRCache:
+    """
+    Anonymized results (text, OCR quality, weak flag and mask boxes)
+    of pages that recur across unrelated cases, shared by all of
+    them; never the original OCR text. Pages are keyed by the
+    anonymization policy and the exact digest of their raster
+    (page_fingerprint), so only a page with the very same pixels
+    gets the text: the same form filled in for another client, or
+    another scan of it, is a miss. A page is stored only once its
+    key was seen in min_cases different cases; the stored pages are
+    evicted by least recent use above max_bytes.
+    """
+
+    def __init__(
+            self,
+            db_path: Path = CACHE_PATH / "page_ocr.sqlite",
+            max_bytes: int = int(OCR_CACHE_MAX_MB * 1024 * 1024),
+            max_fingerprints: int = OCR_CACHE_MAX_FINGERPRINTS,
+            min_cases: int = OCR_CACHE_MIN_CASES
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_fingerprints = max_fingerprints
+        self.min_cases = min_cases
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < OCR_CACHE_SCHEMA:
+            # Las entradas de la huella aproximada no se pueden confirmar, se descartan
+            self._conn.executescript("DROP TABLE IF EXISTS sightings; DROP TABLE IF EXISTS pages;")
+            self._conn.execute(f"PRAGMA user_version = {OCR_CACHE_SCHEMA}")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sightings (
+                key TEXT NOT NULL,
+                case_id TEXT NOT NULL,
+                last_seen REAL NOT NULL,
+                UNIQUE (key, case_id)
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sightings_last_seen ON sightings (last_seen);
+            CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access);
+            """
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> dict:
+        """
+        Returns the cached anonymized result of the page, None on a miss.
+
+        Args:
+            key: anonymization policy and raster digest of the page
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE pages SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+        return None
+
+    def record(self, key: str, case_id: str, result: dict) -> bool:
+        """
+        Count the page in the case and store its anonymized result
+        once it recurs in min_cases distinct cases.
+        Returns True if the result was stored.
+
+        Args:
+            key: anonymization policy and raster digest of the page
+            case_id: id of the case where the page was seen
+            result: anonymized result (text, confidence, weak, mask...), never the original OCR text
+        """
+        now = time.time()
+        with self._lock:
+            # Una fila por caso: volver a ver la página en un caso ya contado solo actualiza la fecha
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sightings (key, case_id, last_seen) VALUES (?, ?, ?)", (key, case_id, now)
+            )
+            cases = self._conn.execute("SELECT COUNT(*) FROM sightings WHERE key = ?", (key,)).fetchone()[0]
+            stored = cases >= self.min_cases
+            if stored:
+                payload = json.dumps(result, ensure_ascii=False)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO pages (key, result, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, payload, len(payload), now)
+                )
+            self._conn.commit()
+        if stored:
+            self.evict()
+        return stored
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used pages above max_bytes and the
+        oldest sightings above max_fingerprints.
+        Returns the number of removed pages.
+        """
+        removed = 0
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in self._conn.execute("SELECT key, size FROM pages ORDER BY last_access ASC").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+                    total -= size
+                    removed += 1
+            self._conn.execute(
+                "DELETE FROM sightings WHERE rowid IN "
+                "(SELECT rowid FROM sightings ORDER BY last_seen DESC LIMIT -1 OFFSET ?)",
+                (self.max_fingerprints,)
+            )
+            self._conn.commit()
+        if removed:
+            logger.info(f"Page OCR cache evicted {removed} pages")
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters, hit ratio, number of pages and bytes.
+        """
+        with self._lock:
+            pages, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "pages": pages,
+            "bytes": size
+        }
@@ -10,17 +10,11 @@ import httpx
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 from dotenv import load_dotenv
 
+from utils.logs import setup_logging
+from utils.resilience import resilient_call
 
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 MAIN_PATH = Path(os.getcwd())
@@ -54,12 +48,17 @@ class AWSSignedHTTPTransport(httpx.HTTPTransport):
             aws_service="execute-api",
         )
 
-        response = requests.post(
-            request.url,
-            auth=auth,
-            json=content,
-            headers=headers,
-        )
+        # Cada intento respeta el deadline del turno
+        def send(timeout: float) -> requests.Response:
+            return requests.post(
+                str(request.url),
+                auth=auth,
+                json=content,
+                headers=headers,
+                timeout=timeout,
+            )
+
+        response = resilient_call(send, model=content.get("model", "default"))
 
         return httpx.Response(
             status_code=response.status_code,
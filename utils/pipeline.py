@@ -0,0 +1,278 @@
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Iterable
+
+from utils.logs import setup_logging
+from utils.profiling import profile_stage
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Tamaño de las colas entre etapas: limita las páginas rasterizadas en memoria
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 4))
+# Cada cuánto revisa una etapa bloqueada si otra etapa falló
+PIPELINE_POLL_INTERVAL = 0.1
+
+# Marca de fin de los elementos de una cola
+_END = object()
+
+
+class StageMetrics:
+    """
+    Counters of one stage: items processed, seconds busy, seconds
+    waiting for input (starved), seconds blocked on a full output
+    queue (backpressure) and the depth of its input queue.
+    """
+
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+        self._lock = threading.Lock()
+
+    def add(self, items: int = 0, busy: float = 0.0, starved: float = 0.0, blocked: float = 0.0, depth: int = None):
+        with self._lock:
+            self.items += items
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+            if depth is not None:
+                self.max_depth = max(self.max_depth, depth)
+                self._depth_total += depth
+                self._depth_samples += 1
+
+    def merge(self, other: "StageMetrics"):
+        self.add(other.items, other.busy, other.starved, other.blocked)
+        with self._lock:
+            self.max_depth = max(self.max_depth, other.max_depth)
+            self._depth_total += other._depth_total
+            self._depth_samples += other._depth_samples
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "items": self.items,
+                "busy_s": round(self.busy, 3),
+                "starved_s": round(self.starved, 3),
+                "blocked_s": round(self.blocked, 3),
+                "avg_queue_depth": round(self._depth_total / self._depth_samples, 2) if self._depth_samples else 0.0,
+                "max_queue_depth": self.max_depth
+            }
+
+
+class PipelineMetrics:
+    """
+    Process-wide per-stage counters of all the pipeline runs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.elapsed = 0.0
+        self._stages = {}
+
+    def record(self, stages: list[StageMetrics], elapsed: float):
+        with self._lock:
+            self.runs += 1
+            self.elapsed += elapsed
+            for stage in stages:
+                self._stages.setdefault(stage.name, StageMetrics(stage.name, stage.workers)).merge(stage)
+
+    def summary(self) -> dict:
+        """
+        Returns the number of runs, their average seconds and the
+        counters of each stage.
+        """
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "avg_elapsed_s": round(self.elapsed / self.runs, 3) if self.runs else 0.0,
+                "stages": {name: stage.summary() for name, stage in self._stages.items()}
+            }
+
+
+pipeline_metrics = PipelineMetrics()
+
+
+class Stage:
+    """
+    Step of a pipeline. func receives a list of up to batch items and
+    returns the list of items passed to the next stage. With several
+    workers the items of the stage may leave out of order.
+    """
+
+    def __init__(self, name: str, func: Callable[[list], list], workers: int = 1, batch: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.batch = max(batch, 1)
+
+
+class PagePipeline:
+    """
+    Producer/consumer pipeline with bounded queues between stages.
+    The source runs in its own thread and each stage in its workers,
+    so the stages overlap across items; a full queue stops the stage
+    before it. The first error (or Cancelled) of any stage stops the
+    others and is raised by run.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = PIPELINE_QUEUE_SIZE, name: str = "pipeline"):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.name = name
+
+    def run(self, source: Iterable, source_name: str = "source") -> tuple[list, list[StageMetrics]]:
+        """
+        Run the items of source through the stages.
+        Returns the items out of the last stage, in arrival order,
+        and the metrics of each stage.
+
+        Args:
+            source: iterable of items, consumed in its own thread
+            source_name: name of the source stage in the metrics
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        # La salida de la última etapa no se limita, la consume el hilo que llama
+        queues.append(queue.Queue())
+        metrics = [StageMetrics(source_name)] + [StageMetrics(stage.name, stage.workers) for stage in self.stages]
+        stop = threading.Event()
+        errors = []
+        remaining = [stage.workers for stage in self.stages]
+        remaining_lock = threading.Lock()
+
+        def fail(e: BaseException):
+            if not errors:
+                errors.append(e)
+            stop.set()
+
+        def put(q: queue.Queue, item, stage_metrics: StageMetrics) -> bool:
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=PIPELINE_POLL_INTERVAL)
+                    stage_metrics.add(blocked=time.perf_counter() - start)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def close(q: queue.Queue):
+            # Con la ejecución detenida nadie consume la cola, la marca no debe bloquear en una cola llena
+            while True:
+                try:
+                    q.put(_END, timeout=PIPELINE_POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    if stop.is_set():
+                        return
+
+        def produce():
+            try:
+                with profile_stage(source_name):
+                    iterator = iter(source)
+                    while not stop.is_set():
+                        start = time.perf_counter()
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            break
+                        metrics[0].add(items=1, busy=time.perf_counter() - start)
+                        if not put(queues[0], item, metrics[0]):
+                            return
+            except BaseException as e:
+                fail(e)
+            finally:
+                close(queues[0])
+
+        def work(i: int):
+            stage = self.stages[i]
+            inbox, outbox, stage_metrics = queues[i], queues[i + 1], metrics[i + 1]
+            try:
+                with profile_stage(stage.name):
+                    while not stop.is_set():
+                        start = time.perf_counter()
+                        try:
+                            first = inbox.get(timeout=PIPELINE_POLL_INTERVAL)
+                        except queue.Empty:
+                            stage_metrics.add(starved=time.perf_counter() - start)
+                            continue
+                        stage_metrics.add(starved=time.perf_counter() - start, depth=inbox.qsize())
+                        if first is _END:
+                            # La marca vuelve a la cola para los otros hilos de la etapa
+                            close(inbox)
+                            break
+                        batch = [first]
+                        # Se agregan al lote los elementos que ya esperan, sin bloquear
+                        while len(batch) < stage.batch:
+                            try:
+                                item = inbox.get_nowait()
+                            except queue.Empty:
+                                break
+                            if item is _END:
+                                close(inbox)
+                                break
+                            batch.append(item)
+                        start = time.perf_counter()
+                        outputs = stage.func(batch)
+                        stage_metrics.add(items=len(batch), busy=time.perf_counter() - start)
+                        for output in outputs:
+                            if not put(outbox, output, stage_metrics):
+                                return
+            except BaseException as e:
+                fail(e)
+            finally:
+                with remaining_lock:
+                    remaining[i] -= 1
+                    last = remaining[i] == 0
+                if last:
+                    close(outbox)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(
+            target=contextvars.copy_context().run, args=(produce,), name=f"{self.name}-{source_name}", daemon=True
+        )]
+        for i, stage in enumerate(self.stages):
+            for w in range(stage.workers):
+                # Cada hilo copia el contexto: deadline, token de cancelación, perfil y campos de log
+                threads.append(threading.Thread(
+                    target=contextvars.copy_context().run, args=(work, i), name=f"{self.name}-{stage.name}-{w}", daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+        results = []
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _END:
+                    break
+                results.append(item)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - start
+        pipeline_metrics.record(metrics, elapsed)
+        logger.info(
+            f"Pipeline {self.name}: {len(results)} items in {elapsed:.2f}s, "
+            + ", ".join(
+                f"{m.name} {m.items} items busy {m.busy:.2f}s starved {m.starved:.2f}s blocked {m.blocked:.2f}s "
+                f"max depth {m.max_depth}"
+                for m in metrics
+            )
+        )
+        if errors:
+            raise errors[0]
+        return results, metrics
@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, ToolMessage
+
+from utils.dataframes import typo_data
+from utils.logs import setup_logging
+from utils.tools import render_response_document, typology_dossier
+from utils.vision import normalize
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Hilos para precalcular y número de conversaciones que se recuerdan
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 2))
+PREFETCH_MAX_THREADS = int(os.getenv("PREFETCH_MAX_THREADS", 256))
+# Segundos que se espera un precálculo en curso antes de dejar que el agente use la herramienta
+PREFETCH_WAIT = float(os.getenv("PREFETCH_WAIT", 5))
+
+DOSSIER_TOOL = "get_typology_dossier"
+# Código entre paréntesis de las tipologías propuestas: "1. **NOMBRE (64)**: ..."
+PROPOSED_CODE = re.compile(r"^\s*(?:[-*]\s*)?\d\.\s*\**[^\n(]*\((\d+)\)", flags=re.MULTILINE)
+ORDINALS = {"primera": 1, "primero": 1, "segunda": 2, "segundo": 2, "tercera": 3, "tercero": 3}
+# Elección explícita que ocupa todo el mensaje: "2", "la segunda", "me quedo con la número 1", "tipología 64",
+# el nombre de la tipología... Un mensaje con más texto ("el 1 de marzo", "el primer pago") no es una elección
+CHOICE_MESSAGE = re.compile(
+    r"(?:(?:elijo|escojo|selecciono|prefiero|me quedo con|vamos con|sigamos con|continua con|con)\s+)?"
+    r"(?:(?:la|el)\s+)?(?:(?:opcion|numero|tipologia)\s+|#\s*)?"
+    r"(?P<choice>.+?)(?:\s+opcion)?(?:,?\s+por favor)?"
+)
+SUMMARY_FIELDS = (
+    re.compile(r"qu[eé] le pas[oó] al cliente\?\**:?\**\s*(.+)", flags=re.IGNORECASE),
+    re.compile(r"qu[eé] solicita el cliente\?\**:?\**\s*(.+)", flags=re.IGNORECASE),
+)
+
+
+# Función para obtener las tipologías propuestas en el primer análisis
+def proposed_typologies(response: str, proposal: list[dict] = None, k: int = 3) -> list[int]:
+    """
+    Returns the codes of the proposed typologies, in order. The
+    pre-classifier proposal is used when there is one, otherwise
+    the codes are parsed from the numbered list of the response.
+
+    Args:
+        response: first analysis of the agent
+        proposal: predictions of the pre-classifier, if any
+        k: number of typologies proposed
+    """
+    if proposal:
+        return [int(prediction["id"]) for prediction in proposal[:k]]
+    known = set(typo_data["id"].tolist())
+    codes = []
+    for match in PROPOSED_CODE.finditer(response or ""):
+        code = int(match.group(1))
+        if code in known and code not in codes:
+            codes.append(code)
+    return codes[:k]
+
+
+# Función para resumir el caso a partir del primer análisis
+def analysis_summary(response: str) -> str:
+    """
+    Returns what happened to the client and what they ask for, as
+    written in the first analysis, to draft the response document.
+
+    Args:
+        response: first analysis of the agent
+    """
+    parts = []
+    for pattern in SUMMARY_FIELDS:
+        match = pattern.search(response or "")
+        if match:
+            parts.append(match.group(1).strip())
+    return " ".join(parts)
+
+
+# Función para saber cuál de las tipologías propuestas eligió el analista
+def chosen_typology(user_input: str, codes: list[int]) -> int:
+    """
+    Returns the code of the proposed typology the analyst chose, None
+    unless the whole message is a short, explicit choice (see
+    CHOICE_MESSAGE) of the option number, its ordinal, its code or
+    its name. Any other message is left to the agent, which requests
+    the dossier tool itself.
+
+    Args:
+        user_input: message of the analyst
+        codes: codes of the proposed typologies, in order
+    """
+    text = " ".join(normalize(user_input).split()).strip(" .!¡?¿")
+    match = CHOICE_MESSAGE.fullmatch(text)
+    if match is None:
+        return None
+    choice = match.group("choice")
+    if choice.isdigit():
+        number = int(choice)
+        if 1 <= number <= len(codes):
+            return codes[number - 1]
+        return number if number in codes else None
+    if ORDINALS.get(choice, len(codes) + 1) <= len(codes):
+        return codes[ORDINALS[choice] - 1]
+    names = typo_data.set_index("id")["typo"]
+    for code in codes:
+        if code in names and " ".join(normalize(names[code]).split()).strip(" .") == choice:
+            return code
+    return None
+
+
+class SpeculativePrefetcher:
+    """
+    Precomputes, while the analyst reads the first analysis, the
+    dossier and a draft response document of each proposed typology.
+    When the analyst picks one of them the dossier is added to the
+    conversation as the result of the dossier tool, so the agent
+    answers from it without a model step to request the tool.
+    """
+
+    def __init__(self, workers: int = PREFETCH_WORKERS, max_threads: int = PREFETCH_MAX_THREADS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._threads = OrderedDict()
+        self.max_threads = max_threads
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _prepare(code: int, date: str, summary: str) -> dict:
+        dossier = typology_dossier(code)
+        if dossier["found"] and summary:
+            # Argumentos de la plantilla, se renderiza para dejarla en la memoria de render_response_document
+            dossier["template"] = {
+                "date": date,
+                "typo_name": dossier["typology"],
+                "typo_desc": dossier["description"],
+                "pqrs_summary": summary
+            }
+            render_response_document(**dossier["template"])
+        return dossier
+
+    @staticmethod
+    def make_key(session_id: str, thread_id: str) -> str:
+        # La conversación se identifica con la sesión del analista para no entregar el dossier de otra sesión
+        return f"{session_id}:{thread_id}"
+
+    def start(self, key: str, response: str, date: str, proposal: list[dict] = None) -> list[int]:
+        """
+        Start prefetching the typologies proposed in the first analysis.
+        Returns their codes.
+
+        Args:
+            key: key of the conversation, see make_key
+            response: first analysis of the agent
+            date: today's date, as given to the agent
+            proposal: predictions of the pre-classifier, if any
+        """
+        codes = proposed_typologies(response, proposal)
+        if not codes:
+            logger.info("No proposed typologies to prefetch")
+            return codes
+        summary = analysis_summary(response)
+        futures = {code: self._executor.submit(self._prepare, code, date, summary) for code in codes}
+        with self._lock:
+            self._threads[key] = {"codes": codes, "futures": futures}
+            self._threads.move_to_end(key)
+            while len(self._threads) > self.max_threads:
+                self._threads.popitem(last=False)
+        logger.info(f"Prefetching typologies {codes}")
+        return codes
+
+    def dossier_for(self, key: str, user_input: str) -> dict:
+        """
+        Returns the prefetched dossier of the typology chosen in the
+        message, None if there is no prefetch for the conversation or
+        the message is not an explicit choice of a proposed typology.
+
+        Args:
+            key: key of the conversation, see make_key
+            user_input: message of the analyst
+        """
+        with self._lock:
+            prefetch = self._threads.get(key)
+        if prefetch is None:
+            return None
+        code = chosen_typology(user_input, prefetch["codes"])
+        if code is None:
+            return None
+        # Se usa una sola vez, después la conversación sigue su curso normal
+        with self._lock:
+            self._threads.pop(key, None)
+        try:
+            dossier = prefetch["futures"][code].result(timeout=PREFETCH_WAIT)
+        except Exception as e:
+            logger.error(f"Error prefetching typology {code}: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            hits, misses = self.hits, self.misses
+        logger.info(f"Prefetched typology {code} used ({hits} hits / {misses} misses)")
+        return dossier
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters and the number of pending conversations.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "pending": len(self._threads)}
+
+
+# Función para agregar el dossier precalculado como resultado de la herramienta
+def dossier_messages(dossier: dict) -> list:
+    """
+    Returns the tool call and tool result messages of a prefetched
+    dossier, as if the agent had requested it.
+
+    Args:
+        dossier: prefetched dossier
+    """
+    call_id = f"prefetch_{uuid.uuid4().hex[:12]}"
+    return [
+        AIMessage(content="", tool_calls=[{"name": DOSSIER_TOOL, "args": {"typo_code": dossier["typo_code"]}, "id": call_id}]),
+        ToolMessage(content=json.dumps(dossier, ensure_ascii=False), tool_call_id=call_id, name=DOSSIER_TOOL)
+    ]
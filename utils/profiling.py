@@ -0,0 +1,257 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Fracción de los turnos que se perfilan sin pedirlo, 0 lo desactiva
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.0))
+# "sample" muestrea las pilas (bajo costo, salida collapsed para flamegraphs)
+# "cprofile" usa cProfile (costo mayor, salida pstats)
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+# Segundos entre muestras del modo "sample"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", 20))
+
+# Perfil del turno en curso, se propaga a los hilos que copian el contexto
+current_profile = ContextVar("current_profile", default=None)
+
+
+# Función para nombrar un frame en la pila colapsada
+def frame_name(code) -> str:
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})".replace(";", ":")
+
+
+class RequestProfile:
+    """
+    Profile of one request. Only the threads inside a profile_stage
+    of the request are profiled, so the other sessions served by the
+    process do not show up. In "sample" mode a background thread
+    samples their stacks every interval seconds; in "cprofile" mode
+    each of them runs its own cProfile and the results are merged.
+    """
+
+    def __init__(self, mode: str = PROFILE_MODE, interval: float = PROFILE_INTERVAL):
+        self.mode = mode
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._profiles = []
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        if self.mode == "sample":
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self._start
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = dict(self._threads)
+            for ident, stage in threads.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join([stage] + stack[::-1])] += 1
+            self.samples += 1
+
+    @contextmanager
+    def thread_stage(self, stage: str):
+        """
+        Profile the current thread inside the block under the stage name.
+
+        Args:
+            stage: name of the stage
+        """
+        ident = threading.get_ident()
+        with self._lock:
+            previous = self._threads.get(ident)
+            # Las etapas anidadas quedan como frames raíz de la pila: request;agent;...
+            self._threads[ident] = f"{previous};{stage}" if previous else stage
+        # En modo cProfile solo el primer bloque del hilo crea su perfil
+        profile = None
+        if self.mode == "cprofile" and previous is None:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+            with self._lock:
+                if previous is None:
+                    self._threads.pop(ident, None)
+                else:
+                    self._threads[ident] = previous
+
+    def top(self, n: int = PROFILE_TOP) -> list[dict]:
+        """
+        Returns the n functions with the most self time.
+
+        Args:
+            n: number of functions
+        """
+        if self.mode == "cprofile":
+            if not self._profiles:
+                return []
+            stats = pstats.Stats(*self._profiles).stats
+            total = sum(values[2] for values in stats.values()) or 1.0
+            ranked = sorted(stats.items(), key=lambda item: -item[1][2])[:n]
+            return [
+                {
+                    "function": f"{func} ({Path(file).name}:{line})",
+                    "self_ms": round(values[2] * 1000, 1),
+                    "self_pct": round(100 * values[2] / total, 1),
+                    "calls": values[1]
+                }
+                for (file, line, func), values in ranked
+            ]
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [
+            {
+                "function": function,
+                "self_ms": round(count * self.interval * 1000, 1),
+                "self_pct": round(100 * count / total, 1),
+                "samples": count
+            }
+            for function, count in leaves.most_common(n)
+        ]
+
+    def save(self, output_dir: Path, name: str) -> list[Path]:
+        """
+        Write the profile (collapsed stacks or pstats) and its summary.
+        Returns the paths written.
+
+        Args:
+            output_dir: directory of the files
+            name: prefix of the files
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if self.mode == "cprofile":
+            profile_path = output_dir / f"{name}.pstats"
+            if self._profiles:
+                pstats.Stats(*self._profiles).dump_stats(profile_path)
+        else:
+            profile_path = output_dir / f"{name}.collapsed"
+            profile_path.write_text(
+                "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()), encoding="utf-8"
+            )
+        summary_path = output_dir / f"{name}_summary.json"
+        summary_path.write_text(json.dumps({
+            "mode": self.mode,
+            "elapsed_s": round(self.elapsed, 3),
+            "samples": self.samples,
+            "top_self_time": self.top()
+        }, ensure_ascii=False, indent=2), encoding="utf-8")
+        return [profile_path, summary_path]
+
+
+# Función para decidir si se perfila el turno
+def should_profile(requested: bool = False, sample_rate: float = PROFILE_SAMPLE_RATE) -> bool:
+    """
+    Returns True if the turn was explicitly requested to be profiled
+    (e.g. ?profile=1) or falls in the sample rate.
+
+    Args:
+        requested: profiling requested for the session
+        sample_rate: fraction of the turns profiled without request
+    """
+    return requested or (sample_rate > 0 and random.random() < sample_rate)
+
+
+# Contexto para perfilar un turno completo
+@contextmanager
+def profile_request(output_dir: Path, enabled: bool, name: str = "request"):
+    """
+    Profile the block and the profile_stage blocks it runs, and save
+    the profile with a summary of the top self-time functions in
+    output_dir. Does nothing if not enabled.
+
+    Args:
+        output_dir: directory of the profile files, next to the case artifacts
+        enabled: profile this request
+        name: name of the profiled block
+    """
+    if not enabled or current_profile.get() is not None:
+        yield
+        return
+    profile = RequestProfile()
+    token = current_profile.set(profile)
+    profile.start()
+    try:
+        with profile.thread_stage(name):
+            yield
+    finally:
+        profile.stop()
+        current_profile.reset(token)
+        try:
+            paths = profile.save(output_dir, f"profile_{time.strftime('%Y%m%d-%H%M%S')}_{name}")
+            top = ", ".join(f"{item['function']} {item['self_pct']}%" for item in profile.top(5))
+            logger.info(f"Profile of {name} saved in {paths[0]} ({profile.elapsed:.2f}s). Top self time: {top}")
+        except Exception as e:
+            logger.error(f"Error saving profile: {e}")
+
+
+# Contexto para perfilar una etapa, también en hilos de trabajo
+@contextmanager
+def profile_stage(stage: str):
+    """
+    Include the current thread in the profile of the request while
+    inside the block. Does nothing if the request is not profiled.
+
+    Args:
+        stage: name of the stage
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.thread_stage(stage):
+        yield
+
+
+# Decorador para perfilar una función, por ejemplo una herramienta del agente
+def profiled(stage: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,108 @@
+import logging
+import threading
+from functools import lru_cache
+
+from utils.cache import content_hash
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# A partir de esta sección el prompt solo tiene datos propios del caso
+CASE_MARKER = "<<Datos variables>>"
+
+
+# Función para obtener la versión del catálogo de tipologías
+@lru_cache(maxsize=8)
+def catalog_version(typo_list: str) -> str:
+    """
+    Returns a short hash identifying the typology catalog.
+
+    Args:
+        typo_list: rendered list of typologies
+    """
+    return content_hash(typo_list)[:16]
+
+
+# Función para separar la parte estática del prompt de la parte del caso
+@lru_cache(maxsize=8)
+def split_prompt(sys_prompt: str) -> tuple[str, str]:
+    """
+    Split a prompt template at CASE_MARKER.
+    Returns the static template and the per-case template.
+
+    Args:
+        sys_prompt: Base prompt of the agent
+    """
+    index = sys_prompt.find(CASE_MARKER)
+    if index < 0:
+        return sys_prompt, ""
+    return sys_prompt[:index], sys_prompt[index:]
+
+
+class PromptAssembler:
+    """
+    Builds the system prompt with the static content first, so
+    every case shares the same prefix for provider-side prompt
+    caching. The static block is rendered once per prompt and
+    catalog version and only the case variables are appended.
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._static = {}
+
+    def static_block(self, sys_prompt: str, typo_list: str) -> str:
+        """
+        Returns the rendered static block of the prompt.
+
+        Args:
+            sys_prompt: Base prompt of the agent
+            typo_list: List of typologies to chose
+        """
+        key = (sys_prompt, catalog_version(typo_list))
+        with self._lock:
+            block = self._static.get(key)
+            if block is not None:
+                self.hits += 1
+                return block
+            self.misses += 1
+        static_template, _ = split_prompt(sys_prompt)
+        block = static_template.format(typo_list=typo_list)
+        with self._lock:
+            if len(self._static) >= self.max_entries:
+                self._static.pop(next(iter(self._static)))
+            self._static[key] = block
+        logger.info(f"Static prompt rendered for catalog {key[1]}")
+        return block
+
+    def build(self, sys_prompt: str, typo_list: str, today: str, file_name: str = "") -> str:
+        """
+        Returns the full system prompt for a case.
+
+        Args:
+            sys_prompt: Base prompt of the agent
+            typo_list: List of typologies to chose
+            today: today's date
+            file_name: name of the case document
+        """
+        _, case_template = split_prompt(sys_prompt)
+        return self.static_block(sys_prompt, typo_list) + case_template.format(today=today, file_name=file_name)
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters of the static block memo.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0
+        }
+
+
+prompt_assembler = PromptAssembler()
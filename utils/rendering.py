@@ -0,0 +1,261 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import zipfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable
+from xml.sax.saxutils import escape
+
+from fontTools import subset
+from fontTools.ttLib import TTFont
+from fpdf import FPDF
+from PIL import Image
+
+from utils.cache import CACHE_PATH
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+# fontTools escribe varias líneas INFO y WARNING por cada fuente que fpdf embebe en un documento
+logging.getLogger("fontTools").setLevel(logging.ERROR)
+
+# La fuente se recorta una vez por proceso a los caracteres que producen el OCR y la anonimización
+RENDER_FONT_SUBSET = os.getenv("RENDER_FONT_SUBSET", "true").lower() == "true"
+# Rangos Unicode del recorte: latín y sus extensiones, diacríticos, puntuación, monedas, símbolos y flechas
+RENDER_FONT_RANGES = (
+    (0x0020, 0x007E), (0x00A0, 0x036F), (0x1E00, 0x1EFF), (0x2000, 0x21FF), (0x25A0, 0x25FF), (0xFFFD, 0xFFFD)
+)
+# Tablas que fpdf descarta al embeber la fuente, en el recorte se descartan de una vez
+RENDER_FONT_DROP_TABLES = [
+    "FFTM", "GDEF", "GPOS", "GSUB", "MATH", "hdmx", "meta", "sbix", "CBDT", "CBLC", "EBDT", "EBLC", "EBSC",
+    "SVG ", "CPAL", "COLR", "TTFA"
+]
+RENDER_FONT_FAMILY = "Noto"
+FONTS_CACHE_PATH = CACHE_PATH / "fonts"
+# Caracteres que no admite el XML de un docx
+DOCX_INVALID_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+DOCX_BREAKS = re.compile(r"[\r\n\t]")
+
+
+# Función para obtener la fuente recortada de una fuente
+@lru_cache(maxsize=8)
+def render_font(font_path: Path) -> Path:
+    """
+    Subset the font once (per process, and per font file in the cache
+    folder) to RENDER_FONT_RANGES without the tables fpdf drops, so
+    each document parses and embeds a small font.
+    Returns the path of the subset, font_path if subsetting is
+    disabled or fails.
+
+    Args:
+        font_path: Local path of the font
+    """
+    font_path = Path(font_path)
+    if not RENDER_FONT_SUBSET:
+        return font_path
+    data = font_path.read_bytes()
+    key = hashlib.sha256(data + repr((RENDER_FONT_RANGES, RENDER_FONT_DROP_TABLES)).encode("utf-8")).hexdigest()[:16]
+    subset_path = FONTS_CACHE_PATH / f"{font_path.stem}-{key}.ttf"
+    if subset_path.exists():
+        return subset_path
+    try:
+        options = subset.Options(notdef_outline=True, recommended_glyphs=True)
+        options.drop_tables += RENDER_FONT_DROP_TABLES
+        font = TTFont(io.BytesIO(data), recalcTimestamp=False)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=[code for start, end in RENDER_FONT_RANGES for code in range(start, end + 1)])
+        subsetter.subset(font)
+        FONTS_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+        # Se escribe aparte y se reemplaza para que otro proceso no lea una fuente a medias
+        temp_path = subset_path.with_name(f"{subset_path.stem}.{os.getpid()}.tmp")
+        font.save(temp_path)
+        os.replace(temp_path, subset_path)
+    except Exception as e:
+        logger.error(f"Error while subsetting font {font_path.name}, using the full font: {e}")
+        return font_path
+    logger.info(f"Font subset {subset_path.name}: {len(data)} -> {subset_path.stat().st_size} bytes")
+    return subset_path
+
+
+# Función para crear un PDF con la fuente y el estilo de los documentos
+def new_pdf(font_path: Path, font_size: int = 12) -> FPDF:
+    """
+    Returns an empty FPDF with one page, the subset font selected and
+    automatic page breaks.
+
+    Args:
+        font_path: Local path of the font
+        font_size: Font size in points
+    """
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.add_font(RENDER_FONT_FAMILY, "", render_font(font_path))
+    pdf.set_font(RENDER_FONT_FAMILY, size=font_size)
+    pdf.set_auto_page_break(auto=True, margin=15)
+    return pdf
+
+
+# Función para partir una línea en las líneas que caben en el ancho
+def wrap_line(line: str, max_width: float, word_width: Callable[[str], float], space_width: float) -> list[str]:
+    """
+    Greedy word wrap, like fpdf's multi_cell: lines break at spaces
+    and words wider than the line are split by characters.
+    Returns the wrapped lines, [""] for an empty line.
+
+    Args:
+        line: Text without newlines
+        max_width: Width available for the text
+        word_width: Width of a string
+        space_width: Width of a space
+    """
+    lines = []
+    current = None
+    current_width = 0.0
+    for word in line.split(" "):
+        width = word_width(word)
+        if current is not None and current_width + space_width + width <= max_width:
+            current += " " + word
+            current_width += space_width + width
+            continue
+        if current is not None:
+            lines.append(current)
+        while width > max_width:
+            cut = 1
+            while cut < len(word) and word_width(word[:cut + 1]) <= max_width:
+                cut += 1
+            lines.append(word[:cut])
+            word = word[cut:]
+            width = word_width(word)
+        current, current_width = word, width
+    lines.append(current)
+    return lines
+
+
+# Función para escribir un bloque de texto en el PDF
+def write_text(pdf: FPDF, text: str, line_height: float = 10):
+    """
+    Lay out a whole block of text (e.g. a source page) at once: the
+    lines are wrapped with the character widths of the current font,
+    each word measured once, and written as single cells, instead of
+    one multi_cell per line re-measuring the line at each character.
+
+    Args:
+        pdf: Document with the font selected
+        text: Text, lines separated by newlines
+        line_height: Height of each line
+    """
+    font = pdf.current_font
+    scale = pdf.font_size_pt * 0.001 / pdf.k
+    max_width = pdf.epw - 2 * pdf.c_margin
+    widths = {}
+
+    def word_width(word: str) -> float:
+        if word not in widths:
+            widths[word] = sum(font.cw[ord(char)] for char in word) * scale
+        return widths[word]
+
+    space_width = word_width(" ")
+    for line in text.split("\n"):
+        for wrapped in wrap_line(line, max_width, word_width, space_width):
+            pdf.cell(0, line_height, wrapped, new_x="LMARGIN", new_y="NEXT")
+
+
+# Función para dibujar una imagen en la página actual del PDF
+def write_image(pdf: FPDF, image: Image):
+    """
+    Draw the image centered on the current page, as large as the page
+    allows keeping its aspect ratio, compressed as JPEG.
+
+    Args:
+        pdf: Document with the page added
+        image: Image of a whole page
+    """
+    scale = min(pdf.w / image.width, pdf.h / image.height)
+    width, height = image.width * scale, image.height * scale
+    pdf.set_image_filter("DCTDecode")
+    pdf.image(image, x=(pdf.w - width) / 2, y=(pdf.h - height) / 2, w=width, h=height)
+
+
+# Función para escribir un valor en el texto de un docx
+def docx_text(value: str) -> str:
+    """
+    Returns the value as the XML of a run text, with newlines and
+    tabs as breaks, like python-docx's run.text.
+
+    Args:
+        value: Text of the field
+    """
+    value = escape(DOCX_INVALID_CHARS.sub("", str(value)))
+    return DOCX_BREAKS.sub(
+        lambda match: '</w:t><w:tab/><w:t xml:space="preserve">' if match.group(0) == "\t"
+        else '</w:t><w:br/><w:t xml:space="preserve">',
+        value
+    )
+
+
+class DocxTemplate:
+    """
+    Docx built once per process with python-docx, with a marker in
+    each variable field. render copies the parts of the package and
+    swaps the markers of the document XML for the values, so styles,
+    numbering and paragraphs are not rebuilt on every call.
+    """
+
+    def __init__(self, build: Callable[..., bytes], fields: tuple[str, ...]):
+        self.build = build
+        self.fields = fields
+        self._parts = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def marker(field: str) -> str:
+        return "{{" + field + "}}"
+
+    def parts(self) -> list[tuple[zipfile.ZipInfo, bytes]]:
+        """
+        Returns the parts of the template package, building it on the
+        first call. None if a marker is missing (the builder failed).
+        """
+        with self._lock:
+            if self._parts is None:
+                data = self.build(**{field: self.marker(field) for field in self.fields})
+                with zipfile.ZipFile(io.BytesIO(data)) as package:
+                    parts = [(info, package.read(info)) for info in package.infolist()]
+                xml = next(content.decode("utf-8") for info, content in parts if info.filename == "word/document.xml")
+                if all(self.marker(field) in xml for field in self.fields):
+                    # El texto de los campos conserva los espacios del inicio y el final
+                    xml = re.sub(r"<w:t>(?=[^<]*\{\{)", '<w:t xml:space="preserve">', xml)
+                    self._parts = [
+                        (info, xml.encode("utf-8") if info.filename == "word/document.xml" else content)
+                        for info, content in parts
+                    ]
+                else:
+                    logger.error("Docx template without all its markers, documents are built from scratch")
+                    self._parts = []
+            return self._parts or None
+
+    def render(self, **values) -> bytes:
+        """
+        Returns the docx bytes with the values in their fields.
+
+        Args:
+            values: Text of each field
+        """
+        parts = self.parts()
+        if parts is None:
+            return self.build(**values)
+        pattern = re.compile("|".join(re.escape(self.marker(field)) for field in self.fields))
+        texts = {self.marker(field): docx_text(values[field]) for field in self.fields}
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as package:
+            for info, content in parts:
+                if info.filename == "word/document.xml":
+                    # Una sola pasada: un valor que contenga un marcador no se reemplaza de nuevo
+                    content = pattern.sub(lambda match: texts[match.group(0)], content.decode("utf-8")).encode("utf-8")
+                package.writestr(info, content)
+        return buffer.getvalue()
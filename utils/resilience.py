@@ -0,0 +1,220 @@
+import contextvars
+import logging
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Callable
+
+import httpx
+import requests
+
+from utils.cancellation import check_cancelled, current_token
+from utils.governor import AdmissionTimeout, governor
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Parámetros de resiliencia del transporte hacia el API Gateway
+GATEWAY_TIMEOUT = float(os.getenv("GATEWAY_TIMEOUT", 120))
+GATEWAY_MAX_RETRIES = int(os.getenv("GATEWAY_MAX_RETRIES", 4))
+GATEWAY_BACKOFF_BASE = float(os.getenv("GATEWAY_BACKOFF_BASE", 0.5))
+GATEWAY_BACKOFF_MAX = float(os.getenv("GATEWAY_BACKOFF_MAX", 20))
+# Segundos de espera antes de lanzar una petición duplicada (0 = desactivado)
+GATEWAY_HEDGE_AFTER = float(os.getenv("GATEWAY_HEDGE_AFTER", 0))
+RETRY_STATUS = {429, 502, 503, 504}
+# Cada cuánto revisa una llamada en curso si su trabajo fue cancelado
+CANCEL_POLL_INTERVAL = 0.1
+
+# Momento límite (time.monotonic) del turno en curso
+_deadline = contextvars.ContextVar("deadline", default=None)
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+_call_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="gateway")
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """
+    Raised when the turn deadline runs out before the gateway answers.
+    """
+
+    def __init__(self, message: str = "Turn deadline exceeded"):
+        super().__init__(message)
+
+
+@contextmanager
+def deadline(seconds: float):
+    """
+    Set a deadline for every gateway call made inside the block.
+    Nested deadlines can only shorten the outer one.
+
+    Args:
+        seconds: time budget of the block
+    """
+    limit = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        limit = min(limit, outer)
+    token = _deadline.set(limit)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+# Función para obtener el tiempo restante del turno
+def remaining_time() -> float:
+    """
+    Returns the seconds left before the current deadline,
+    or None if there is no deadline.
+    """
+    limit = _deadline.get()
+    if limit is None:
+        return None
+    return limit - time.monotonic()
+
+
+# Función para calcular la espera entre reintentos
+def backoff_delay(attempt: int, retry_after: str = None) -> float:
+    """
+    Exponential backoff with full jitter. Honors Retry-After
+    when the gateway sends it in seconds.
+    Returns the seconds to wait.
+
+    Args:
+        attempt: number of the failed attempt starting at 0
+        retry_after: value of the Retry-After header
+    """
+    if retry_after:
+        try:
+            return min(float(retry_after), GATEWAY_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(GATEWAY_BACKOFF_MAX, GATEWAY_BACKOFF_BASE * 2 ** attempt))
+
+
+def _call_timeout() -> float:
+    remaining = remaining_time()
+    if remaining is None:
+        return GATEWAY_TIMEOUT
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return min(GATEWAY_TIMEOUT, remaining)
+
+
+def _hedged_call(send: Callable, timeout: float, hedge_after: float) -> requests.Response:
+    context = contextvars.copy_context()
+    futures = [_hedge_pool.submit(context.copy().run, send, timeout)]
+    done, _ = wait(futures, timeout=min(hedge_after, timeout))
+    if not done:
+        logger.info(f"Gateway slower than {hedge_after}s, sending hedged request")
+        futures.append(_hedge_pool.submit(context.copy().run, send, max(timeout - hedge_after, 0.001)))
+    pending = set(futures)
+    error = None
+    # Devolvemos la primera respuesta exitosa, la otra se descarta
+    while pending:
+        done, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+        check_cancelled("gateway", skipped=1)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+# Función para llamar al API Gateway sin bloquear la cancelación del trabajo
+def _cancellable_call(send: Callable, timeout: float) -> requests.Response:
+    """
+    Run the request in a worker thread and wait for it checking the
+    cancellation token, so a superseded job stops within
+    CANCEL_POLL_INTERVAL instead of waiting for the gateway answer.
+    The abandoned request ends on its own timeout.
+    """
+    future = _call_pool.submit(contextvars.copy_context().run, send, timeout)
+    while True:
+        done, _ = wait([future], timeout=CANCEL_POLL_INTERVAL)
+        if done:
+            return future.result()
+        check_cancelled("gateway", skipped=1)
+
+
+# Función para hacer un intento con un cupo del modelo en el API Gateway
+def _admitted_attempt(send: Callable, model: str, idempotent: bool, hedge_after: float) -> requests.Response:
+    """
+    Wait for a slot of the model in the concurrency governor (at most
+    until the turn deadline) and perform one attempt, hedged or not.
+    The timeout of the attempt is computed once admitted, so the time
+    in the queue is not charged to the request.
+    """
+    try:
+        governor.acquire(model, max_wait=remaining_time())
+    except AdmissionTimeout as e:
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded() from e
+        raise
+    try:
+        timeout = _call_timeout()
+        if idempotent and hedge_after > 0:
+            return _hedged_call(send, timeout, hedge_after)
+        if current_token.get() is not None:
+            return _cancellable_call(send, timeout)
+        return send(timeout)
+    finally:
+        governor.release(model)
+
+
+# Función para llamar al API Gateway con deadline, reintentos y hedging
+def resilient_call(
+        send: Callable[[float], requests.Response],
+        idempotent: bool = True,
+        max_retries: int = GATEWAY_MAX_RETRIES,
+        hedge_after: float = GATEWAY_HEDGE_AFTER,
+        model: str = "default"
+) -> requests.Response:
+    """
+    Call the gateway bounding each attempt by the turn deadline,
+    retrying throttling and transient errors with backoff and
+    optionally hedging slow idempotent calls.
+    Returns the last gateway response.
+
+    Args:
+        send: function that receives a timeout and performs the request
+        idempotent: whether a duplicate request is safe
+        max_retries: maximum number of retries
+        hedge_after: seconds before sending a duplicate request, 0 disables it
+        model: model called, for its limits in the concurrency governor
+    """
+    attempt = 0
+    while True:
+        check_cancelled("gateway", skipped=1)
+        try:
+            response = _admitted_attempt(send, model, idempotent, hedge_after)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded() from e
+            if attempt >= max_retries:
+                raise
+            logger.error(f"Gateway error on attempt {attempt + 1}: {e}")
+            response = None
+        if response is not None and (response.status_code not in RETRY_STATUS or attempt >= max_retries):
+            return response
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        delay = backoff_delay(attempt, retry_after)
+        remaining = remaining_time()
+        # Si la espera supera el tiempo restante no tiene sentido reintentar
+        if remaining is not None and delay >= remaining:
+            if response is not None:
+                return response
+            raise DeadlineExceeded()
+        status = response.status_code if response is not None else "error"
+        logger.info(f"Gateway returned {status}, retrying in {delay:.2f}s")
+        token = current_token.get()
+        if token is not None:
+            token.wait(delay)
+        else:
+            time.sleep(delay)
+        attempt += 1
@@ -1,58 +1,107 @@
+import json
 import logging
 import os
 from datetime import datetime
 from pathlib import Path
+from typing import Callable
 import unicodedata
 
+from langchain_core.messages import messages_from_dict, messages_to_dict
 from langgraph.checkpoint.memory import InMemorySaver
 from langgraph.graph import StateGraph
 
-from utils.functions import encrypt_document, doc_to_base64
+from utils.analysis import message_analysis, render_analysis
+from utils.cache import AnalysisCache, content_hash
+from utils.classifier import PRECLASSIFY_THRESHOLD, TypologyClassifier, justification_prompt, render_proposal
+from utils.functions import anonymize_documents, build_hybrid_payload, redaction_policy, sources_digest
+from utils.logs import setup_logging, timed_stage
+from utils.ocr_cache import PageOCRCache
+from utils.prefetch import SpeculativePrefetcher, dossier_messages
+from utils.profiling import profile_stage
+from utils.prompt_assembly import catalog_version, prompt_assembler
+from utils.resilience import DeadlineExceeded, deadline
+from utils.shared_cache import SharedCache, artifacts_key, pack_artifacts, unpack_artifacts
+from utils.workspace import SessionWorkspace, use_workspace
 
 
 # Variables para utilizar la encriptación de PQRS
 POPPLER_PATH = r'C:\Users\O014796\AppData\Local\Programs\poppler-25.07.0\Library\bin'
 TESSERACT_PATH = r'C:\Users\O014796\AppData\Local\Programs\Tesseract-OCR\tesseract.exe'
 
+# Tiempo máximo de un turno del agente en segundos
+TURN_TIMEOUT = float(os.getenv("TURN_TIMEOUT", 180))
+
 MAIN_PATH = Path(os.getcwd())
 DATA_PATH = MAIN_PATH / "data"
 FONT_PATH = MAIN_PATH / "fonts" / "noto-sans-regular.ttf"
 
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
+# Función para validar si la conversación ya existe en memoria
+def thread_exists(memory: InMemorySaver, thread_id: str) -> bool:
+    """
+    Returns True if the thread already has messages in memory.
+
+    Args:
+        memory: Agent checkpointer
+        thread_id: Unique id for conversation memory
+    """
+    try:
+        len(memory.get({"configurable": {"thread_id": thread_id}})["channel_values"]["messages"])
+        return True
+    except Exception:
+        return False
+
+
 # Función para obtener respuesta del agente
 def get_agent_response(
         thread_id: str,
         typo_list: str,
         sys_prompt: str,
-        cases_path: Path,
         memory: InMemorySaver,
         agent: StateGraph,
         user_input: str = None,
-        doc_path: Path = None
-) -> str:
+        documents: list[tuple[str, bytes]] = None,
+        workspace: SessionWorkspace = None,
+        model_id: str = "",
+        analysis_cache: AnalysisCache = None,
+        turn_timeout: float = TURN_TIMEOUT,
+        classifier: TypologyClassifier = None,
+        prefetcher: SpeculativePrefetcher = None,
+        shared_cache: SharedCache = None,
+        ocr_cache: PageOCRCache = None,
+        on_proposal: Callable[[str], None] = None
+) -> tuple[str, str]:
     
     """
     It has all the steps of the agent.
+    Returns the response (or the error message) and the case name.
 
     Args:
         user_input: String message for the user
         thread_id: Unique id for conversation memory
         typo_list: List of typologies to chose
         sys_prompt: Base prompt of the agent
-        doc_path: Local path for the document to analize
+        documents: (file name, file bytes) of the document to analize and its annexes
+        workspace: Workspace of the analyst session, in memory by default
+        model_id: Id of the model behind the agent, part of the cache key
+        analysis_cache: Optional cache for the first analysis of a document
+        turn_timeout: Deadline in seconds shared by all the gateway calls of the turn
+        classifier: Optional local pre-classifier for the first analysis
+        prefetcher: Optional prefetcher of the typologies proposed in the first analysis
+        shared_cache: Optional cache of the case artifacts shared by the server processes
+        ocr_cache: Optional cache of the anonymized pages recurring across cases
+        on_proposal: Optional callback that shows the markdown of the pre-classifier proposal before the model call
     """
+    # Solo el primer análisis con el mensaje por defecto es determinista
+    # y por lo tanto puede servirse desde la cache
+    default_input = not user_input
+    workspace = workspace or SessionWorkspace()
+    cache_key = None
+    proposal = None
     # En caso de que no haya mensaje
     # Se utiliza el mensaje por defecto
     if not user_input:
@@ -61,52 +110,25 @@ def get_agent_response(
     case_name = ""
     # Respuesta predefinida para errores
     error_response = "Lo lamento. No puedo ayudarte en este momento. Intenta de nuevo más tarde."
+    timeout_response = "Lo lamento. El servicio está tardando más de lo normal en responder. Intenta de nuevo en unos minutos."
+    throttled_response = "Lo lamento. El servicio está recibiendo muchas solicitudes en este momento. Intenta de nuevo en unos minutos."
     # Obtenemos la fecha de hoy
     today = datetime.today().strftime("%Y-%m-%d")
     logger.info(f"In use date: {today}")
-    # Este es el prompt general
-    system_msg = sys_prompt.format(typo_list=typo_list, today=today, file_name="")
     # Si existe un documento cargado debemos leerlo
     # Leerlo implica extraer la información en base64
     # Para que LLM lo entienda
     # Si el usuario carga un documento
     # Entonces lo que hay que hacer es extraerle la información en base64
-    if doc_path:
+    if documents:
         logger.info(f"Document loaded")
-        # Creamos el directorio del caso
-        case_name = doc_path.stem
-        case_path = cases_path / case_name
-        case_path.mkdir(exist_ok=True)
-        encrypted_path = case_path / f"{case_name}_encrypted.pdf"
-        # Agregamos el nombre del archivo para la salida de la plantilla
-        system_msg = sys_prompt.format(typo_list=typo_list, today=today, file_name=case_name)
-        # Realizamos la encriptación
-        # Si y solo si no se ha hecho antes
-        if not os.path.exists(encrypted_path):
-            try:
-                encrypt_document(
-                    doc_path=doc_path,
-                    output_path=encrypted_path,
-                    poppler_path=POPPLER_PATH,
-                    tesseract_path=TESSERACT_PATH,
-                    font_path=FONT_PATH
-                )
-            except Exception as e:
-                return error_response
-        else:
-            logger.info(f"Encryption already done")
+        # El caso es la carta más sus anexos y se nombra por la carta
+        case_name = Path(documents[0][0]).stem
         # Listo ya tenemos nuestro documento encriptado
-        # Es hora de convertirlo a base64 para que el agente lo utilice
-        try:
-            base64_pages = doc_to_base64(encrypted_path)
-        except Exception as e:
-            logger.error(f"Error in base64 conversion: {e}")
-            return error_response
-        # Creamos el input_message utilizando las imagenes como referencia
+        # Creamos el input_message utilizando el documento como referencia
         # Si la conversación ya existe no tengo necesidad de volver a enviar el documento
         # El agente ya lo tiene en su memoria
-        try:
-            len(memory.get({"configurable": {"thread_id": thread_id}})["channel_values"]["messages"])
+        if thread_exists(memory, thread_id):
             logger.info("Thread exists")
             input_message = {
                 "role": "user",
@@ -115,15 +137,93 @@ def get_agent_response(
                     "text": user_input}
                 ]
             }
-        except Exception as e:
+        else:
             logger.error("Thread does not exists")
+            # Realizamos la encriptación en memoria
+            # Si y solo si no se ha hecho antes con estos mismos archivos
+            # Si se cargaron con cambios solo se procesan las páginas nuevas
+            # Con un cache compartido cada documento se procesa una sola vez entre todos los procesos
+            sources = sources_digest(documents)
+            artifacts = workspace.get_case(case_name, sources)
+            # El pipeline de páginas deja listo el payload del caso que calcula este proceso
+            payload = None
+            if artifacts is None or artifacts["sources"] != sources:
+                page_index = artifacts["index"] if artifacts else None
+                computed = {}
+                def anonymize() -> dict:
+                    with timed_stage(logger, "anonymize"):
+                        result = anonymize_documents(
+                            documents=documents,
+                            poppler_path=POPPLER_PATH,
+                            tesseract_path=TESSERACT_PATH,
+                            font_path=FONT_PATH,
+                            page_index=page_index,
+                            ocr_cache=ocr_cache
+                        )
+                    if result is not None:
+                        computed["payload"] = result.pop("payload", None)
+                    return result
+                def anonymize_packed() -> bytes:
+                    result = anonymize()
+                    return pack_artifacts(result) if result else None
+                if shared_cache is not None:
+                    try:
+                        packed = shared_cache.get_or_compute(artifacts_key(sources, redaction_policy()), anonymize_packed)
+                        artifacts = unpack_artifacts(packed) if packed else None
+                    except Exception as e:
+                        logger.error(f"Error using shared cache: {e}")
+                        artifacts = anonymize()
+                else:
+                    artifacts = anonymize()
+                if artifacts is None:
+                    return error_response, case_name
+                payload = computed.get("payload")
+                workspace.put_case(case_name, artifacts)
+            else:
+                logger.info(f"Encryption already done")
+            # Es hora de convertirlo para que el agente lo utilice
+            # Texto anonimizado para las páginas limpias e imágenes para las débiles
+            try:
+                if payload is not None:
+                    document_blocks = payload
+                else:
+                    with timed_stage(logger, "payload"), profile_stage("payload"):
+                        document_blocks = build_hybrid_payload(artifacts["pdf"], artifacts["pages"], name=case_name)
+            except Exception as e:
+                logger.error(f"Error building document payload: {e}")
+                return error_response, case_name
+            # Si el clasificador local está seguro mostramos su propuesta
+            # y el LLM solo escribe el resumen y la justificación
+            if classifier is not None and default_input:
+                try:
+                    pages = artifacts["pages"]
+                    if pages:
+                        predictions = classifier.predict("\n".join(page["text"] for page in pages), k=3)
+                        logger.info(f"Pre-classifier proposal: {predictions}")
+                        if predictions[0]["confidence"] >= PRECLASSIFY_THRESHOLD:
+                            proposal = predictions
+                            user_input = justification_prompt(predictions)
+                            # El analista ve la propuesta mientras el LLM escribe la justificación
+                            if on_proposal is not None:
+                                on_proposal(render_proposal(proposal))
+                except Exception as e:
+                    logger.error(f"Error in pre-classifier: {e}")
             input_message = {
                 "role": "user",
                 "content": [
                     {"type": "text",
                     "text": user_input}
-                ] + base64_pages
+                ] + document_blocks
             }
+            # La llave depende del contenido anonimizado, del prompt,
+            # del catálogo de tipologías y del modelo
+            if analysis_cache is not None and default_input:
+                cache_key = AnalysisCache.make_key(
+                    content=content_hash(user_input, *[block.get("data") or block.get("text") for block in document_blocks]),
+                    prompt_version=content_hash(sys_prompt),
+                    catalog_version=catalog_version(typo_list),
+                    model_id=model_id
+                )
     # Si no hay ningun documento cargado el mensaje que le enviamos
     # Es basicamente solamente el texto que escribe el usuario
     else:
@@ -137,20 +237,22 @@ def get_agent_response(
         }
     # Ahora creamos el mensaje para enviar
     # Validamos si ya existe la conversación en memoria
-    try:
+    if thread_exists(memory, thread_id):
         # Si existe existe quiere decir que no es la primera conversación
         # Por lo tanto debo enviarle el prompt del sistema
-        len(memory.get({"configurable": {"thread_id": thread_id}})["channel_values"]["messages"])
         logger.info("Thread exists")
         messages = {
             "messages": [
                 input_message
             ]
         }
-    except Exception as e:
+    else:
         # De lo contrario si existe
         # Entonces ya no hace falta enviarle el system_prompt
         logger.error("Thread does not exists")
+        # Este es el prompt general con el nombre del archivo para la salida de la plantilla
+        # La parte estática va primero para aprovechar la cache de prompts del proveedor
+        system_msg = prompt_assembler.build(sys_prompt, typo_list, today=today, file_name=case_name)
         messages = {
             "messages": [
                 {"role": "system", "content": system_msg},
@@ -159,14 +261,72 @@ def get_agent_response(
         }
     # Esta es la sesion
     config = {"configurable": {"thread_id": thread_id}}
+    prefetch_key = SpeculativePrefetcher.make_key(workspace.session_id, thread_id)
+    # Si el análisis ya está en cache lo cargamos en la memoria del agente
+    # así las preguntas siguientes continúan la conversación sin llamar al LLM
+    if cache_key:
+        cached = analysis_cache.get(cache_key)
+        if cached:
+            try:
+                agent.update_state(
+                    config,
+                    {"messages": messages["messages"] + messages_from_dict(cached["messages"])},
+                    as_node="chatbot"
+                )
+                if prefetcher is not None:
+                    prefetcher.start(prefetch_key, cached["response"], today, proposal)
+                return cached["response"], case_name
+            except Exception as e:
+                logger.error(f"Error loading cached analysis: {e}")
+    # Si el analista eligió una de las tipologías precalculadas el dossier
+    # entra como resultado de la herramienta y el agente no tiene que pedirlo
+    graph_input = messages
+    if prefetcher is not None and not default_input:
+        dossier = prefetcher.dossier_for(prefetch_key, user_input)
+        if dossier is not None:
+            try:
+                agent.update_state(config, {"messages": messages["messages"] + dossier_messages(dossier)}, as_node="tools")
+                graph_input = None
+            except Exception as e:
+                logger.error(f"Error loading prefetched dossier: {e}")
     # Una vez tenemos el input del mensaje
     # Ya podemos enviarlo al agente
     try:
-        result = agent.invoke(messages, config=config)
+        with deadline(turn_timeout), use_workspace(workspace), timed_stage(logger, "agent"), profile_stage("agent"):
+            result = agent.invoke(graph_input, config=config)
         response = result["messages"][-1].content
         logger.info("Main agent response succesful")
     except Exception as e:
         logger.error(f"Error getting main response: {e}")
-        return error_response
+        # El cliente de OpenAI envuelve las excepciones del transporte
+        if isinstance(e, DeadlineExceeded) or isinstance(e.__cause__, DeadlineExceeded):
+            return timeout_response, case_name
+        if getattr(e, "status_code", None) == 429:
+            return throttled_response, case_name
+        return error_response, case_name
+    # El análisis tipado ya trae las tipologías, se arma de nuevo con la confianza del clasificador
+    analysis = message_analysis(result["messages"][-1])
+    if analysis:
+        if proposal:
+            response = render_analysis(analysis, proposal)
+        # Queda con el caso para las herramientas y otros procesos
+        try:
+            workspace.save_file(case_name, "analisis.json", json.dumps(analysis, ensure_ascii=False).encode("utf-8"))
+        except Exception as e:
+            logger.error(f"Error saving structured analysis: {e}")
+    elif proposal:
+        response = render_proposal(proposal) + "\n\n" + response
+    # Mientras el analista lee el análisis se precalculan las tipologías propuestas
+    if prefetcher is not None and default_input and documents:
+        prefetcher.start(prefetch_key, response, today, proposal or (analysis or {}).get("typologies"))
+    # Guardamos la respuesta y los resultados de las herramientas
+    if cache_key:
+        try:
+            analysis_cache.set(cache_key, {
+                "response": response,
+                "messages": messages_to_dict(result["messages"][len(messages["messages"]):])
+            })
+        except Exception as e:
+            logger.error(f"Error storing analysis in cache: {e}")
 
     return response, case_name
\ No newline at end of file
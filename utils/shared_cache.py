@@ -0,0 +1,443 @@
+"""
+Artifact cache shared by the server processes.
+
+The backend is chosen with SHARED_CACHE_URL:
+    file:///path/to/dir   local directory with file locks and a SQLite index (default)
+    memory://             in-process stand-in of an external store, for tests
+    redis://host:6379/0   Redis, requires the redis package
+"""
+import json
+import logging
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+
+from utils.cache import CACHE_PATH, content_hash
+from utils.logs import setup_logging
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+SHARED_CACHE_URL = os.getenv("SHARED_CACHE_URL", "")
+# Vigencia y tamaño máximo del cache compartido
+SHARED_CACHE_TTL = int(os.getenv("SHARED_CACHE_TTL", 7 * 24 * 3600))
+SHARED_CACHE_MAX_MB = float(os.getenv("SHARED_CACHE_MAX_MB", 2048))
+# Segundos que se espera a que otro proceso termine el mismo trabajo antes de hacerlo en paralelo
+SHARED_CACHE_LOCK_TIMEOUT = float(os.getenv("SHARED_CACHE_LOCK_TIMEOUT", 300))
+LOCK_POLL_INTERVAL = 0.1
+
+
+class SharedCache(ABC):
+    """
+    Interface of the shared cache: bytes by key plus a lock per key
+    that holds across processes. get_or_compute builds on both to
+    compute each key once (single flight): concurrent callers wait
+    for the one doing the work and read its result.
+    """
+
+    def __init__(self, lock_timeout: float = SHARED_CACHE_LOCK_TIMEOUT):
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self._stats_lock = threading.Lock()
+        # Un lock del proceso por llave en uso, así los hilos no sondean el lock del backend
+        # y una llave no espera por el cálculo de otra
+        self._local_locks = {}
+        self._local_guard = threading.Lock()
+
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        """
+        Returns the value of the key, None if it is missing or expired.
+        """
+
+    @abstractmethod
+    def put(self, key: str, value: bytes) -> None:
+        """
+        Store the value of the key.
+        """
+
+    @abstractmethod
+    def acquire(self, key: str, timeout: float):
+        """
+        Returns a handle of the lock of the key for release, None if
+        it was not acquired within timeout seconds.
+        """
+
+    @abstractmethod
+    def release(self, key: str, handle) -> None:
+        """
+        Release the lock of the key taken by acquire.
+        """
+
+    @contextmanager
+    def lock(self, key: str):
+        """
+        Hold the lock of the key across threads and processes.
+        Yields False if it could not be acquired within lock_timeout.
+
+        Args:
+            key: key of the entry
+        """
+        # El guard se toma solo para obtener el lock de la llave, nunca mientras se calcula
+        with self._local_guard:
+            entry = self._local_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            start = time.monotonic()
+            if not entry[0].acquire(timeout=self.lock_timeout):
+                yield False
+                return
+            try:
+                handle = self.acquire(key, max(self.lock_timeout - (time.monotonic() - start), 0.0))
+                try:
+                    yield handle is not None
+                finally:
+                    if handle is not None:
+                        self.release(key, handle)
+            finally:
+                entry[0].release()
+        finally:
+            with self._local_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._local_locks[key]
+
+    def _count(self, counter: str) -> None:
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_or_compute(self, key: str, compute) -> bytes:
+        """
+        Returns the cached value of the key or computes it once while
+        holding its lock. A None result is returned but not stored.
+
+        Args:
+            key: key of the entry
+            compute: function without arguments that returns the bytes
+        """
+        value = self.get(key)
+        if value is not None:
+            self._count("hits")
+            return value
+        start = time.perf_counter()
+        with self.lock(key) as locked:
+            if not locked:
+                logger.warning(f"Shared cache lock timeout, computing without lock: {key[:12]}")
+            # Otro proceso o hilo pudo calcularlo mientras esperábamos
+            value = self.get(key)
+            if value is not None:
+                self._count("waits")
+                logger.info(
+                    f"Shared cache hit after waiting {time.perf_counter() - start:.2f}s: {key[:12]}",
+                    extra={"cache_key": key[:12]}
+                )
+                return value
+            self._count("misses")
+            value = compute()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def stats(self) -> dict:
+        """
+        Returns hits, misses (computed here) and waits (computed by a
+        concurrent caller and read after waiting for its lock).
+        """
+        with self._stats_lock:
+            return {"backend": type(self).__name__, "hits": self.hits, "misses": self.misses, "waits": self.waits}
+
+
+class LocalSharedCache(SharedCache):
+    """
+    Shared cache in a local directory for the processes of one host.
+    Each entry is a file written atomically and indexed in SQLite
+    with TTL and LRU eviction by total size. The lock of a key is an
+    OS file lock on root/locks/<key>.lock, released by the OS if the
+    process dies, and its file is deleted with the entry.
+    """
+
+    def __init__(
+            self,
+            root: Path = CACHE_PATH / "shared",
+            ttl: int = SHARED_CACHE_TTL,
+            max_bytes: int = int(SHARED_CACHE_MAX_MB * 1024 * 1024),
+            lock_timeout: float = SHARED_CACHE_LOCK_TIMEOUT
+    ):
+        super().__init__(lock_timeout)
+        self.root = Path(root)
+        (self.root / "locks").mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._db_lock = threading.Lock()
+        # La conexión se abre con timeout para esperar a los demás procesos
+        self._conn = sqlite3.connect(self.root / "index.sqlite", timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _lock_path(self, key: str) -> Path:
+        return self.root / "locks" / f"{key}.lock"
+
+    def get(self, key: str) -> bytes:
+        now = time.time()
+        with self._db_lock:
+            row = self._conn.execute("SELECT created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[0] > self.ttl:
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Escritura atómica: los lectores ven el archivo anterior o el completo
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(value)
+        os.replace(tmp_path, path)
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, len(value), now, now)
+            )
+            self._conn.commit()
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Remove expired entries and the least recently used ones while
+        the total size is above max_bytes.
+        Returns the number of removed entries.
+        """
+        with self._db_lock:
+            removed = self._conn.execute(
+                "SELECT key FROM entries WHERE created_at < ?", (time.time() - self.ttl,)
+            ).fetchall()
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC"):
+                    if total <= self.max_bytes:
+                        break
+                    removed.append((key,))
+                    total -= size
+            for (key,) in removed:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._path(key).unlink(missing_ok=True)
+            self._conn.commit()
+        for (key,) in removed:
+            self._remove_lock(key)
+        if removed:
+            logger.info(f"Shared cache evicted {len(removed)} entries")
+        return len(removed)
+
+    def _remove_lock(self, key: str) -> None:
+        # El archivo se borra con el lock tomado, si otro proceso lo tiene se deja
+        handle = self.acquire(key, 0)
+        if handle is None:
+            return
+        try:
+            self._lock_path(key).unlink(missing_ok=True)
+        except OSError:
+            # Windows no borra un archivo abierto por otro proceso
+            pass
+        finally:
+            self.release(key, handle)
+
+    def acquire(self, key: str, timeout: float):
+        lock_path = self._lock_path(key)
+        deadline = time.monotonic() + timeout
+        while True:
+            lock_file = open(lock_path, "a+b")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            except OSError:
+                lock_file.close()
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(LOCK_POLL_INTERVAL)
+                continue
+            # evict pudo borrar el archivo mientras se esperaba, el lock de un archivo borrado no excluye a nadie
+            try:
+                current = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path))
+            except FileNotFoundError:
+                current = False
+            if current:
+                return lock_file
+            self.release(key, lock_file)
+
+    def release(self, key: str, handle) -> None:
+        try:
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+            else:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            handle.close()
+
+
+class MemorySharedCache(SharedCache):
+    """
+    In-process stand-in of an external store, with the same
+    semantics (values with TTL and expiring locks), for tests and
+    single-process runs.
+    """
+
+    def __init__(self, ttl: int = SHARED_CACHE_TTL, lock_timeout: float = SHARED_CACHE_LOCK_TIMEOUT):
+        super().__init__(lock_timeout)
+        self.ttl = ttl
+        self._store_lock = threading.Lock()
+        self._values = {}
+        self._locks = {}
+
+    def get(self, key: str) -> bytes:
+        with self._store_lock:
+            entry = self._values.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                return None
+            return entry[0]
+
+    def put(self, key: str, value: bytes) -> None:
+        with self._store_lock:
+            self._values[key] = (value, time.time())
+
+    def acquire(self, key: str, timeout: float):
+        token = f"{os.getpid()}:{threading.get_ident()}:{time.monotonic()}"
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._store_lock:
+                holder = self._locks.get(key)
+                # Como en un store externo el lock expira si su dueño no lo libera
+                if holder is None or holder[1] < time.monotonic():
+                    self._locks[key] = (token, time.monotonic() + self.lock_timeout)
+                    return token
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self, key: str, handle) -> None:
+        with self._store_lock:
+            if self._locks.get(key, (None,))[0] == handle:
+                del self._locks[key]
+
+
+class RedisSharedCache(SharedCache):
+    """
+    Shared cache in Redis for workers on several hosts. Values are
+    stored with TTL and the lock of a key is a SET NX with expiry,
+    released only by its owner.
+    """
+
+    def __init__(self, url: str, ttl: int = SHARED_CACHE_TTL, lock_timeout: float = SHARED_CACHE_LOCK_TIMEOUT):
+        import redis
+        super().__init__(lock_timeout)
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> bytes:
+        return self._client.get(f"pqrs:cache:{key}")
+
+    def put(self, key: str, value: bytes) -> None:
+        self._client.set(f"pqrs:cache:{key}", value, ex=self.ttl)
+
+    def acquire(self, key: str, timeout: float):
+        token = f"{os.getpid()}:{threading.get_ident()}:{time.time()}"
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._client.set(f"pqrs:lock:{key}", token, nx=True, px=int(self.lock_timeout * 1000)):
+                return token
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self, key: str, handle) -> None:
+        # Borrado condicionado al dueño, atómico en el servidor
+        self._client.eval(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0",
+            1, f"pqrs:lock:{key}", handle
+        )
+
+
+# Backends disponibles por esquema de SHARED_CACHE_URL, se pueden registrar otros
+BACKENDS = {
+    "file": lambda url: LocalSharedCache(root=Path(url.path)) if url.path else LocalSharedCache(),
+    "memory": lambda url: MemorySharedCache(),
+    "redis": lambda url: RedisSharedCache(url.geturl()),
+    "rediss": lambda url: RedisSharedCache(url.geturl()),
+}
+
+
+# Función para crear el cache compartido configurado
+def make_shared_cache(url: str = SHARED_CACHE_URL) -> SharedCache:
+    """
+    Returns the shared cache of the url, the local directory backend
+    if the url is empty.
+
+    Args:
+        url: backend url, see the module docstring
+    """
+    parsed = urlparse(url or "file://")
+    if parsed.scheme not in BACKENDS:
+        raise ValueError(f"Unknown shared cache backend: {parsed.scheme}")
+    cache = BACKENDS[parsed.scheme](parsed)
+    logger.info(f"Shared cache backend: {type(cache).__name__}")
+    return cache
+
+
+# Funciones para guardar los artefactos de un caso como un solo valor
+def artifacts_key(sources: str, policy: str) -> str:
+    # La política (motor y sus ajustes, REDACTION_MODE, WEAK_PAGE_RASTER, ver redaction_policy) es parte de la llave:
+    # al cambiar la configuración no se sirven artefactos anonimizados con la anterior
+    return content_hash("case-artifacts", sources, policy)
+
+
+def pack_artifacts(artifacts: dict) -> bytes:
+    """
+    Returns the artifacts of anonymize_documents as bytes: a json
+    header line followed by the anonymized pdf.
+
+    Args:
+        artifacts: output of anonymize_documents
+    """
+    header = {"sources": artifacts["sources"], "pages": artifacts["pages"], "index": artifacts["index"]}
+    return json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n" + artifacts["pdf"]
+
+
+def unpack_artifacts(value: bytes) -> dict:
+    header, pdf = value.split(b"\n", 1)
+    return {**json.loads(header), "pdf": pdf}
@@ -1,5 +1,8 @@
+import io
+import json
 import os
 import logging
+from functools import lru_cache
 from pathlib import Path
 
 import docx
@@ -9,21 +12,17 @@ from pydantic import BaseModel, Field
 from langchain_core.tools import tool
 
 from utils.dataframes import typo_data, subtypo_data, concept_data
+from utils.logs import setup_logging
+from utils.profiling import profiled
+from utils.rendering import DocxTemplate
+from utils.workspace import current_workspace
 
 MAIN_PATH = Path(os.getcwd())
 DATA_PATH = MAIN_PATH / "data"
 CASES_PATH = DATA_PATH / "cases"
 
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -33,6 +32,7 @@ class GetTypoInfoInput(BaseModel):
     typo_code_list: int = Field(description="Code of the typology chosen")
 
 @tool("get_typology_concept", args_schema=GetTypoInfoInput, return_direct=True)
+@profiled("tool:get_typology_concept")
 def get_typology_concept(
         typo_code_list: int,
 ) -> str:
@@ -66,6 +66,7 @@ class GetSubtypoInfoInput(BaseModel):
     typo_code: int = Field(description="Code of the typology chosen")
 
 @tool("get_subtypologies", args_schema=GetSubtypoInfoInput, return_direct=True)
+@profiled("tool:get_subtypologies")
 def get_subtypologies(
         typo_code: int,
 ) -> str:
@@ -93,6 +94,73 @@ def get_subtypologies(
     return typo_info
 
 
+# Función para reunir los datos de una tipología que el agente necesita tras la elección del analista
+def typology_dossier(typo_code: int) -> dict:
+    """
+    Returns the typology, its subtypologies and its third-party
+    concept (escalation, area and additional requirements per
+    casuistic) as a single dict.
+
+    Args:
+        typo_code: Code of the typology chosen
+    """
+    typo_filtered = typo_data[typo_data["id"] == typo_code]
+    if typo_filtered.empty:
+        return {"found": False, "typo_code": typo_code}
+    typo_row = typo_filtered.iloc[0]
+    subtypo_filtered = subtypo_data[subtypo_data["id"] == typo_code].drop_duplicates(subset=["subtypo", "desc"])
+    concept_filtered = concept_data[concept_data["id"] == typo_code].drop_duplicates(subset=["casu", "area", "info"])
+    casuistics = [
+        {
+            "casuistic": row["casu"],
+            "escalate": row["escal"] == "Si",
+            "area": row["area"],
+            "requirements": row["info"]
+        }
+        for _, row in concept_filtered.iterrows()
+    ]
+    return {
+        "found": True,
+        "typo_code": typo_code,
+        "typology": typo_row["typo"],
+        "description": typo_row["desc"],
+        "subtypologies": [
+            {"id": int(row["subtypo_id"]), "name": row["subtypo"], "description": row["desc"]}
+            for _, row in subtypo_filtered.iterrows()
+        ],
+        "needs_concept": any(casuistic["escalate"] for casuistic in casuistics),
+        "areas": sorted({casuistic["area"] for casuistic in casuistics if casuistic["escalate"]}),
+        "casuistics": casuistics
+    }
+
+
+# Herramienta que entrega en una sola llamada subtipologías y concepto de terceros -----------------------------------------------------------------
+@tool("get_typology_dossier", args_schema=GetSubtypoInfoInput, return_direct=True)
+@profiled("tool:get_typology_dossier")
+def get_typology_dossier(
+        typo_code: int,
+) -> str:
+
+    """
+    Returns in one call the subtypologies of the selected typology,
+    if it needs a third-party concept (escalation) and the casuistic,
+    area and additional requisites of each case, as JSON.
+
+    Args:
+        typo_code: Code of the typology chosen
+    """
+    logger.info("Tool get_typology_dossier used")
+
+    logger.info(f"Typo code used: {typo_code}")
+    dossier = typology_dossier(typo_code)
+    if not dossier["found"]:
+        logger.error("Typology not found")
+    else:
+        logger.info(f"Typology found: {len(dossier['subtypologies'])} subtypologies, {len(dossier['casuistics'])} casuistics")
+
+    return json.dumps(dossier, ensure_ascii=False)
+
+
 class MakeDocumentInput(BaseModel):
     date: str = Field(description="today's date")
     typo_name: str = Field(description="name of the typology chosen")
@@ -100,27 +168,22 @@ class MakeDocumentInput(BaseModel):
     pqrs_summary: str = Field(description="summary of the pqrs")
     file_name: str = Field(description="name of the pqrs document")
 
-# Herramienta que recibe los datos encontrados por el agente 
-# Y los convierte en la plantilla de respuesta del documento -----------------------------------------------------------------
-@tool("make_response_document", args_schema=MakeDocumentInput, return_direct=True)
-def make_response_document(
+# Función para construir la plantilla de respuesta con python-docx
+def build_response_document(
         date: str,
         typo_name: str,
         typo_desc: str,
-        pqrs_summary: str,
-        file_name: str
-):
+        pqrs_summary: str
+) -> bytes:
     """
-    Returns the response document.
+    Returns the response document as docx bytes.
 
     Args:
         date: today's date
         typo_name: typology name
         typo_desc: typology description
         pqrs_summary: summary of the pqrs documents analized
-        file_name: name of the pqrs document
     """
-    logger.info("Tool make_response_document used")
      # 1. Crear un nuevo documento
     doc = docx.Document()
 
@@ -219,10 +282,70 @@ def make_response_document(
     except Exception as e:
         logger.error(f"Error while making response document: {e}")
 
-    # 3. Guardar el documento
-    case_path = CASES_PATH / file_name
-    file_path = case_path / f"plantilla_respuesta_{file_name}.docx"
-    doc.save(file_path)
-    logger.info(f"Document created: {file_path.name}")
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+# Plantilla de respuesta armada una vez por proceso, con marcadores en los campos variables
+response_template = DocxTemplate(build_response_document, ("date", "typo_name", "typo_desc", "pqrs_summary"))
+
+
+# Función para obtener la plantilla de respuesta
+# Se memoiza por sus argumentos para reutilizar los borradores precalculados
+@lru_cache(maxsize=64)
+def render_response_document(
+        date: str,
+        typo_name: str,
+        typo_desc: str,
+        pqrs_summary: str
+) -> bytes:
+    """
+    Returns the response document as docx bytes, filling the fields
+    of the prepared template.
+
+    Args:
+        date: today's date
+        typo_name: typology name
+        typo_desc: typology description
+        pqrs_summary: summary of the pqrs documents analized
+    """
+    return response_template.render(date=date, typo_name=typo_name, typo_desc=typo_desc, pqrs_summary=pqrs_summary)
+
+
+# Herramienta que recibe los datos encontrados por el agente 
+# Y los convierte en la plantilla de respuesta del documento -----------------------------------------------------------------
+@tool("make_response_document", args_schema=MakeDocumentInput, return_direct=True)
+@profiled("tool:make_response_document")
+def make_response_document(
+        date: str,
+        typo_name: str,
+        typo_desc: str,
+        pqrs_summary: str,
+        file_name: str
+):
+    """
+    Returns the response document.
+
+    Args:
+        date: today's date
+        typo_name: typology name
+        typo_desc: typology description
+        pqrs_summary: summary of the pqrs documents analized
+        file_name: name of the pqrs document
+    """
+    logger.info("Tool make_response_document used")
+    data = render_response_document(date, typo_name, typo_desc, pqrs_summary)
+
+    # Guardar el documento
+    # En el espacio de trabajo de la sesión si existe, en memoria salvo que se persista
+    docx_name = f"plantilla_respuesta_{file_name}.docx"
+    workspace = current_workspace.get()
+    if workspace is not None:
+        file_path = workspace.save_file(file_name, docx_name, data)
+    else:
+        file_path = CASES_PATH / file_name / docx_name
+        file_path.write_bytes(data)
+    logger.info(f"Document created: {docx_name}")
 
     return file_path
\ No newline at end of file
@@ -1,4 +1,5 @@
 import logging
+import threading
 from pathlib import Path
 
 import boto3
@@ -7,22 +8,19 @@ from botocore.awsrequest import AWSRequest
 from dotenv import load_dotenv
 from google.oauth2 import service_account
 import os
+from requests.adapters import HTTPAdapter
 from requests.sessions import Session
 
 import streamlit as st
 
 import vertexai
 
+from utils.cancellation import check_cancelled
+from utils.governor import governor, vertex_model
+from utils.logs import setup_logging
+
 # Logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(filename)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Cargamos las variables de entorno
@@ -41,6 +39,10 @@ HOST_EXP_ENV = st.secrets["HOST_EXP_ENV"]
 JWT_EXP_ENV = st.secrets["JWT"]
 URL_EXP_ENV = st.secrets["URL_EXP_ENV"]
 
+VERTEX_DEFAULT_URL = "https://us-central1-aiplatform.googleapis.com"
+# Tamaño del pool de conexiones hacia el API Gateway
+POOL_MAXSIZE = int(os.getenv("VERTEX_POOL_MAXSIZE", 10))
+
 
 # Carga las credenciales de la cuenta de servicio
 service_account_credentials = service_account.Credentials.from_service_account_file(
@@ -55,48 +57,88 @@ vertexai.init(
     api_transport="rest",
 )
 
-# Save the original Session.request method
-original_request = Session.request
-
-
-def custom_request(self, method, url, headers, data, **kwargs):
-    # Replace domain if called via langchain
-    url = url.replace("https://us-central1-aiplatform.googleapis.com", URL_EXP_ENV)
-    # Check if the URL is for your Vertex AI endpoint
-    if URL_EXP_ENV in url:
-        # Format headers
-        # Lowercase and sort headers
-        headers = {k.lower(): v for k, v in sorted(dict(headers).items())}
-        # Inject the API GAteway Host
-        headers["host"] = HOST_EXP_ENV.lower()
+class CachedAWSCredentials:
+    """
+    Resolves the AWS credentials once per process.
+    Refreshable credentials are only refreshed by botocore
+    when they are about to expire.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credentials = None
+
+    def get(self):
+        """
+        Returns frozen credentials ready to sign a request.
+        """
+        if self._credentials is None:
+            with self._lock:
+                if self._credentials is None:
+                    session = boto3.Session(
+                        region_name=AWS_REGION,
+                        aws_access_key_id=AWS_ACCESS_KEY,
+                        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                        aws_session_token=AWS_SESSION_TOKEN
+                    )
+                    self._credentials = session.get_credentials()
+                    logger.info("AWS credentials resolved")
+        return self._credentials.get_frozen_credentials()
+
+
+aws_credentials = CachedAWSCredentials()
+
+
+class AWSSignedAdapter(HTTPAdapter):
+    """
+    Pooled requests adapter that redirects Vertex calls to the
+    API Gateway and signs them with AWS SigV4. It is mounted only
+    on the Vertex client session, so other requests are untouched.
+    """
+
+    def __init__(self, credentials: CachedAWSCredentials = aws_credentials, **kwargs):
+        kwargs.setdefault("pool_maxsize", POOL_MAXSIZE)
+        super().__init__(**kwargs)
+        self.credentials = credentials
+
+    def send(self, request, **kwargs):
+        check_cancelled("gateway", skipped=1)
+        # Replace domain if called via langchain
+        request.url = request.url.replace(VERTEX_DEFAULT_URL, URL_EXP_ENV)
+        # Inject the API Gateway Host
+        request.headers["host"] = HOST_EXP_ENV.lower()
         # Inject the JWT token into a custom header for downstream validation
-        headers["x-jwt-token"] = f"Bearer {JWT_EXP_ENV}"
-
-        # Sign the request with AWS SigV4
-        aws_request = AWSRequest(
-            method=method,
-            url=url + "?%24alt=json%3Benum-encoding%3Dint",
-            headers=headers,
-            data=data
-        )
-        session = boto3.Session(
-            region_name=AWS_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            aws_session_token=AWS_SESSION_TOKEN
-        )
-        credentials = session.get_credentials().get_frozen_credentials()
-        SigV4Auth(credentials, "execute-api", AWS_REGION).add_auth(aws_request)
-
-    # Call the original request method with modified paramters
-    return original_request(self,
-                            method=aws_request.method,
-                            url=url,
-                            headers=dict(aws_request.headers),
-                            data=aws_request.body,
-                            **kwargs
-                            )
-
-
-# Patch the request
-Session.request = custom_request
\ No newline at end of file
+        request.headers["x-jwt-token"] = f"Bearer {JWT_EXP_ENV}"
+
+        # Cada petición espera su turno y un cupo del modelo en el gobernador,
+        # se firma después para que la espera no envejezca la firma
+        with governor.slot(vertex_model(request.url)):
+            # Sign the request with AWS SigV4
+            aws_request = AWSRequest(
+                method=request.method,
+                url=request.url,
+                headers=dict(request.headers),
+                data=request.body
+            )
+            SigV4Auth(self.credentials.get(), "execute-api", AWS_REGION).add_auth(aws_request)
+            request.headers.update(dict(aws_request.headers.items()))
+
+            return super().send(request, **kwargs)
+
+
+# Función para montar el transporte firmado en el cliente de Vertex
+def mount_signed_transport(client) -> Session:
+    """
+    Mount the signed adapter on the HTTP session of a Vertex
+    REST client (e.g. ChatVertexAI.prediction_client).
+    Returns the patched session.
+
+    Args:
+        client: Vertex gapic client using the rest transport
+    """
+    session = client._transport._session
+    adapter = AWSSignedAdapter()
+    session.mount(URL_EXP_ENV, adapter)
+    session.mount(VERTEX_DEFAULT_URL, adapter)
+    logger.info("Signed transport mounted on Vertex client")
+    return session
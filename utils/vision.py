@@ -0,0 +1,291 @@
+import base64
+import io
+import logging
+import os
+import re
+import unicodedata
+
+import cv2
+import numpy as np
+from PIL import Image
+import fitz
+
+from utils.cancellation import check_cancelled
+from utils.logs import setup_logging
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Presupuesto de las imágenes que se envían al modelo
+# Tokens aproximados por imagen: ancho x alto / VISION_PIXELS_PER_TOKEN
+VISION_MAX_IMAGES = int(os.getenv("VISION_MAX_IMAGES", 8))
+VISION_TOKENS_PER_IMAGE = int(os.getenv("VISION_TOKENS_PER_IMAGE", 500))
+VISION_PIXELS_PER_TOKEN = 750
+VISION_RENDER_DPI = int(os.getenv("VISION_RENDER_DPI", 110))
+# Si es verdadero se renderiza también el payload original para reportar la reducción en bytes,
+# cuesta renderizar y codificar cada página otra vez, la medición está en benchmarks/vision.py
+VISION_REPORT_BYTES = os.getenv("VISION_REPORT_BYTES", "false").lower() == "true"
+# Página en blanco: casi sin tinta. Solo se juzga por la imagen, las páginas que llegan aquí son débiles
+# y su texto del OCR no es confiable (un manuscrito puede leerse como ninguna palabra)
+BLANK_INK_RATIO = float(os.getenv("BLANK_INK_RATIO", 0.002))
+CROP_MARGIN = 0.02
+
+# Términos que indican que la página habla del reclamo del cliente
+COMPLAINT_TERMS = re.compile(
+    r"\b(reclam\w*|queja\w*|solicit\w*|peticion\w*|cobr\w*|fraude\w*|devoluci\w*|reembols\w*|"
+    r"transacci\w*|debit\w*|retir\w*|tarjeta\w*|cuenta\w*|credito\w*|extracto\w*|hechos|pretensi\w*)\b"
+    r"|\$\s?\d",
+    flags=re.IGNORECASE
+)
+
+
+# Función para encontrar la región con contenido de una página
+def content_box(gray: np.ndarray) -> tuple[int, int, int, int]:
+    """
+    Returns the (x0, y0, x1, y1) box of the inked region of the
+    page, None if the page has no ink.
+
+    Args:
+        gray: grayscale page
+    """
+    _, ink = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
+    # Se quitan puntos aislados para no extender la caja por ruido
+    ink = cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+    points = cv2.findNonZero(ink)
+    if points is None:
+        return None
+    x, y, w, h = cv2.boundingRect(points)
+    return x, y, x + w, y + h
+
+
+# Función para recortar la página a su contenido y ajustarla al presupuesto
+def fit_page(image: Image, max_pixels: int) -> tuple[Image, float]:
+    """
+    Crop the page to its content with a small margin, convert it
+    to grayscale and downscale it to at most max_pixels.
+    Returns the image and its ink ratio before cropping.
+
+    Args:
+        image: rendered page
+        max_pixels: pixel budget of the image
+    """
+    gray = np.array(image.convert("L"))
+    ink = float(np.count_nonzero(gray < 200) / gray.size)
+    box = content_box(gray)
+    if box is not None:
+        height, width = gray.shape
+        margin = int(CROP_MARGIN * max(height, width))
+        x0, y0, x1, y1 = box
+        gray = gray[max(y0 - margin, 0):min(y1 + margin, height), max(x0 - margin, 0):min(x1 + margin, width)]
+    height, width = gray.shape
+    if height * width > max_pixels:
+        scale = (max_pixels / (height * width)) ** 0.5
+        gray = cv2.resize(gray, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+    return Image.fromarray(gray), ink
+
+
+# Función para comparar texto sin tildes ni mayúsculas
+def normalize(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", text.lower()) if unicodedata.category(c) != "Mn")
+
+
+# Función para clasificar una página antes de enviarla como imagen
+def page_kind(ink: float) -> str:
+    """
+    Returns "blank" or "content", from the ink of the page only.
+
+    Args:
+        ink: ratio of inked pixels of the page
+    """
+    return "blank" if ink < BLANK_INK_RATIO else "content"
+
+
+# Función para medir qué tan relacionada está una página con el reclamo
+def relevance(text: str) -> int:
+    return len(COMPLAINT_TERMS.findall(normalize(text or "")))
+
+
+# Función para enviar como texto una página que no va como imagen
+def text_block(page: dict, empty: str) -> dict:
+    return {"type": "text", "text": f"--- Página {page['page']} ---\n{page.get('text') or empty}"}
+
+
+# Función para codificar una imagen en el formato del mensaje
+def image_block(image: Image) -> dict:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return {
+        "type": "image",
+        "source_type": "base64",
+        "data": base64.b64encode(buffer.getvalue()).decode("utf-8"),
+        "mime_type": "image/png"
+    }
+
+
+# Función para renderizar las imágenes de una página del pdf anonimizado
+def page_images(
+        pdf_document,
+        page: dict,
+        tokens_per_image: int = VISION_TOKENS_PER_IMAGE,
+        report: dict = None
+) -> tuple[str, list[Image]]:
+    """
+    Render the pdf pages of a source page cropped to their content
+    and downscaled to the token budget.
+    Returns the kind of the page (see page_kind) and its images.
+
+    Args:
+        pdf_document: anonymized pdf opened with fitz
+        page: dict with page, text (None if unknown) and pdf_pages
+        tokens_per_image: approximate token budget of each image
+        report: optional report to add the before totals to
+    """
+    max_pixels = tokens_per_image * VISION_PIXELS_PER_TOKEN
+    zoom = VISION_RENDER_DPI / 72
+    images = []
+    for index in page["pdf_pages"]:
+        pdf_page = pdf_document.load_page(index)
+        # Antes: la página completa con la resolución por defecto
+        if report is not None:
+            report["images_before"] += 1
+            report["pixels_before"] += int(pdf_page.rect.width) * int(pdf_page.rect.height)
+            if report["bytes_before"] is not None:
+                pix = pdf_page.get_pixmap()
+                original = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                buffer = io.BytesIO()
+                original.save(buffer, format="PNG")
+                report["bytes_before"] += len(base64.b64encode(buffer.getvalue()))
+        pix = pdf_page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        rendered = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        images.append(fit_page(rendered, max_pixels))
+    ink = max((ratio for _, ratio in images), default=0.0)
+    return page_kind(ink), [image for image, _ in images]
+
+
+# Función para elegir las páginas que se envían como imagen
+def select_image_pages(candidates: list[tuple[dict, int]], max_images: int = VISION_MAX_IMAGES) -> set:
+    """
+    Returns the page numbers sent as images: with more images than
+    max_images the pages most related to the complaint go first.
+
+    Args:
+        candidates: (page dict, number of images) of each content page
+        max_images: maximum number of images of the request
+    """
+    ranked = sorted(candidates, key=lambda item: (-relevance(item[0].get("text")), item[0]["page"]))
+    selected = set()
+    n_images = 0
+    for page, count in ranked:
+        if n_images + count <= max_images:
+            selected.add(page["page"])
+            n_images += count
+    return selected
+
+
+# Función para iniciar el reporte de tamaños del payload de visión
+def new_report(n_pages: int, report_bytes: bool = VISION_REPORT_BYTES) -> dict:
+    return {
+        "pages": n_pages, "blank": 0, "capped": 0,
+        "images_before": 0, "images_after": 0,
+        "pixels_before": 0, "pixels_after": 0, "bytes_before": 0 if report_bytes else None, "bytes_after": 0
+    }
+
+
+# Función para renderizar una página candidata a imagen
+def render_vision_page(
+        pdf_document,
+        page: dict,
+        tokens_per_image: int = VISION_TOKENS_PER_IMAGE,
+        report: dict = None,
+        encode: bool = False
+) -> dict:
+    """
+    Render the images of a page (see page_images).
+    Returns a dict with the page, its kind and its images, and their
+    content blocks when encode is set and the page is not blank.
+
+    Args:
+        pdf_document: anonymized pdf opened with fitz
+        page: dict with page, text (None if unknown) and pdf_pages
+        tokens_per_image: approximate token budget of each image
+        report: optional report to add the before totals to
+        encode: also encode the images, before knowing if the page is selected
+    """
+    kind, images = page_images(pdf_document, page, tokens_per_image, report)
+    rendered = {"page": page, "kind": kind, "images": images}
+    if encode and kind == "content":
+        rendered["blocks"] = [image_block(image) for image in images]
+    return rendered
+
+
+# Función para armar el payload de visión con las páginas ya renderizadas
+def assemble_vision_payload(rendered: list[dict], report: dict, max_images: int = VISION_MAX_IMAGES) -> dict:
+    """
+    Apply the image cap to the rendered pages: blank pages and, above
+    max_images, all but the pages most related to the complaint fall
+    back to their anonymized text, so every page gets a block.
+    Returns a dict of page number -> content blocks.
+
+    Args:
+        rendered: output of render_vision_page for each page
+        report: report of the payload, the after totals are added to it
+        max_images: maximum number of images of the request
+    """
+    blocks = {}
+    candidates = []
+    for item in rendered:
+        if item["kind"] == "blank":
+            report["blank"] += 1
+            blocks[item["page"]["page"]] = [text_block(item["page"], "(Página en blanco)")]
+            continue
+        candidates.append(item)
+
+    # Con más imágenes que el límite se priorizan las páginas del reclamo
+    selected = select_image_pages([(item["page"], len(item["images"])) for item in candidates], max_images)
+
+    for item in candidates:
+        page = item["page"]
+        if page["page"] in selected:
+            # Las páginas que no se codificaron al renderizar se codifican solo si se envían
+            blocks[page["page"]] = item.get("blocks") or [image_block(image) for image in item["images"]]
+            report["images_after"] += len(item["images"])
+            report["pixels_after"] += sum(image.width * image.height for image in item["images"])
+            report["bytes_after"] += sum(len(block["data"]) for block in blocks[page["page"]])
+        else:
+            report["capped"] += 1
+            blocks[page["page"]] = [text_block(page, "(Página no enviada como imagen, sin texto reconocido)")]
+    logger.info(f"Vision payload: {report}")
+    return blocks
+
+
+# Función para construir las imágenes del payload con el presupuesto de visión
+def optimize_vision_payload(
+        doc: bytes,
+        pages: list[dict],
+        max_images: int = VISION_MAX_IMAGES,
+        tokens_per_image: int = VISION_TOKENS_PER_IMAGE,
+        report_bytes: bool = VISION_REPORT_BYTES
+) -> tuple[dict, dict]:
+    """
+    Render the given pages of the anonymized pdf cropped to their
+    content and downscaled to the token budget, and apply the image
+    cap (see assemble_vision_payload).
+    Returns a dict of page number -> content blocks and a report
+    with the before/after pixel and byte totals (bytes_before is None
+    unless report_bytes).
+
+    Args:
+        doc: bytes of the anonymized pdf
+        pages: dicts with page, text (None if unknown) and pdf_pages
+        max_images: maximum number of images of the request
+        tokens_per_image: approximate token budget of each image
+        report_bytes: also render and encode the full pages to report the bytes before
+    """
+    pdf_document = fitz.open(stream=doc, filetype="pdf")
+    report = new_report(len(pages), report_bytes)
+    rendered = []
+    for i, page in enumerate(pages):
+        check_cancelled("encode", skipped=len(pages) - i)
+        rendered.append(render_vision_page(pdf_document, page, tokens_per_image, report))
+    return assemble_vision_payload(rendered, report, max_images), report
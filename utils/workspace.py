@@ -0,0 +1,189 @@
+import logging
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from utils.case_store import CaseStore
+from utils.functions import load_case_artifacts, redaction_policy, save_case_artifacts
+from utils.logs import setup_logging
+from utils.shared_cache import artifacts_key
+
+# Logs
+setup_logging()
+logger = logging.getLogger(__name__)
+
+MAIN_PATH = Path(os.getcwd())
+DATA_PATH = MAIN_PATH / "data"
+CASES_PATH = DATA_PATH / "cases"
+
+# Si es verdadero los artefactos de cada caso también se guardan en disco
+PERSIST_ARTIFACTS = os.getenv("PERSIST_ARTIFACTS", "false").lower() == "true"
+# Los artefactos anonimizados dependen solo del contenido de los documentos,
+# se guardan en root/ARTIFACTS_DIR/<llave del contenido> para recargarlos desde cualquier sesión
+ARTIFACTS_DIR = "artifacts"
+
+# Espacio de trabajo de la sesión que atiende el turno actual
+current_workspace = ContextVar("current_workspace", default=None)
+
+
+# Función para limpiar un nombre antes de usarlo como ruta
+def safe_name(name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", Path(name).name) or "_"
+
+
+class SessionWorkspace:
+    """
+    Isolated workspace of an analyst session. The anonymized
+    artifacts of each case and the generated files live in memory.
+    With persist the generated files are also written under
+    root/<session_id>/<case>, so sessions never overwrite each
+    other's files, and the artifacts under
+    root/ARTIFACTS_DIR/<artifacts key>, keyed by the content of the
+    documents so any session (or a restart) reloads them. Both are
+    indexed in the case store when one is given.
+    """
+
+    def __init__(
+            self,
+            session_id: str = None,
+            root: Path = CASES_PATH,
+            persist: bool = PERSIST_ARTIFACTS,
+            store: CaseStore = None
+    ):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.root = Path(root)
+        self.persist = persist
+        self.store = store
+        self._lock = threading.Lock()
+        self._cases = {}
+        self._files = {}
+
+    def case_path(self, case_name: str) -> Path:
+        """
+        Returns the directory of the case inside the session,
+        created on demand.
+
+        Args:
+            case_name: name of the case
+        """
+        path = self.root / safe_name(self.session_id) / safe_name(case_name)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def encrypted_path(self, sources: str) -> Path:
+        """
+        Returns the path of the anonymized pdf of the documents with
+        this sources digest, shared by all the sessions.
+
+        Args:
+            sources: sources digest of the documents of the case
+        """
+        key = artifacts_key(sources, redaction_policy())
+        return self.root / ARTIFACTS_DIR / key / f"{key}_encrypted.pdf"
+
+    def _index(self, case_hash: str, paths: list[Path]):
+        if self.store is None:
+            return
+        for path in paths:
+            self.store.put(case_hash, path.parent, path.name, path)
+
+    def _load(self, sources: str) -> dict:
+        # Con índice basta una consulta, sin él se revisa el disco
+        encrypted_path = self.encrypted_path(sources)
+        if self.store is None:
+            return load_case_artifacts(encrypted_path)
+        path = self.store.get(artifacts_key(sources, redaction_policy()), encrypted_path.name)
+        return load_case_artifacts(path) if path else None
+
+    def get_case(self, case_name: str, sources: str = None) -> dict:
+        """
+        Returns the artifacts of the case. With persist and sources,
+        artifacts of the same documents saved by any session or a
+        previous run are loaded from disk when the session has none
+        for them. None if they do not exist.
+
+        Args:
+            case_name: name of the case
+            sources: sources digest of the documents of the case
+        """
+        with self._lock:
+            artifacts = self._cases.get(case_name)
+        if self.persist and sources and (artifacts is None or artifacts["sources"] != sources):
+            loaded = None
+            try:
+                loaded = self._load(sources)
+            except Exception as e:
+                logger.error(f"Error loading case artifacts: {e}")
+            if loaded is not None:
+                artifacts = loaded
+                with self._lock:
+                    self._cases[case_name] = artifacts
+        return artifacts
+
+    def put_case(self, case_name: str, artifacts: dict):
+        """
+        Store the artifacts of the case.
+
+        Args:
+            case_name: name of the case
+            artifacts: output of anonymize_documents
+        """
+        with self._lock:
+            self._cases[case_name] = artifacts
+        if self.persist:
+            try:
+                encrypted_path = self.encrypted_path(artifacts["sources"])
+                encrypted_path.parent.mkdir(parents=True, exist_ok=True)
+                self._index(
+                    artifacts_key(artifacts["sources"], redaction_policy()), save_case_artifacts(artifacts, encrypted_path)
+                )
+            except Exception as e:
+                logger.error(f"Error saving case artifacts: {e}")
+
+    def save_file(self, case_name: str, file_name: str, data: bytes) -> str:
+        """
+        Store a generated file of the case.
+        Returns the path of the file if persisted, its name otherwise.
+
+        Args:
+            case_name: name of the case
+            file_name: name of the file
+            data: file bytes
+        """
+        with self._lock:
+            self._files[(case_name, file_name)] = data
+        if not self.persist:
+            return file_name
+        file_path = self.case_path(case_name) / safe_name(file_name)
+        with open(file_path, "wb") as f:
+            f.write(data)
+        try:
+            self._index(CaseStore.make_key(self.session_id, case_name), [file_path])
+        except Exception as e:
+            logger.error(f"Error indexing {file_name}: {e}")
+        return str(file_path)
+
+    def get_file(self, case_name: str, file_name: str) -> bytes:
+        """
+        Returns the bytes of a generated file of the case, None if it does not exist.
+
+        Args:
+            case_name: name of the case
+            file_name: name of the file
+        """
+        with self._lock:
+            return self._files.get((case_name, file_name))
+
+
+# Contexto para que las herramientas del agente usen el espacio de la sesión
+@contextmanager
+def use_workspace(workspace: SessionWorkspace):
+    token = current_workspace.set(workspace)
+    try:
+        yield workspace
+    finally:
+        current_workspace.reset(token)